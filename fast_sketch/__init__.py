@@ -9,30 +9,48 @@ bl_info = {
 
 import bpy
 
+from .background import cancel_all_bakes
 from .gizmo import FastSketchGizmo, FastSketchGizmoGroup
+from .misc import migrate_all_sketches, sketch_ids_migration_handler
 from .properties import FastSketchNodeProperties, FastSketchTubeProperties, FastSketchGroupProperties, \
-    FastSketchWmProperties
-from .tool import FastSketchToolOperator, FastSketchTool
+    FastSketchWmProperties, FastSketchPreferences
+from .runtime import sketch_data_reloaded_handler, sketch_file_loaded_handler, sketch_selection_save_handler
+from .tool import FastSketchToolOperator, FastSketchUndoOperator, FastSketchRedoOperator, FastSketchTool
 from .ui import FastSketchTubeList, FastSketchPanel, \
     FastSketchBakeOperator, \
+    FastSketchBackgroundBakeOperator, \
+    FastSketchCancelBakeOperator, \
     FastSketchAddTubeOperator, \
     FastSketchRemoveTubeOperator, \
-    FastSketchCreateArmatureOperator
+    FastSketchCreateArmatureOperator, \
+    FastSketchCreateSketchFromArmatureOperator, \
+    FastSketchExportOperator, \
+    FastSketchImportOperator, \
+    draw_import_menu, draw_export_menu, draw_convert_menu
+from .update import flush_geometry_updates, sketch_geometry_reloaded_handler
 
 classes = [
     FastSketchNodeProperties,
     FastSketchTubeProperties,
     FastSketchGroupProperties,
     FastSketchWmProperties,
+    FastSketchPreferences,
 
     FastSketchTubeList,
     FastSketchPanel,
     FastSketchBakeOperator,
+    FastSketchBackgroundBakeOperator,
+    FastSketchCancelBakeOperator,
     FastSketchAddTubeOperator,
     FastSketchRemoveTubeOperator,
     FastSketchCreateArmatureOperator,
+    FastSketchCreateSketchFromArmatureOperator,
+    FastSketchExportOperator,
+    FastSketchImportOperator,
 
     FastSketchToolOperator,
+    FastSketchUndoOperator,
+    FastSketchRedoOperator,
 
     FastSketchGizmo,
     FastSketchGizmoGroup,
@@ -45,9 +63,38 @@ def register():
     bpy.types.Object.fast_sketch_properties = bpy.props.PointerProperty(type=FastSketchGroupProperties)
     bpy.types.WindowManager.fast_sketch = bpy.props.PointerProperty(type=FastSketchWmProperties)
     bpy.utils.register_tool(FastSketchTool, separator=True, group=False)
+    bpy.types.TOPBAR_MT_file_import.append(draw_import_menu)
+    bpy.types.TOPBAR_MT_file_export.append(draw_export_menu)
+    bpy.types.VIEW3D_MT_object_convert.append(draw_convert_menu)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post, bpy.app.handlers.load_post):
+        handlers.append(sketch_data_reloaded_handler)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        handlers.append(sketch_geometry_reloaded_handler)
+    bpy.app.handlers.load_post.append(sketch_file_loaded_handler)
+    bpy.app.handlers.load_post.append(sketch_ids_migration_handler)
+    bpy.app.handlers.save_pre.append(sketch_selection_save_handler)
+    # sketches of the file open when the add-on is enabled
+    bpy.app.timers.register(migrate_all_sketches, first_interval=0)
 
 
 def unregister():
+    if sketch_ids_migration_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(sketch_ids_migration_handler)
+    if sketch_file_loaded_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(sketch_file_loaded_handler)
+    if sketch_selection_save_handler in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(sketch_selection_save_handler)
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post):
+        if sketch_geometry_reloaded_handler in handlers:
+            handlers.remove(sketch_geometry_reloaded_handler)
+    flush_geometry_updates()
+    cancel_all_bakes()
+    for handlers in (bpy.app.handlers.undo_post, bpy.app.handlers.redo_post, bpy.app.handlers.load_post):
+        if sketch_data_reloaded_handler in handlers:
+            handlers.remove(sketch_data_reloaded_handler)
+    bpy.types.TOPBAR_MT_file_import.remove(draw_import_menu)
+    bpy.types.TOPBAR_MT_file_export.remove(draw_export_menu)
+    bpy.types.VIEW3D_MT_object_convert.remove(draw_convert_menu)
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
     bpy.utils.unregister_tool(FastSketchTool)
@@ -0,0 +1,113 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+import bpy
+import numpy as np
+
+from .bake import write_baked_mesh, get_bake_key
+from .bake_worker import STAGE_PREFIX, REPORT_PREFIX
+from .runtime import get_sketch_arrays, get_preferences
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bake_worker.py")
+
+# running background bakes, keyed by object session uid, so renaming the object keeps its bake
+_bakes = {}
+
+
+# a bake running in a separate background Blender, started from a copy of the sketch written to a temporary file
+class BakeProcess:
+    def __init__(self, obj):
+        self.object_name = obj.name
+        self.session_uid = obj.session_uid
+        # to tell whether the sketch or its settings changed while baking
+        self.bake_key = get_bake_key(obj, get_sketch_arrays(obj))
+        self.stage = "start"
+        self.report = ""
+        self.log = deque(maxlen=20)
+        self.cancelled = False
+        self.start_time = time.perf_counter()
+        self.directory = tempfile.mkdtemp(prefix="fast_sketch_bake_")
+        self.input_path = os.path.join(self.directory, "sketch.blend")
+        self.output_path = os.path.join(self.directory, "result.npz")
+        preferences = get_preferences()
+        try:
+            bpy.data.libraries.write(self.input_path, {obj}, fake_user=True)
+            self.process = subprocess.Popen(
+                [bpy.app.binary_path, "--background", "--factory-startup", "--python-exit-code", "1",
+                 "--python", WORKER_SCRIPT, "--", self.input_path, self.output_path, obj.name,
+                 bpy.path.abspath(preferences.bake_cache_directory), str(preferences.bake_cache_size)],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        except Exception:
+            self.close()
+            raise
+        self.thread = threading.Thread(target=self._read_output, daemon=True)
+        self.thread.start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            line = line.rstrip()
+            if line.startswith(STAGE_PREFIX):
+                self.stage = line[len(STAGE_PREFIX):]
+            elif line.startswith(REPORT_PREFIX):
+                self.report = line[len(REPORT_PREFIX):]
+            else:
+                self.log.append(line)
+
+    def get_elapsed_time(self):
+        return time.perf_counter() - self.start_time
+
+    def poll(self):
+        # exit code, or None while running
+        return self.process.poll()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    def read_result(self):
+        self.thread.join()
+        with np.load(self.output_path) as data:
+            return {name: data[name] for name in data.files}
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_bake(obj):
+    return _bakes.get(obj.session_uid)
+
+
+def get_bake_object(bake):
+    # the sketch the bake was started from, or None if it was deleted
+    for obj in bpy.data.objects:
+        if obj.session_uid == bake.session_uid:
+            return obj
+    return None
+
+
+def start_bake(obj):
+    bake = BakeProcess(obj)
+    _bakes[obj.session_uid] = bake
+    return bake
+
+
+def finish_bake(bake):
+    _bakes.pop(bake.session_uid, None)
+    bake.close()
+
+
+def cancel_all_bakes():
+    for bake in list(_bakes.values()):
+        bake.cancel()
+        bake.process.wait()
+        finish_bake(bake)
+
+
+def swap_in_bake(obj, result):
+    write_baked_mesh(obj, result)
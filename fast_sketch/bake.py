@@ -0,0 +1,310 @@
+import time
+
+import bpy
+import numpy as np
+
+from .cache import BakeCache, hash_bake_key
+from .mesher import evaluate_capsule_field, surface_nets, get_voxel_capsules, get_voxel_size, join_meshes
+from .misc import replace_join_nodes_with_boolean_nodes
+from .runtime import get_sketch_arrays, get_preferences
+from .spatial import find_overlap_clusters
+from .union import plan_boolean_union
+from .update import get_skeleton, write_polygon_mesh, write_polygons, remove_skin_modifier, \
+    remove_geometry_node_modifier, get_node_segments, build_bake_geometry
+
+bake_cache = BakeCache(256 * 1024 * 1024)
+
+# baked mesh arrays holding the coordinates of a UV map, followed by its name
+UV_PREFIX = "uv:"
+
+
+def format_timings(timings):
+    return ", ".join("%s %.2fs" % timing for timing in timings)
+
+
+def get_bake_key(obj, arrays):
+    # everything the baked mesh depends on, the views and interactions do not change bakes
+    group = obj.fast_sketch_properties
+    if group.bake_method == "Voxel":
+        settings = (group.voxel_size, group.blend_radius)
+    else:
+        settings = (get_node_segments(obj, arrays, bake=True), group.method, group.sub_surf_levels,
+                    group.merge_meshes)
+    return hash_bake_key(arrays.locations, arrays.radii, arrays.tube_offsets, arrays.parents, group.bake_method,
+                         *settings, tuple(group.mirror_axis), group.mirror_merge, group.mirror_merge_threshold,
+                         tuple(group.bisect_axis))
+
+
+def read_baked_mesh(mesh):
+    verts = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    loops = np.empty(len(mesh.loops), dtype=np.int32)
+    loop_starts = np.empty(len(mesh.polygons), dtype=np.int32)
+    smooth = np.empty(len(mesh.polygons), dtype=bool)
+    mesh.vertices.foreach_get("co", verts)
+    mesh.loops.foreach_get("vertex_index", loops)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    mesh.polygons.foreach_get("use_smooth", smooth)
+    material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get("material_index", material_indices)
+    baked = {"verts": verts.reshape(-1, 3), "loops": loops, "loop_starts": loop_starts, "smooth": smooth,
+             "material_indices": material_indices}
+    for uv_layer in mesh.uv_layers:
+        uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", uvs)
+        baked[UV_PREFIX + uv_layer.name] = uvs
+    return baked
+
+
+def write_baked_mesh(obj, baked):
+    # replace the sketch with a mesh read by read_baked_mesh
+    remove_sketch_modifiers(obj)
+    obj.fast_sketch_properties.is_fast_sketch = False
+    mesh = obj.data
+    write_polygons(mesh, baked["verts"], baked["loops"], baked["loop_starts"], baked["smooth"])
+    if "material_indices" in baked:
+        mesh.polygons.foreach_set("material_index", np.ascontiguousarray(baked["material_indices"], dtype=np.int32))
+    for key, uvs in baked.items():
+        if key.startswith(UV_PREFIX):
+            name = key[len(UV_PREFIX):]
+            uv_layer = mesh.uv_layers.get(name) or mesh.uv_layers.new(name=name)
+            uv_layer.data.foreach_set("uv", np.ascontiguousarray(uvs, dtype=np.float32))
+
+
+def update_bake_cache_options():
+    preferences = get_preferences()
+    bake_cache.set_options(preferences.bake_cache_size * 1024 * 1024,
+                           bpy.path.abspath(preferences.bake_cache_directory))
+
+
+def load_cached_bake(obj, key=None):
+    # replace the sketch with its cached bake, returns whether there was one
+    update_bake_cache_options()
+    if key is None:
+        key = get_bake_key(obj, get_sketch_arrays(obj))
+    baked = bake_cache.get(key)
+    if baked is None:
+        return False
+    write_baked_mesh(obj, baked)
+    return True
+
+
+def bake_sketch(obj, progress=None):
+    # turn the sketch into a plain mesh, obj must be the active object, returns a report of the bake
+    # progress is called with the name of each stage before it starts
+    if progress is None:
+        def progress(stage):
+            pass
+
+    progress("cache lookup")
+    key = get_bake_key(obj, get_sketch_arrays(obj))
+    if load_cached_bake(obj, key):
+        return "Baked from cache"
+
+    if obj.fast_sketch_properties.bake_method == "Voxel":
+        report = bake_voxels(obj, progress)
+    else:
+        progress("build")
+        build_bake_geometry(obj)
+        report = bake_booleans(obj, progress)
+    progress("cache store")
+    bake_cache.put(key, read_baked_mesh(obj.data))
+    return report
+
+
+def bake_booleans(obj, progress):
+    merge_meshes = obj.fast_sketch_properties.merge_meshes
+    # seconds spent in each stage
+    timings = []
+
+    def apply_modifier(name):
+        stage = name.replace("Fast Sketch ", "apply ").lower()
+        progress(stage)
+        start_time = time.perf_counter()
+        bpy.ops.object.modifier_apply(modifier=name)
+        timings.append((stage, time.perf_counter() - start_time))
+
+    stats = None
+    if obj.modifiers.get("Fast Sketch Mesh"):
+        # the sketch is still needed to find the overlapping hulls
+        progress("plan unions")
+        stats, pieces = plan_boolean_union(obj, merge_meshes, timings)
+        stats["cached"] = bake_union_pieces(obj, pieces, progress, timings)
+
+    obj.fast_sketch_properties.is_fast_sketch = False
+
+    if obj.modifiers.get("Fast Sketch Attribute Mesh"):
+        replace_join_nodes_with_boolean_nodes(merge_meshes, "Fast Sketch Attribute Mesh")
+        apply_modifier("Fast Sketch Attribute Mesh")
+
+    if obj.modifiers.get("Fast Sketch Skin"):
+        apply_modifier("Fast Sketch Skin")
+
+    if obj.modifiers.get("Fast Sketch Sub Surf"):
+        apply_modifier("Fast Sketch Sub Surf")
+
+    if merge_meshes and obj.fast_sketch_properties.method in ("Skin Modifier", "Mesh"):
+        # remove internal vertices
+        geo_nodes = obj.modifiers.new("Fast Sketch Boolean Union", "NODES")
+        obj.modifiers.move(len(obj.modifiers) - 1, 0)
+        tree = bpy.data.node_groups.new("Geometry Nodes", "GeometryNodeTree")
+        geo_nodes.node_group = tree
+        # tree.inputs.new("NodeSocketGeometry", "Geometry")
+        # tree.outputs.new("NodeSocketGeometry", "Geometry")
+        tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='INPUT')
+        tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='OUTPUT')
+        input_node = tree.nodes.new("NodeGroupInput")
+        output_node = tree.nodes.new("NodeGroupOutput")
+        bool_node = tree.nodes.new(type="GeometryNodeMeshBoolean")
+        bool_node.operation = "UNION"
+        bool_node.solver = "EXACT"
+        bool_node.inputs[2].default_value = True
+        tree.links.new(input_node.outputs[0], bool_node.inputs["Mesh 2"])
+        tree.links.new(bool_node.outputs[0], output_node.inputs[0])
+        apply_modifier("Fast Sketch Boolean Union")
+
+    if obj.modifiers.get("Fast Sketch Mirror"):
+        apply_modifier("Fast Sketch Mirror")
+
+    report = format_timings(timings)
+    if stats:
+        report = "%d hulls in %d clusters with %d from cache, %d unions, depth %d: %s" % (
+            stats["primitives"], stats["clusters"], stats["cached"], stats["unions"], stats["depth"], report)
+    return "Baked, " + report
+
+
+def join_baked_meshes(pieces):
+    vert_offsets = np.cumsum([0] + [len(piece["verts"]) for piece in pieces])
+    loop_offsets = np.cumsum([0] + [len(piece["loops"]) for piece in pieces])
+    return {
+        "verts": np.concatenate([piece["verts"] for piece in pieces] or [np.empty((0, 3), dtype=np.float32)]),
+        "loops": np.concatenate([piece["loops"] + offset for piece, offset in zip(pieces, vert_offsets)]
+                                or [np.empty(0, dtype=np.int32)]),
+        "loop_starts": np.concatenate([piece["loop_starts"] + offset for piece, offset in zip(pieces, loop_offsets)]
+                                      or [np.empty(0, dtype=np.int32)]),
+        "smooth": np.concatenate([piece["smooth"] for piece in pieces] or [np.empty(0, dtype=bool)]),
+        "material_indices": np.concatenate([piece["material_indices"] for piece in pieces]
+                                           or [np.empty(0, dtype=np.int32)]),
+    }
+
+
+def bake_union_pieces(obj, pieces, progress, timings):
+    # replace the Fast Sketch Mesh modifier with its result, evaluated and cached one cluster of hulls at a time
+    # like the pieces of voxel bakes, so clusters untouched since the last bake are not computed again
+    # pieces come from plan_boolean_union, returns how many were found in the cache
+    arrays = get_sketch_arrays(obj)
+    segments = get_node_segments(obj, arrays, bake=True)
+    geo_nodes = obj.modifiers["Fast Sketch Mesh"]
+    tree = geo_nodes.node_group
+    join_socket = tree.nodes["Join"].inputs["Geometry"]
+    for link in list(join_socket.links):
+        tree.links.remove(link)
+    # the modifiers after it are applied to the joined pieces
+    hidden = [modifier for modifier in obj.modifiers if modifier != geo_nodes and modifier.show_viewport]
+    for modifier in hidden:
+        modifier.show_viewport = False
+
+    baked_pieces = []
+    cached_count = 0
+    evaluate_time = 0.0
+    try:
+        for piece_index, (socket, first_nodes, second_nodes) in enumerate(pieces):
+            key = hash_bake_key("boolean piece", arrays.locations[first_nodes], arrays.radii[first_nodes],
+                                segments[first_nodes], arrays.locations[second_nodes], arrays.radii[second_nodes],
+                                segments[second_nodes])
+            piece = bake_cache.get(key)
+            if piece is None:
+                progress("piece %d" % (piece_index + 1))
+                start_time = time.perf_counter()
+                link = tree.links.new(socket, join_socket)
+                obj_eval = obj.evaluated_get(bpy.context.evaluated_depsgraph_get())
+                piece = read_baked_mesh(obj_eval.to_mesh())
+                obj_eval.to_mesh_clear()
+                tree.links.remove(link)
+                evaluate_time += time.perf_counter() - start_time
+                bake_cache.put(key, piece)
+            else:
+                cached_count += 1
+            baked_pieces.append(piece)
+    finally:
+        for modifier in hidden:
+            modifier.show_viewport = True
+    timings.append(("evaluate pieces", evaluate_time))
+
+    progress("write")
+    start_time = time.perf_counter()
+    baked = join_baked_meshes(baked_pieces)
+    remove_geometry_node_modifier(obj, "Fast Sketch Mesh")
+    write_polygons(obj.data, baked["verts"], baked["loops"], baked["loop_starts"], baked["smooth"])
+    obj.data.polygons.foreach_set("material_index", baked["material_indices"])
+    timings.append(("write", time.perf_counter() - start_time))
+    return cached_count
+
+
+def remove_sketch_modifiers(obj):
+    remove_geometry_node_modifier(obj, "Fast Sketch Mesh")
+    remove_geometry_node_modifier(obj, "Fast Sketch Attribute Mesh")
+    remove_skin_modifier(obj)
+    mirror = obj.modifiers.get("Fast Sketch Mirror")
+    if mirror:
+        obj.modifiers.remove(mirror)
+
+
+def bake_voxels(obj, progress):
+    group = obj.fast_sketch_properties
+    arrays = get_sketch_arrays(obj)
+    vert_nodes, edges = get_skeleton(obj, arrays)
+    radii = arrays.radii[vert_nodes].astype(np.float64)
+    capsules = get_voxel_capsules(arrays.locations[vert_nodes].astype(np.float64), radii, edges)
+    voxel_size = get_voxel_size(radii, group.voxel_size)
+    blend = group.blend_radius
+    mirror_axis = tuple(group.mirror_axis)
+    bisect_axis = tuple(group.bisect_axis)
+    field_time = 0.0
+    surface_time = 0.0
+
+    # groups of capsules too far apart to blend are meshed and cached separately
+    # mirrored halves may blend across the mirror planes, so mirrored sketches are one piece
+    if any(mirror_axis):
+        clusters = np.zeros(len(capsules[0]), dtype=np.int64)
+    else:
+        margin = blend + voxel_size * 2
+        starts, start_radii, ends, end_radii = capsules
+        clusters = find_overlap_clusters(
+            np.minimum(starts - start_radii[:, np.newaxis], ends - end_radii[:, np.newaxis]) - margin,
+            np.maximum(starts + start_radii[:, np.newaxis], ends + end_radii[:, np.newaxis]) + margin)
+    order = np.argsort(clusters, kind="stable")
+    pieces = []
+    cached_count = 0
+    for piece_index, members in enumerate(np.split(order, np.flatnonzero(np.diff(clusters[order])) + 1)
+                                          if len(order) else ()):
+        piece_capsules = tuple(values[members] for values in capsules)
+        key = hash_bake_key("voxel piece", *piece_capsules, voxel_size, blend, mirror_axis, bisect_axis)
+        piece = bake_cache.get(key)
+        if piece is None:
+            progress("piece %d" % (piece_index + 1))
+            start_time = time.perf_counter()
+            # mirrors are part of the field, so the halves are joined without seams
+            field, origin, piece_voxel_size = evaluate_capsule_field(*piece_capsules, voxel_size, blend, mirror_axis,
+                                                                     bisect_axis)
+            field_time += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            piece_verts, piece_quads = surface_nets(field, origin, piece_voxel_size)
+            surface_time += time.perf_counter() - start_time
+            piece = {"verts": piece_verts, "quads": piece_quads}
+            bake_cache.put(key, piece)
+        else:
+            cached_count += 1
+        pieces.append(piece)
+    verts, tris, quads = join_meshes([(piece["verts"], np.empty((0, 3), dtype=np.int32), piece["quads"])
+                                      for piece in pieces])
+    timings = [("field", field_time), ("surface", surface_time)]
+
+    progress("write")
+    start_time = time.perf_counter()
+    remove_sketch_modifiers(obj)
+    group.is_fast_sketch = False
+    write_polygon_mesh(obj.data, verts, tris, quads)
+    timings.append(("write", time.perf_counter() - start_time))
+
+    return "Baked %d faces, %d pieces with %d from cache, voxels of %.4g: %s" % (
+        len(quads), len(pieces), cached_count, voxel_size, format_timings(timings))
@@ -0,0 +1,51 @@
+import importlib
+import os
+import sys
+
+import addon_utils
+import bpy
+import numpy as np
+
+# script of the background bake process, run as
+# blender --background --factory-startup --python bake_worker.py -- <sketch .blend> <result .npz> <object name>
+#     <bake cache directory> <bake cache size>
+# it must not use relative imports, the add-on is enabled from the directory of this file
+
+STAGE_PREFIX = "FAST_SKETCH_STAGE "
+REPORT_PREFIX = "FAST_SKETCH_REPORT "
+
+
+def print_stage(stage):
+    print(STAGE_PREFIX + stage, flush=True)
+
+
+def main():
+    input_path, output_path, object_name, cache_directory, cache_size = sys.argv[sys.argv.index("--") + 1:]
+
+    print_stage("load")
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(addon_dir))
+    package = os.path.basename(addon_dir)
+    if addon_utils.enable(package, default_set=True) is None:
+        raise RuntimeError("Can not enable %s" % package)
+    preferences = bpy.context.preferences.addons[package].preferences
+    preferences.bake_cache_directory = cache_directory
+    preferences.bake_cache_size = int(cache_size)
+    bake = importlib.import_module(package + ".bake")
+
+    with bpy.data.libraries.load(input_path) as (data_from, data_to):
+        data_to.objects = [object_name]
+    obj = data_to.objects[0]
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    obj.select_set(True)
+
+    report = bake.bake_sketch(obj, print_stage)
+
+    print_stage("save")
+    np.savez(output_path, **bake.read_baked_mesh(obj.data))
+    print(REPORT_PREFIX + report, flush=True)
+
+
+if __name__ == "__main__":
+    main()
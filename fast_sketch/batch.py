@@ -0,0 +1,148 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import bpy
+
+# bake every sketch of a directory of .blend and .npz sketch files from the command line, one background Blender per
+# file
+#     blender --background --python batch.py -- <input directory> <output directory> [--format blend|obj|ply]
+#         [--jobs N]
+# it must not use relative imports, the add-on is enabled from the directory of this file
+
+RESULT_PREFIX = "FAST_SKETCH_RESULT "
+FORMATS = ("blend", "obj", "ply")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="blender --background --python batch.py --",
+                                     description="Bake Fast Sketch sketches into meshes")
+    parser.add_argument("input", help="directory of .blend files with sketches and .npz sketch files")
+    parser.add_argument("output", help="directory the meshes are written to")
+    parser.add_argument("--format", choices=FORMATS, default="blend", help="output file format")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="files baked at the same time")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--sketch", default="", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def enable_addon():
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(addon_dir))
+    package = os.path.basename(addon_dir)
+    import addon_utils
+    if addon_utils.enable(package, default_set=True) is None:
+        raise RuntimeError("Can not enable %s" % package)
+    return package
+
+
+def export_objects(objects, path, file_format):
+    for obj in bpy.context.view_layer.objects:
+        obj.select_set(obj in objects)
+    if file_format == "blend":
+        # only the baked objects and the data they use, kept by fake users since no scene links them
+        bpy.data.libraries.write(path, set(objects), fake_user=True)
+    elif file_format == "obj":
+        bpy.ops.wm.obj_export(filepath=path, export_selected_objects=True)
+    else:
+        bpy.ops.wm.ply_export(filepath=path, export_selected_objects=True)
+
+
+def run_worker(args):
+    # runs in the background Blender that opened the .blend file, or the startup file for a sketch file
+    path = args.sketch or bpy.data.filepath
+    result = {"file": path, "objects": [], "error": None}
+    start_time = time.perf_counter()
+    try:
+        package = enable_addon()
+        misc = importlib.import_module(package + ".misc")
+        bake = importlib.import_module(package + ".bake")
+        if args.sketch:
+            sketch_file = importlib.import_module(package + ".sketch_file")
+            sketch_file.create_sketch_object(bpy.context, os.path.splitext(os.path.basename(path))[0],
+                                             sketch_file.read_sketch_file(path))
+        misc.migrate_all_sketches()
+        view_layer = bpy.context.view_layer
+        baked = []
+        for obj in [obj for obj in view_layer.objects if obj.fast_sketch_properties.is_fast_sketch]:
+            object_start_time = time.perf_counter()
+            entry = {"name": obj.name, "report": None, "error": None}
+            result["objects"].append(entry)
+            try:
+                view_layer.objects.active = obj
+                entry["report"] = bake.bake_sketch(obj)
+                baked.append(obj)
+            except Exception:
+                entry["error"] = traceback.format_exc()
+            entry["time"] = time.perf_counter() - object_start_time
+        if baked:
+            name = os.path.splitext(os.path.basename(path))[0]
+            export_objects(baked, os.path.join(args.output, "%s.%s" % (name, args.format)), args.format)
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["time"] = time.perf_counter() - start_time
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def bake_file(path, args):
+    start_time = time.perf_counter()
+    if path.endswith(".npz"):
+        # sketch files are read into the startup file
+        blend_args, worker_args = [], ["--sketch", path]
+    else:
+        blend_args, worker_args = [path], []
+    process = subprocess.run(
+        [bpy.app.binary_path, "--background", "--factory-startup", *blend_args, "--python-exit-code", "1",
+         "--python", os.path.abspath(__file__), "--", args.input, args.output, "--format", args.format, "--worker",
+         *worker_args],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    # the process ended before it could report
+    return {"file": path, "objects": [], "time": time.perf_counter() - start_time,
+            "error": "exit code %d\n%s" % (process.returncode, "\n".join(process.stdout.splitlines()[-20:]))}
+
+
+def run_batch(args):
+    args.input = os.path.abspath(args.input)
+    args.output = os.path.abspath(args.output)
+    paths = sorted(os.path.join(args.input, name) for name in os.listdir(args.input)
+                   if name.endswith((".blend", ".npz")))
+    os.makedirs(args.output, exist_ok=True)
+    start_time = time.perf_counter()
+    failed = 0
+    # each file is baked by its own Blender process, the threads only wait for them
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        for result in executor.map(lambda path: bake_file(path, args), paths):
+            errors = [entry for entry in result["objects"] if entry["error"]]
+            status = "FAILED" if result["error"] or errors else "ok"
+            failed += status != "ok"
+            print("%-6s %6.2fs %s" % (status, result["time"], result["file"]), flush=True)
+            for entry in result["objects"]:
+                print("         %6.2fs %s: %s" % (entry["time"], entry["name"], entry["report"] or "failed"))
+                if entry["error"]:
+                    print(entry["error"])
+            if result["error"]:
+                print(result["error"])
+    print("%d files, %d failed, %.2fs" % (len(paths), failed, time.perf_counter() - start_time), flush=True)
+    return failed
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parse_args(argv)
+    if args.worker:
+        run_worker(args)
+    elif run_batch(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
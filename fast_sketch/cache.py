@@ -0,0 +1,120 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# bumped when bakes of the same sketch and settings would give a different mesh
+BAKE_CACHE_VERSION = 1
+
+
+def hash_bake_key(*parts):
+    # parts are numpy arrays or values with a stable repr
+    digest = hashlib.sha256(b"%d" % BAKE_CACHE_VERSION)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str(part.dtype).encode())
+            digest.update(str(part.shape).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+# bake results on disk as one .npz file of arrays per key, the least recently used files are removed first
+class BakeCache:
+    def __init__(self, max_bytes, directory=""):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def get_directory(self):
+        return self.directory or os.path.join(tempfile.gettempdir(), "fast_sketch_bake_cache")
+
+    def _get_path(self, key):
+        return os.path.join(self.get_directory(), key + ".npz")
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, arrays):
+        if self.max_bytes <= 0:
+            return
+        directory = self.get_directory()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # written under another name first, so readers never see a partial file
+            # the suffix keeps the partial file out of the size count and eviction
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, **arrays)
+            os.replace(temp_path, self._get_path(key))
+        except OSError:
+            return
+        finally:
+            # left behind only when the write failed
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        self._evict()
+
+    def set_options(self, max_bytes, directory):
+        self.max_bytes = max_bytes
+        self.directory = directory
+
+    def get_size(self):
+        return sum(entry[1] for entry in self._stat())
+
+    def clear(self):
+        for entry in self._scan():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def _scan(self):
+        try:
+            return [entry for entry in os.scandir(self.get_directory())
+                    if entry.is_file() and entry.name.endswith(".npz")]
+        except OSError:
+            return []
+
+    def _stat(self):
+        # files removed by another Blender sharing the directory are skipped
+        stats = []
+        for entry in self._scan():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size, entry.path))
+        return stats
+
+    def _evict(self):
+        entries = sorted(self._stat())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
@@ -1,9 +1,157 @@
 import math
 
 import bpy
+import gpu
 import mathutils
+import numpy as np
+from gpu_extras.batch import batch_for_shader
 
 from .misc import get_mouse_pointing_node
+from .runtime import get_sketch_arrays, read_selection_flags, get_sketch_version, get_selection_version
+
+CIRCLE_SEGMENTS = 32
+# circles smaller than this on screen are not drawn
+CIRCLE_MIN_PIXELS = 1.0
+# circle data is stored in a texture, two texels per circle
+CIRCLES_PER_ROW = 1024
+
+_circle_shader = None
+_circle_template = None
+_line_shader = None
+
+
+def _get_circle_shader():
+    # one instance per circle, read from the circle data texture, expanded around its center facing the camera
+    # frustum culling is left to clipping, circles too small on screen are moved behind the far plane
+    global _circle_shader
+    if _circle_shader is None:
+        interface = gpu.types.GPUStageInterfaceInfo("fast_sketch_circle_interface")
+        interface.flat("VEC4", "vertColor")
+        info = gpu.types.GPUShaderCreateInfo()
+        info.push_constant("MAT4", "viewProjectionMatrix")
+        info.push_constant("MAT4", "objectMatrix")
+        info.push_constant("VEC3", "viewRight")
+        info.push_constant("VEC3", "viewUp")
+        info.push_constant("VEC2", "viewportSize")
+        info.push_constant("FLOAT", "radiusScale")
+        info.push_constant("FLOAT", "minPixels")
+        info.sampler(0, "FLOAT_2D", "circleData")
+        info.vertex_in(0, "VEC2", "offset")
+        info.vertex_out(interface)
+        info.fragment_out(0, "VEC4", "fragColor")
+        info.vertex_source(
+            "void main()"
+            "{"
+            "  ivec2 texel = ivec2((gl_InstanceID %% %d) * 2, gl_InstanceID / %d);"
+            "  vec4 sphere = texelFetch(circleData, texel, 0);"
+            "  vertColor = texelFetch(circleData, texel + ivec2(1, 0), 0);"
+            "  vec3 center = (objectMatrix * vec4(sphere.xyz, 1.0)).xyz;"
+            "  float radius = sphere.w * radiusScale;"
+            "  vec4 centerClip = viewProjectionMatrix * vec4(center, 1.0);"
+            "  vec4 edgeClip = viewProjectionMatrix * vec4(center + viewUp * radius, 1.0);"
+            "  float pixels = length(edgeClip.xy / edgeClip.w - centerClip.xy / centerClip.w) * 0.5 * viewportSize.y;"
+            "  if (pixels < minPixels) {"
+            "    gl_Position = vec4(0.0, 0.0, 2.0, 1.0);"
+            "    return;"
+            "  }"
+            "  vec3 pos = center + (viewRight * offset.x + viewUp * offset.y) * radius;"
+            "  gl_Position = viewProjectionMatrix * vec4(pos, 1.0);"
+            "}" % (CIRCLES_PER_ROW, CIRCLES_PER_ROW)
+        )
+        info.fragment_source(
+            "void main()"
+            "{"
+            "  fragColor = vertColor;"
+            "}"
+        )
+        _circle_shader = gpu.shader.create_from_info(info)
+    return _circle_shader
+
+
+def _get_line_shader():
+    global _line_shader
+    if _line_shader is None:
+        interface = gpu.types.GPUStageInterfaceInfo("fast_sketch_line_interface")
+        interface.smooth("VEC4", "vertColor")
+        info = gpu.types.GPUShaderCreateInfo()
+        info.push_constant("MAT4", "viewProjectionMatrix")
+        info.push_constant("MAT4", "objectMatrix")
+        info.vertex_in(0, "VEC3", "pos")
+        info.vertex_in(1, "VEC4", "color")
+        info.vertex_out(interface)
+        info.fragment_out(0, "VEC4", "fragColor")
+        info.vertex_source(
+            "void main()"
+            "{"
+            "  gl_Position = viewProjectionMatrix * objectMatrix * vec4(pos, 1.0);"
+            "  vertColor = color;"
+            "}"
+        )
+        info.fragment_source(
+            "void main()"
+            "{"
+            "  fragColor = vertColor;"
+            "}"
+        )
+        _line_shader = gpu.shader.create_from_info(info)
+    return _line_shader
+
+
+def _get_circle_template():
+    # pairs of points of a unit circle for LINES, shared by all circle instances
+    global _circle_template
+    if _circle_template is None:
+        angles = np.linspace(0, 2 * math.pi, CIRCLE_SEGMENTS + 1, dtype=np.float32)
+        ring = np.stack((np.cos(angles), np.sin(angles)), axis=1)
+        offsets = np.stack((ring[:-1], ring[1:]), axis=1).reshape(-1, 2)
+        _circle_template = batch_for_shader(_get_circle_shader(), "LINES", {"offset": offsets})
+    return _circle_template
+
+
+# circles of one instanced draw call, centers and radii are in the space of the matrix given when drawing
+class CircleBatch:
+    def __init__(self, centers, radii, colors):
+        self.count = len(centers)
+        rows = max(-(-self.count // CIRCLES_PER_ROW), 1)
+        data = np.zeros((rows * CIRCLES_PER_ROW, 2, 4), dtype=np.float32)
+        data[:self.count, 0, :3] = centers
+        data[:self.count, 0, 3] = radii
+        data[:self.count, 1] = colors
+        buffer = gpu.types.Buffer("FLOAT", data.size, data.ravel())
+        self.texture = gpu.types.GPUTexture((CIRCLES_PER_ROW * 2, rows), format="RGBA32F", data=buffer)
+
+    def draw(self, context, matrix, radius_scale):
+        if not self.count:
+            return
+        r3d = context.space_data.region_3d
+        view_mat_inv = r3d.view_matrix.inverted()
+        shader = _get_circle_shader()
+        shader.bind()
+        shader.uniform_float("viewProjectionMatrix", r3d.perspective_matrix)
+        shader.uniform_float("objectMatrix", matrix)
+        shader.uniform_float("viewRight", view_mat_inv.col[0].xyz.normalized())
+        shader.uniform_float("viewUp", view_mat_inv.col[1].xyz.normalized())
+        shader.uniform_float("viewportSize", (context.region.width, context.region.height))
+        shader.uniform_float("radiusScale", radius_scale)
+        shader.uniform_float("minPixels", CIRCLE_MIN_PIXELS)
+        shader.uniform_sampler("circleData", self.texture)
+        _get_circle_template().draw_instanced(shader, instance_count=self.count)
+
+
+def _make_line_batch(points, colors):
+    if not len(points):
+        return None
+    return batch_for_shader(_get_line_shader(), "LINES", {"pos": points, "color": colors})
+
+
+def _draw_lines(context, batch, matrix):
+    if batch is None:
+        return
+    shader = _get_line_shader()
+    shader.bind()
+    shader.uniform_float("viewProjectionMatrix", context.space_data.region_3d.perspective_matrix)
+    shader.uniform_float("objectMatrix", matrix)
+    batch.draw(shader)
 
 
 class FastSketchGizmo(bpy.types.Gizmo):
@@ -12,61 +160,35 @@ class FastSketchGizmo(bpy.types.Gizmo):
 
     _select_tube_index = -1
     _select_node_index = -1
-    _circle_shape = None
-    _line_shape = None
-
-    def _make_circle_verts(self, radius, segments):
-        circle_verts = []
-        theta = 2 * math.pi / segments
-        cos = math.cos(theta)
-        sin = math.sin(theta)
-        cx = radius
-        cy = 0
-        for i in range(segments + 1):
-            circle_verts.append((cx, cy, 0))
-            tmp = cx
-            cx = cos * cx - sin * cy
-            cy = sin * tmp + cos * cy
-        return circle_verts
-
-    def _draw_circle(self, context, location, radius):
-        view_mat = context.space_data.region_3d.view_matrix
-        view_vec = mathutils.Vector((-view_mat[2][0], -view_mat[2][1], -view_mat[2][2]))
-        rot_mat = view_vec.to_track_quat('-Z', 'Y').to_matrix().to_4x4()
-        mat = mathutils.Matrix.Translation(location) @ \
-              rot_mat @ \
-              mathutils.Matrix.Scale(radius, 4)
-        self.draw_custom_shape(self._circle_shape, matrix=mat)
-
-    def _begin_line(self):
-        self._prev_line_point = None
-
-    def _move_to(self, loc):
-        self._prev_line_point = loc
-
-    def _line_to(self, loc):
-        if self._prev_line_point:
-            v = loc - self._prev_line_point
-            l = v.length
-            if l < 1e-7:
-                return
-            n = v.normalized()
-            a = n.angle((1, 0, 0))
-            ax = -n.cross((1, 0, 0))
-            mat_t = mathutils.Matrix.Translation(self._prev_line_point)
-            mat_r = mathutils.Matrix.Rotation(a, 4, ax)
-            mat_s = mathutils.Matrix.Scale(l, 4)
-            mat = mat_t @ mat_r @ mat_s
-            self.draw_custom_shape(self._line_shape, matrix=mat)
-        self._prev_line_point = loc
-
-    def setup(self):
-        if not hasattr(self, "circle_shape"):
-            self._circle_shape = self.new_custom_shape("LINE_STRIP", self._make_circle_verts(1, 32))
-        if not hasattr(self, "line_shape"):
-            self._line_shape = self.new_custom_shape("LINE_STRIP", ((0, 0, 0), (1, 0, 0)))
+    _circle_batch = None
+    _circle_batch_key = None
+    _line_batch = None
+    _line_batch_key = None
+    _hover_key = None
+
+    def _get_hover_key(self, context, location):
+        obj = context.object
+        if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
+            return None
+        region = context.region
+        r3d = context.space_data.region_3d
+        return (tuple(location),
+                obj.session_uid,
+                get_sketch_version(obj),
+                get_selection_version(obj),
+                obj.fast_sketch_properties.active_index,
+                r3d.perspective_matrix.copy(),
+                obj.matrix_world.copy(),
+                region.width,
+                region.height)
 
     def test_select(self, context, location):
+        # gizmos are created per region, so the cached result is per region as well
+        hover_key = self._get_hover_key(context, location)
+        if hover_key is not None and hover_key == self._hover_key:
+            return -1
+        self._hover_key = hover_key
+
         old_tube_index = self._select_tube_index
         old_node_index = self._select_node_index
         self._select_tube_index, self._select_node_index = get_mouse_pointing_node(context, location)
@@ -78,6 +200,55 @@ class FastSketchGizmo(bpy.types.Gizmo):
         # don't use blender's default gizmo highlighting here so always return -1
         return -1
 
+    def _get_circle_batch(self, obj, arrays, is_inserting):
+        # batches only depend on the sketch, the view and object transform are shader uniforms
+        active_index = obj.fast_sketch_properties.active_index
+        key = (arrays, get_selection_version(obj), active_index,
+               self._select_tube_index, self._select_node_index, is_inserting)
+        if self._circle_batch_key == key:
+            return self._circle_batch
+
+        active_flags = read_selection_flags(obj)
+
+        mask = np.ones(len(arrays), dtype=bool)
+        if active_index >= 0:
+            mask &= arrays.tube_indices == active_index
+
+        colors = np.ones((len(arrays), 4), dtype=np.float32)
+        colors[arrays.node_indices == 0, :3] = (.75, .75, 1)
+        if self._select_node_index >= 0 and not is_inserting:
+            hovered = (arrays.tube_indices == self._select_tube_index) \
+                & (arrays.node_indices == self._select_node_index)
+            colors[hovered, :3] = (1, 0, 1)
+        colors[active_flags, :3] = (1, 1, 0)
+
+        self._circle_batch = CircleBatch(arrays.locations[mask], arrays.radii[mask], colors[mask])
+        self._circle_batch_key = key
+        return self._circle_batch
+
+    def _get_line_batch(self, obj, arrays, insert_key):
+        active_index = obj.fast_sketch_properties.active_index
+        key = (arrays, active_index, insert_key)
+        if self._line_batch_key == key:
+            return self._line_batch
+
+        is_inserting, is_branch, insert_tube_index, insert_node_index = insert_key
+        ends = np.flatnonzero(arrays.node_indices != 0)
+        starts = ends - 1
+        mask = np.ones(len(ends), dtype=bool)
+        if active_index >= 0:
+            mask &= arrays.tube_indices[ends] == active_index
+        if is_inserting and not is_branch:
+            # the segment after the inserting position is drawn through the new node instead
+            mask &= ~((arrays.tube_indices[starts] == insert_tube_index)
+                      & (arrays.node_indices[starts] == insert_node_index))
+
+        points = np.stack((arrays.locations[starts[mask]], arrays.locations[ends[mask]]), axis=1).reshape(-1, 3)
+        colors = np.tile(np.array((1, 1, 1, .5), dtype=np.float32), (len(points), 1))
+        self._line_batch = _make_line_batch(points, colors)
+        self._line_batch_key = key
+        return self._line_batch
+
     def draw(self, context):
         is_inserting = context.window_manager.fast_sketch.is_inserting
         insert_tube_index = context.window_manager.fast_sketch.insert_tube_index
@@ -86,58 +257,50 @@ class FastSketchGizmo(bpy.types.Gizmo):
         insert_radius = context.window_manager.fast_sketch.insert_radius
         is_branch = context.window_manager.fast_sketch.is_branch
 
+        gpu.state.blend_set("ALPHA")
+
+        # inserting node and the lines linking it
+        insert_centers = []
+        insert_line_points = []
         if is_inserting and insert_node_index == -1:
-            self.alpha = 1
-            self.color = (1, 0, 1)
-            self._draw_circle(context, insert_loc, insert_radius)
-
-        if context.object is not None and context.object.fast_sketch_properties.is_fast_sketch:
-            active_index = context.object.fast_sketch_properties.active_index
-            tubes = context.object.fast_sketch_properties.tubes
-
-            for tube_index, tube in enumerate(tubes):
-                if 0 <= active_index != tube_index:
-                    continue
-
-                obj_mat = context.object.matrix_world
-                obj_scale = obj_mat.to_scale()
-                scale = min(obj_scale.x, obj_scale.y, obj_scale.z)
-                self._begin_line()
-                for node_index, node in enumerate(tube.nodes):
-                    loc = obj_mat @ node.location
-
-                    # draw circle
-                    self.alpha = 1
-                    self.color = (1, 1, 1)
-                    if node_index == 0:
-                        self.color = (.75, .75, 1)
-                    if tube_index == self._select_tube_index \
-                            and node_index == self._select_node_index \
-                            and not is_inserting:
-                        self.color = (1, 0, 1)
-                    if node.active and (tube_index == active_index or active_index < 0):
-                        self.color = (1, 1, 0)
-                    self._draw_circle(context, loc, scale * node.radius)
-
-                    # draw line
-                    self.alpha = 0.5
-                    self.color = (1, 1, 1)
-                    self._line_to(loc)
-
-                    # insert
-                    if is_inserting \
-                            and insert_tube_index == tube_index \
-                            and insert_node_index == node_index:
-                        self.alpha = 1
-                        self.color = (1, 0, 1)
-                        self._draw_circle(context, insert_loc, insert_radius)
-
-                        self.alpha = 0.5
-                        self.color = (1, 1, 1)
-                        self._line_to(insert_loc)
-
-                        if is_branch:
-                            self._move_to(loc)
+            insert_centers.append(insert_loc)
+
+        obj = context.object
+        if obj is not None and obj.fast_sketch_properties.is_fast_sketch:
+            arrays = get_sketch_arrays(obj)
+            insert_key = (is_inserting, is_branch, insert_tube_index, insert_node_index)
+            obj_mat = obj.matrix_world
+            obj_scale = obj_mat.to_scale()
+
+            _draw_lines(context, self._get_line_batch(obj, arrays, insert_key), obj_mat)
+            self._get_circle_batch(obj, arrays, is_inserting).draw(context, obj_mat,
+                                                                   min(obj_scale.x, obj_scale.y, obj_scale.z))
+
+            active_index = obj.fast_sketch_properties.active_index
+            tube_count = len(arrays.tube_offsets) - 1
+            if is_inserting and 0 <= insert_tube_index < tube_count and not 0 <= active_index != insert_tube_index:
+                start = arrays.tube_offsets[insert_tube_index]
+                end = arrays.tube_offsets[insert_tube_index + 1]
+                if 0 <= insert_node_index < end - start:
+                    loc = obj_mat @ mathutils.Vector(arrays.locations[start + insert_node_index])
+                    insert_centers.append(insert_loc)
+                    insert_line_points += (loc, insert_loc)
+                    if not is_branch and start + insert_node_index + 1 < end:
+                        next_loc = obj_mat @ mathutils.Vector(arrays.locations[start + insert_node_index + 1])
+                        insert_line_points += (insert_loc, next_loc)
+
+        # the inserting node is in world space
+        identity = mathutils.Matrix.Identity(4)
+        _draw_lines(context, _make_line_batch(
+            np.array(insert_line_points, dtype=np.float32).reshape(-1, 3),
+            np.tile(np.array((1, 1, 1, .5), dtype=np.float32), (len(insert_line_points), 1))), identity)
+        if insert_centers:
+            CircleBatch(np.array(insert_centers, dtype=np.float32).reshape(-1, 3),
+                        np.full(len(insert_centers), insert_radius, dtype=np.float32),
+                        np.tile(np.array((1, 0, 1, 1), dtype=np.float32), (len(insert_centers), 1))) \
+                .draw(context, identity, 1.0)
+
+        gpu.state.blend_set("NONE")
 
 
 class FastSketchGizmoGroup(bpy.types.GizmoGroup):
@@ -149,8 +312,8 @@ class FastSketchGizmoGroup(bpy.types.GizmoGroup):
 
     @classmethod
     def poll(cls, context):
-        return context.workspace.tools \
-            .from_space_view3d_mode(context.mode, create=False).idname == "fast_sketch.fast_sketch_tool"
+        tool = context.workspace.tools.from_space_view3d_mode(context.mode, create=False)
+        return tool is not None and tool.idname == "fast_sketch.fast_sketch_tool"
 
     def setup(self, context):
         self.gizmo = self.gizmos.new(FastSketchGizmo.bl_idname)
@@ -0,0 +1,435 @@
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+# sketch meshes are built only from numpy arrays here, without bpy, so they can be generated anywhere
+
+# capsule cache keys are positions and radii rounded to this step
+CACHE_QUANTIZE_STEP = 1e-5
+
+
+def adaptive_segments(radii, detail_size, min_segments, max_segments):
+    # a ring has segments * 2 faces, so this keeps faces about detail_size wide
+    segments = np.ceil(math.pi * np.asarray(radii, dtype=np.float64) / detail_size)
+    return np.clip(segments, min_segments, max_segments).astype(np.int32)
+
+
+def lathe_faces(ring_count, around):
+    # vertices of a surface of revolution are stored ring by ring, followed by the bottom and top poles
+    ring = np.arange(ring_count * around, dtype=np.int32).reshape(ring_count, around)
+    next_ring = np.roll(ring, -1, axis=1)
+    quads = np.stack((ring[:-1], next_ring[:-1], next_ring[1:], ring[1:]), axis=-1).reshape(-1, 4)
+    bottom = np.full(around, ring_count * around, dtype=np.int32)
+    top = bottom + 1
+    tris = np.concatenate((
+        np.stack((bottom, next_ring[0], ring[0]), axis=-1),
+        np.stack((top, ring[-1], next_ring[-1]), axis=-1),
+    ))
+    return tris, quads
+
+
+def lathe_verts(centers, radii, thetas, axis, e1, e2, around):
+    # centers, radii and thetas are per ring (count, rings), axis and basis vectors are per surface (count, 3)
+    phi = np.linspace(0, 2 * math.pi, around, endpoint=False)
+    axial = (radii * np.cos(thetas))[:, :, np.newaxis, np.newaxis]
+    radial = (radii * np.sin(thetas))[:, :, np.newaxis, np.newaxis]
+    ring_dir = np.cos(phi)[:, np.newaxis] * e1[:, np.newaxis, :] + np.sin(phi)[:, np.newaxis] * e2[:, np.newaxis, :]
+    rings = centers[:, :, np.newaxis, :] + axial * axis[:, np.newaxis, np.newaxis, :] \
+        + radial * ring_dir[:, np.newaxis, :, :]
+    count, ring_count = thetas.shape
+    return rings.reshape(count, ring_count * around, 3)
+
+
+def perpendicular_basis(axis):
+    helper = np.zeros_like(axis)
+    use_y = np.abs(axis[:, 0]) > 0.9
+    helper[~use_y, 0] = 1
+    helper[use_y, 1] = 1
+    e1 = np.cross(axis, helper)
+    e1 /= np.linalg.norm(e1, axis=1)[:, np.newaxis]
+    e2 = np.cross(axis, e1)
+    return e1, e2
+
+
+def merge_surfaces(verts, tris, quads):
+    # verts (count, n, 3) of surfaces sharing the same faces
+    count, vert_count = verts.shape[:2]
+    offsets = (np.arange(count, dtype=np.int32) * vert_count)[:, np.newaxis, np.newaxis]
+    return verts.reshape(-1, 3), (tris[np.newaxis] + offsets).reshape(-1, 3), \
+        (quads[np.newaxis] + offsets).reshape(-1, 4)
+
+
+def build_spheres(locations, radii, segments):
+    # UV spheres with segments * 2 around and segments rings, the same as the Geometry Node method
+    around = max(segments * 2, 3)
+    rings = max(segments, 2)
+    count = len(locations)
+    thetas = np.tile(np.linspace(math.pi, 0, rings + 1)[1:-1], (count, 1))
+    axis = np.tile(np.array((0, 0, 1), dtype=np.float64), (count, 1))
+    e1 = np.tile(np.array((1, 0, 0), dtype=np.float64), (count, 1))
+    e2 = np.tile(np.array((0, 1, 0), dtype=np.float64), (count, 1))
+    centers = np.repeat(locations[:, np.newaxis, :], thetas.shape[1], axis=1)
+    ring_radii = np.repeat(radii[:, np.newaxis], thetas.shape[1], axis=1)
+    verts = np.concatenate((
+        lathe_verts(centers, ring_radii, thetas, axis, e1, e2, around),
+        (locations - axis * radii[:, np.newaxis])[:, np.newaxis],
+        (locations + axis * radii[:, np.newaxis])[:, np.newaxis],
+    ), axis=1)
+    tris, quads = lathe_faces(thetas.shape[1], around)
+    return merge_surfaces(verts, tris, quads)
+
+
+def capsule_surfaces(start_locations, start_radii, end_locations, end_radii, segments):
+    # each capsule is the cone tangent to the two spheres, closed by the parts of the spheres outside the cone
+    around = max(segments * 2, 3)
+    rings = max(segments, 2)
+    count = len(start_locations)
+    axis = end_locations - start_locations
+    length = np.linalg.norm(axis, axis=1)
+    degenerate = length < 1e-7
+    axis[degenerate] = (0, 0, 1)
+    length[degenerate] = 1
+    axis /= length[:, np.newaxis]
+    e1, e2 = perpendicular_basis(axis)
+
+    # angle from the axis where the cone touches both spheres
+    theta_t = np.arccos(np.clip((start_radii - end_radii) / length, -1, 1))[:, np.newaxis]
+    t = np.linspace(0, 1, rings + 1)
+    thetas = np.concatenate((
+        math.pi + (theta_t - math.pi) * t[1:],
+        theta_t * (1 - t[:-1]),
+    ), axis=1)
+    centers = np.concatenate((
+        np.repeat(start_locations[:, np.newaxis, :], rings, axis=1),
+        np.repeat(end_locations[:, np.newaxis, :], rings, axis=1),
+    ), axis=1)
+    ring_radii = np.concatenate((
+        np.repeat(start_radii[:, np.newaxis], rings, axis=1),
+        np.repeat(end_radii[:, np.newaxis], rings, axis=1),
+    ), axis=1)
+    verts = np.concatenate((
+        lathe_verts(centers, ring_radii, thetas, axis, e1, e2, around),
+        (start_locations - axis * start_radii[:, np.newaxis])[:, np.newaxis],
+        (end_locations + axis * end_radii[:, np.newaxis])[:, np.newaxis],
+    ), axis=1)
+    tris, quads = lathe_faces(thetas.shape[1], around)
+    return verts.reshape(count, -1, 3), tris, quads
+
+
+def build_capsules(start_locations, start_radii, end_locations, end_radii, segments):
+    return merge_surfaces(*capsule_surfaces(start_locations, start_radii, end_locations, end_radii, segments))
+
+
+# least recently used capsule vertices, limited by the memory they take
+class SegmentCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        verts = self._entries.get(key)
+        if verts is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return verts
+
+    def put(self, key, verts):
+        old_verts = self._entries.pop(key, None)
+        if old_verts is not None:
+            self.size -= old_verts.nbytes + len(key)
+        self._entries[key] = verts
+        self.size += verts.nbytes + len(key)
+        self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self._entries and self.size > self.max_bytes:
+            key, verts = self._entries.popitem(last=False)
+            self.size -= verts.nbytes + len(key)
+
+
+def capsule_keys(start_locations, start_radii, end_locations, end_radii, segments):
+    values = np.concatenate((start_locations, start_radii[:, np.newaxis],
+                             end_locations, end_radii[:, np.newaxis]), axis=1)
+    quantized = np.round(values / CACHE_QUANTIZE_STEP).astype(np.int64)
+    suffix = np.int64(segments).tobytes()
+    return [row.tobytes() + suffix for row in quantized]
+
+
+def build_capsules_cached(start_locations, start_radii, end_locations, end_radii, segments, cache):
+    # only the capsules that are not in the cache are generated, in one batch
+    keys = capsule_keys(start_locations, start_radii, end_locations, end_radii, segments)
+    surfaces = [cache.get(key) for key in keys]
+    missing = np.array([i for i, verts in enumerate(surfaces) if verts is None], dtype=np.int64)
+    if len(missing):
+        verts, tris, quads = capsule_surfaces(start_locations[missing], start_radii[missing],
+                                              end_locations[missing], end_radii[missing], segments)
+        for i, capsule_verts in zip(missing, verts):
+            # copy so the cache entry does not keep the whole batch alive
+            surfaces[i] = capsule_verts.copy()
+            cache.put(keys[i], surfaces[i])
+    else:
+        tris, quads = lathe_faces(max(segments, 2) * 2, max(segments * 2, 3))
+    return merge_surfaces(np.stack(surfaces), tris, quads)
+
+
+def join_meshes(meshes):
+    verts = []
+    tris = []
+    quads = []
+    offset = 0
+    for mesh_verts, mesh_tris, mesh_quads in meshes:
+        verts.append(mesh_verts)
+        tris.append(mesh_tris + offset)
+        quads.append(mesh_quads + offset)
+        offset += len(mesh_verts)
+    if not verts:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int32), np.empty((0, 4), dtype=np.int32)
+    return np.concatenate(verts), np.concatenate(tris), np.concatenate(quads)
+
+
+def build_sketch_mesh(locations, radii, edges, segments, cache=None):
+    # a capsule per edge, and a sphere per vertex that is not part of any edge
+    # segments is either shared or per vertex, a capsule uses the finer resolution of its two balls
+    locations = np.asarray(locations, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+    vert_segments = np.broadcast_to(np.asarray(segments, dtype=np.int32), len(locations))
+    isolated = np.ones(len(locations), dtype=bool)
+    isolated[edges.ravel()] = False
+    meshes = []
+    if len(edges):
+        edge_segments = np.maximum(vert_segments[edges[:, 0]], vert_segments[edges[:, 1]])
+        for value in np.unique(edge_segments):
+            group = edges[edge_segments == value]
+            capsule_args = (locations[group[:, 0]], radii[group[:, 0]], locations[group[:, 1]], radii[group[:, 1]],
+                            int(value))
+            if cache is None:
+                meshes.append(build_capsules(*capsule_args))
+            else:
+                meshes.append(build_capsules_cached(*capsule_args, cache))
+    for value in np.unique(vert_segments[isolated]):
+        group = isolated & (vert_segments == value)
+        meshes.append(build_spheres(locations[group], radii[group], int(value)))
+    return join_meshes(meshes)
+
+
+# voxel meshing, the sketch is a signed distance field of capsules sampled on a grid
+
+# voxels of the largest grid, the voxel size grows to stay below it
+MAX_VOXELS = 256 ** 3
+# voxels along each side of the blocks the field is evaluated in
+VOXEL_BLOCK_SIZE = 16
+
+# corners of a cell and the corner pairs of its edges
+CELL_CORNERS = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.int64)
+CELL_EDGES = np.array([[a, b] for a in range(8) for b in range(a + 1, 8)
+                       if np.abs(CELL_CORNERS[a] - CELL_CORNERS[b]).sum() == 1], dtype=np.int64)
+
+
+def capsule_distances(points, starts, start_radii, ends, end_radii):
+    # distances from points to cones with rounded ends, an approximation for balls of different radii
+    axes = ends - starts
+    lengths_squared = np.maximum(np.einsum("ij,ij->i", axes, axes), 1e-12)
+    offsets = points[:, np.newaxis, :] - starts[np.newaxis, :, :]
+    t = np.clip(np.einsum("pcj,cj->pc", offsets, axes) / lengths_squared, 0, 1)
+    closest = offsets - t[:, :, np.newaxis] * axes[np.newaxis, :, :]
+    return np.sqrt(np.einsum("pcj,pcj->pc", closest, closest)) - (start_radii + t * (end_radii - start_radii))
+
+
+def smooth_min(a, b, blend):
+    # polynomial smooth minimum, equal to the minimum when a and b are at least blend apart
+    if blend <= 0:
+        return np.minimum(a, b)
+    h = np.maximum(blend - np.abs(a - b), 0) / blend
+    return np.minimum(a, b) - h * h * blend * 0.25
+
+
+def smooth_union(distances, blend):
+    # only the three closest capsules of each point take part in the blend
+    if distances.shape[1] > 3:
+        distances = np.partition(distances, 2, axis=1)[:, :3]
+    distances = np.sort(distances, axis=1)
+    field = distances[:, -1]
+    for column in range(distances.shape[1] - 2, -1, -1):
+        field = smooth_min(distances[:, column], field, blend)
+    return field
+
+
+def get_voxel_capsules(locations, radii, edges):
+    # a capsule per edge, and a ball per vertex that is not part of any edge
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    isolated = np.ones(len(locations), dtype=bool)
+    isolated[edges.ravel()] = False
+    first = np.concatenate((edges[:, 0], np.flatnonzero(isolated)))
+    second = np.concatenate((edges[:, 1], np.flatnonzero(isolated)))
+    return locations[first], radii[first], locations[second], radii[second]
+
+
+def get_voxel_size(radii, voxel_size):
+    # zero picks half of the smallest radius
+    if voxel_size > 0:
+        return voxel_size
+    radii = radii[radii > 0]
+    return float(radii.min()) * 0.5 if len(radii) else 0.1
+
+
+def evaluate_voxel_field(locations, radii, edges, voxel_size, blend=0.0, mirror_axis=(False,) * 3,
+                         bisect_axis=(False,) * 3):
+    # returns the field, the position of its first voxel and the voxel size
+    locations = np.asarray(locations, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)
+    return evaluate_capsule_field(*get_voxel_capsules(locations, radii, edges), get_voxel_size(radii, voxel_size),
+                                  blend, mirror_axis, bisect_axis)
+
+
+def evaluate_capsule_field(starts, start_radii, ends, end_radii, voxel_size, blend=0.0, mirror_axis=(False,) * 3,
+                           bisect_axis=(False,) * 3):
+    # mirrored copies are unions of the sketch seen through each mirror, cut at the mirror planes on bisected axes
+    # voxels lie on a lattice through the origin, so fields of separate parts of a sketch line up
+    capsule_mins = np.minimum(starts - start_radii[:, np.newaxis], ends - end_radii[:, np.newaxis])
+    capsule_maxs = np.maximum(starts + start_radii[:, np.newaxis], ends + end_radii[:, np.newaxis])
+    mirrors = [np.array(signs, dtype=np.float64)
+               for signs in np.array(np.meshgrid(*[(1, -1) if axis else (1,) for axis in mirror_axis],
+                                                 indexing="ij")).reshape(3, -1).T]
+    bisect = [i for i in range(3) if mirror_axis[i] and bisect_axis[i]]
+
+    # values outside the evaluated blocks, far enough from the surface not to change it
+    margin = blend + voxel_size * 2
+    if not len(starts):
+        return np.full((2, 2, 2), margin, dtype=np.float32), np.zeros(3), voxel_size
+    bound_min = capsule_mins.min(axis=0)
+    bound_max = capsule_maxs.max(axis=0)
+    for signs in mirrors:
+        bound_min, bound_max = np.minimum(bound_min, np.minimum(bound_min * signs, bound_max * signs)), \
+            np.maximum(bound_max, np.maximum(bound_min * signs, bound_max * signs))
+    bound_min -= margin
+    bound_max += margin
+    while True:
+        shape = np.ceil((bound_max - bound_min) / voxel_size).astype(np.int64) + 1
+        if np.prod(shape) <= MAX_VOXELS:
+            break
+        voxel_size *= 1.25
+        margin = blend + voxel_size * 2
+    origin = np.floor(bound_min / voxel_size) * voxel_size
+    shape = np.ceil((bound_max - origin) / voxel_size).astype(np.int64) + 1
+
+    field = np.full(shape, margin, dtype=np.float32)
+    for bx in range(0, shape[0], VOXEL_BLOCK_SIZE):
+        for by in range(0, shape[1], VOXEL_BLOCK_SIZE):
+            for bz in range(0, shape[2], VOXEL_BLOCK_SIZE):
+                block_start = np.array((bx, by, bz))
+                block_end = np.minimum(block_start + VOXEL_BLOCK_SIZE, shape)
+                block_min = origin + block_start * voxel_size - margin
+                block_max = origin + (block_end - 1) * voxel_size + margin
+                grid = np.stack(np.meshgrid(*[np.arange(block_start[i], block_end[i]) for i in range(3)],
+                                            indexing="ij"), axis=-1).reshape(-1, 3)
+                points = origin + grid * voxel_size
+                block_field = None
+                for signs in mirrors:
+                    # the block seen through the mirror
+                    mirrored_min = np.minimum(block_min * signs, block_max * signs)
+                    mirrored_max = np.maximum(block_min * signs, block_max * signs)
+                    candidates = np.flatnonzero(np.all((capsule_mins <= mirrored_max)
+                                                       & (capsule_maxs >= mirrored_min), axis=1))
+                    if not len(candidates):
+                        continue
+                    mirrored_points = points * signs
+                    values = smooth_union(capsule_distances(mirrored_points, starts[candidates],
+                                                            start_radii[candidates], ends[candidates],
+                                                            end_radii[candidates]), blend)
+                    for i in bisect:
+                        values = np.maximum(values, -mirrored_points[:, i])
+                    if block_field is None:
+                        block_field = values
+                    elif bisect:
+                        # halves cut at a plane meet exactly, blending them would bulge the seam
+                        block_field = np.minimum(block_field, values)
+                    else:
+                        block_field = smooth_min(block_field, values, blend)
+                if block_field is not None:
+                    field[bx:block_end[0], by:block_end[1], bz:block_end[2]] = \
+                        np.minimum(block_field, margin).reshape(block_end - block_start)
+    return field, origin, voxel_size
+
+
+def surface_nets(field, origin, voxel_size):
+    # a vertex in each cell the surface passes through, a quad around each grid edge it crosses
+    # the field must be positive on the border of the grid, the mesh is then closed
+    inside = field < 0
+    corner_inside = [inside[x:x + inside.shape[0] - 1, y:y + inside.shape[1] - 1, z:z + inside.shape[2] - 1]
+                     for x, y, z in CELL_CORNERS]
+    any_inside = np.logical_or.reduce(corner_inside)
+    all_inside = np.logical_and.reduce(corner_inside)
+    cells = np.argwhere(any_inside & ~all_inside)
+    if not len(cells):
+        return np.empty((0, 3)), np.empty((0, 4), dtype=np.int32)
+
+    # vertices at the mean of the crossings on the cell edges
+    corners = cells[:, np.newaxis, :] + CELL_CORNERS[np.newaxis, :, :]
+    values = field[corners[:, :, 0], corners[:, :, 1], corners[:, :, 2]].astype(np.float64)
+    a = values[:, CELL_EDGES[:, 0]]
+    b = values[:, CELL_EDGES[:, 1]]
+    crossed = (a < 0) != (b < 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(crossed, a / (a - b), 0)
+    points = CELL_CORNERS[CELL_EDGES[:, 0]][np.newaxis, :, :] \
+        + t[:, :, np.newaxis] * (CELL_CORNERS[CELL_EDGES[:, 1]] - CELL_CORNERS[CELL_EDGES[:, 0]])[np.newaxis, :, :]
+    local = (points * crossed[:, :, np.newaxis]).sum(axis=1) / crossed.sum(axis=1)[:, np.newaxis]
+    verts = origin + (cells + local) * voxel_size
+
+    cell_shape = np.array(field.shape) - 1
+    cell_keys = np.ravel_multi_index(cells.T, cell_shape)
+    quads = []
+    for axis in range(3):
+        u = (axis + 1) % 3
+        v = (axis + 2) % 3
+        step = np.zeros(3, dtype=np.int64)
+        step[axis] = 1
+        end = np.array(field.shape) - step
+        near = inside[:end[0], :end[1], :end[2]]
+        far = inside[step[0]:, step[1]:, step[2]:]
+        grid_points = np.argwhere(near != far)
+        # edges on the border have no cells on one side, they are never crossed on a positive border
+        keep = (grid_points[:, u] >= 1) & (grid_points[:, v] >= 1) \
+            & (grid_points[:, u] < cell_shape[u]) & (grid_points[:, v] < cell_shape[v])
+        grid_points = grid_points[keep]
+        around = []
+        for du, dv in ((-1, -1), (0, -1), (0, 0), (-1, 0)):
+            cell = grid_points.copy()
+            cell[:, u] += du
+            cell[:, v] += dv
+            around.append(np.searchsorted(cell_keys, np.ravel_multi_index(cell.T, cell_shape)))
+        around = np.stack(around, axis=1)
+        # counter-clockwise seen from outside
+        flip = ~inside[grid_points[:, 0], grid_points[:, 1], grid_points[:, 2]]
+        around[flip] = around[flip, ::-1]
+        quads.append(around)
+    return verts, np.concatenate(quads).astype(np.int32)
+
+
+def build_voxel_mesh(locations, radii, edges, voxel_size, blend=0.0, mirror_axis=(False,) * 3,
+                     bisect_axis=(False,) * 3):
+    # returns vertices, quads and the voxel size used
+    field, origin, voxel_size = evaluate_voxel_field(locations, radii, edges, voxel_size, blend, mirror_axis,
+                                                     bisect_axis)
+    verts, quads = surface_nets(field, origin, voxel_size)
+    return verts, quads, voxel_size
@@ -1,74 +1,128 @@
 import re
 
 import bpy
-import mathutils
+import numpy as np
 from bpy_extras.view3d_utils import region_2d_to_location_3d
 from mathutils import Vector
 
+from .runtime import get_picking_grid, get_junction_index, tag_sketch_changed, tag_topology_changed, \
+    get_node_id_map, forget_selection, get_sketch_arrays, read_selection_flags, check_sketch_ids
+from .storage import write_node_data, repair_node_storage
+
+
+def migrate_all_sketches():
+    for obj in bpy.data.objects:
+        if obj.fast_sketch_properties.is_fast_sketch:
+            if repair_node_storage(obj):
+                tag_sketch_changed(obj)
+                tag_topology_changed(obj)
+                forget_selection(obj)
+            check_sketch_ids(obj)
+
+
+@bpy.app.handlers.persistent
+def sketch_ids_migration_handler(*args):
+    migrate_all_sketches()
+
+
+def new_sketch_id(obj):
+    group = obj.fast_sketch_properties
+    check_sketch_ids(obj)
+    sketch_id = group.next_id
+    group.next_id += 1
+    return sketch_id
+
 
 def get_mouse_pointing_node(context, location):
     pointing_tube_index = -1
     pointing_node_index = -1
-    if context.object and context.object.fast_sketch_properties.is_fast_sketch:
-        active_index = context.object.fast_sketch_properties.active_index
-        tubes = context.object.fast_sketch_properties.tubes
-        for tube_index, tube in enumerate(tubes):
+    obj = context.object
+    if obj and obj.fast_sketch_properties.is_fast_sketch:
+        active_index = obj.fast_sketch_properties.active_index
+        arrays = get_sketch_arrays(obj)
+        selected_flags = read_selection_flags(obj)
+        obj_mat = obj.matrix_world
+        obj_scale = obj_mat.to_scale()
+        scale = min(obj_scale.x, obj_scale.y, obj_scale.z)
+        region = context.region
+        r3d = context.space_data.region_3d
+        perspective_matrix = r3d.perspective_matrix
+        active = False
+        min_z = float('inf')
+        current_tube_index = -1
+        # candidates come in tube order, only nodes whose circle covers the mouse cell are tested
+        for tube_index, index in get_picking_grid(context, obj).query(location):
             if 0 <= active_index != tube_index:
                 continue
-            obj_mat = context.object.matrix_world
-            obj_scale = obj_mat.to_scale()
-            scale = min(obj_scale.x, obj_scale.y, obj_scale.z)
-            active = False
-            min_z = float('inf')
-            region = context.region
-            r3d = context.space_data.region_3d
-            perspective_matrix = r3d.perspective_matrix
-            for index, node in enumerate(tube.nodes):
-                node_loc = obj_mat @ node.location
-                mouse_loc = region_2d_to_location_3d(region, r3d, location, node_loc)
-                if (node_loc - mouse_loc).length <= scale * node.radius:
-                    prj = perspective_matrix @ Vector((mouse_loc.x, mouse_loc.y, mouse_loc.z, 1.0))
-                    if (active and node.active or not active) and prj.z < min_z:
-                        min_z = prj.z
-                        pointing_tube_index = tube_index
-                        pointing_node_index = index
-                        if node.active:
-                            active = True
+            if tube_index != current_tube_index:
+                current_tube_index = tube_index
+                active = False
+                min_z = float('inf')
+            i = arrays.get_index(tube_index, index)
+            node_loc = obj_mat @ Vector(arrays.locations[i])
+            mouse_loc = region_2d_to_location_3d(region, r3d, location, node_loc)
+            if (node_loc - mouse_loc).length <= scale * arrays.radii[i]:
+                prj = perspective_matrix @ Vector((mouse_loc.x, mouse_loc.y, mouse_loc.z, 1.0))
+                selected = selected_flags[i]
+                if (active and selected or not active) and prj.z < min_z:
+                    min_z = prj.z
+                    pointing_tube_index = tube_index
+                    pointing_node_index = index
+                    if selected:
+                        active = True
 
     return pointing_tube_index, pointing_node_index
 
 
-def update_branch(target_tube_index, target_node_index):
-    tubes = bpy.context.object.fast_sketch_properties.tubes
-    target_tube = tubes[target_tube_index]
-    target_node = target_tube.nodes[target_node_index]
-    radius = target_node.radius
-    location = target_node.location
-    for tube in tubes:
-        for node in tube.nodes:
-            node.visited = False
-
-    def update(tube_index, node_index):
-        current_tube = tubes[tube_index]
-        current_node = current_tube.nodes[node_index]
-        if current_node.visited:
-            return
-        current_node.visited = True
-        current_node.radius = radius
-        current_node.location = mathutils.Vector(location)
-        if node_index == 0 and current_tube.parent_tube_index >= 0:
-            update(current_tube.parent_tube_index, current_tube.parent_node_index)
-        for (sub_tube_index, sub_tube) in enumerate(tubes):
-            if sub_tube.parent_tube_index == tube_index and sub_tube.parent_node_index == node_index \
-                    and len(sub_tube.nodes):
-                update(sub_tube_index, 0)
-
-    update(target_tube_index, target_node_index)
-
-
-def replace_join_nodes_with_boolean_nodes(merge_meshes):
+def get_selected_nodes(obj):
+    # node array indices of the selected nodes, only in the active tube if there is one
+    arrays = get_sketch_arrays(obj)
+    selected = read_selection_flags(obj)
+    active_index = obj.fast_sketch_properties.active_index
+    if active_index >= 0:
+        selected = selected & (arrays.tube_indices == active_index)
+    return np.flatnonzero(selected)
+
+
+def write_node_arrays(obj, arrays, changed, locations, radii):
+    # write the changed nodes and the other nodes of their junctions, a tube at a time
+    # locations and radii are full copies of the node arrays
+    junction_index = get_junction_index(obj)
+    written = changed.copy()
+    for i in np.flatnonzero(changed):
+        for tube_index, node_index in junction_index.get(int(arrays.tube_indices[i]), int(arrays.node_indices[i])):
+            j = arrays.get_index(tube_index, node_index)
+            if j != i:
+                locations[j] = locations[i]
+                radii[j] = radii[i]
+                written[j] = True
+    tube_indices = np.unique(arrays.tube_indices[written]).tolist()
+    write_node_data(obj, arrays.tube_offsets, "location", locations, tube_indices)
+    write_node_data(obj, arrays.tube_offsets, "radius", radii, tube_indices)
+
+
+def write_node_values(obj, ids, locations, radii):
+    # nodes removed since the values were read are skipped
+    arrays = get_sketch_arrays(obj)
+    node_positions = get_node_id_map(obj).node_positions
+    new_locations = arrays.locations.copy()
+    new_radii = arrays.radii.copy()
+    written = np.zeros(len(arrays), dtype=bool)
+    for k, node_id in enumerate(ids.tolist()):
+        position = node_positions.get(node_id)
+        if position is not None:
+            i = arrays.get_index(*position)
+            new_locations[i] = locations[k]
+            new_radii[i] = radii[k]
+            written[i] = True
+    tube_indices = np.unique(arrays.tube_indices[written]).tolist()
+    write_node_data(obj, arrays.tube_offsets, "location", new_locations, tube_indices)
+    write_node_data(obj, arrays.tube_offsets, "radius", new_radii, tube_indices)
+
+
+def replace_join_nodes_with_boolean_nodes(merge_meshes, modifier_name="Fast Sketch Mesh"):
     obj = bpy.context.object
-    geo_nodes = obj.modifiers.get("Fast Sketch Mesh")
+    geo_nodes = obj.modifiers.get(modifier_name)
     tree = geo_nodes.node_group
     for join_node in tree.nodes:
 
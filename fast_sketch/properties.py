@@ -1,35 +1,67 @@
 import bpy
 
-from .update import update_geometry, update_mirror
+from .bake import bake_cache
+from .runtime import tag_topology_changed
+from .storage import migrate_node_storage
+from .update import request_geometry_update, update_mirror, segment_cache
 
 
 def property_update_callback(self, context):
-    update_geometry()
+    request_geometry_update(changed=False)
     update_mirror()
 
 
+def storage_update_callback(self, context):
+    obj = self.id_data
+    migrate_node_storage(obj)
+    tag_topology_changed(obj)
+    # the geometry is rebuilt from the nodes in their new storage
+    request_geometry_update(obj)
+
+
 class FastSketchNodeProperties(bpy.types.PropertyGroup):
+    id: bpy.props.IntProperty()
     location: bpy.props.FloatVectorProperty(name="Location", subtype="XYZ", unit="LENGTH")
     radius: bpy.props.FloatProperty(name="Radius", unit="LENGTH", min=0)
+    # selection saved with the file, the tool keeps the current selection at runtime
     active: bpy.props.BoolProperty(name="Active")
-    visited: bpy.props.BoolProperty()
 
 
 class FastSketchTubeProperties(bpy.types.PropertyGroup):
     name: bpy.props.StringProperty(name="Name")
     nodes: bpy.props.CollectionProperty(type=FastSketchNodeProperties, name="Nodes")
+    id: bpy.props.IntProperty()
+    # id of the node the tube branches from, 0 for none
+    parent_node_id: bpy.props.IntProperty()
+    # branch relationships of files saved before node ids, only read when migrating
     parent_tube_index: bpy.props.IntProperty(default=-1)
     parent_node_index: bpy.props.IntProperty(default=-1)
 
 
 class FastSketchGroupProperties(bpy.types.PropertyGroup):
     is_fast_sketch: bpy.props.BoolProperty()
+    # next node or tube id, 0 until the sketch has ids
+    next_id: bpy.props.IntProperty()
     active_index: bpy.props.IntProperty(default=-1)
     tubes: bpy.props.CollectionProperty(type=FastSketchTubeProperties, name="Tubes")
+    # nodes are moved to the new storage when it changes
+    storage: bpy.props.EnumProperty(
+        name="Storage",
+        items=[("PROPERTIES", "Properties", "Store nodes in the tubes"),
+               ("MESH", "Mesh", "Store nodes as the vertices of a mesh with radius, node_id, tube_id and active "
+                                "attributes, tubes and branches as edges, faster for large sketches")],
+        default="PROPERTIES",
+        update=storage_update_callback
+    )
+    storage_mesh: bpy.props.PointerProperty(type=bpy.types.Mesh, name="Storage Mesh")
     method: bpy.props.EnumProperty(
         name="Method",
         items=[("Geometry Node", "Geometry Node", "Geometry Node"),
-               ("Skin Modifier", "Skin Modifier", "Skin Modifier")],
+               ("Attribute Geometry Node", "Attribute Geometry Node",
+                "Geometry Node with a fixed size tree reading the sketch from mesh attributes, segments are "
+                "tapered tubes through the ball centers instead of hulls tangent to the balls"),
+               ("Skin Modifier", "Skin Modifier", "Skin Modifier"),
+               ("Mesh", "Mesh", "Generate the mesh directly from capsules tangent to the balls")],
         default="Geometry Node",
         update=property_update_callback
     )
@@ -38,6 +70,31 @@ class FastSketchGroupProperties(bpy.types.PropertyGroup):
                                     max=12,
                                     name="Segments",
                                     update=property_update_callback)
+    use_adaptive_segments: bpy.props.BoolProperty(name="Adaptive Segments",
+                                                  description="Choose the segments of each ball from its size, "
+                                                              "up to Segments",
+                                                  update=property_update_callback)
+    min_segments: bpy.props.IntProperty(default=2,
+                                        min=2,
+                                        max=12,
+                                        name="Min Segments",
+                                        update=property_update_callback)
+    detail_size: bpy.props.FloatProperty(name="Detail Size",
+                                         description="Approximate width of the faces around a ball",
+                                         default=0.05,
+                                         min=0.001,
+                                         unit="LENGTH",
+                                         update=property_update_callback)
+    use_screen_size: bpy.props.BoolProperty(name="Screen Size",
+                                            description="Measure balls by their size in the 3D views when the sketch "
+                                                        "is rebuilt, balls out of view get Min Segments",
+                                            update=property_update_callback)
+    detail_pixels: bpy.props.FloatProperty(name="Detail Size",
+                                           description="Approximate width of the faces around a ball on screen",
+                                           default=8,
+                                           min=1,
+                                           subtype="PIXEL",
+                                           update=property_update_callback)
     sub_surf_levels: bpy.props.IntProperty(default=1,
                                            min=0,
                                            max=6,
@@ -49,6 +106,23 @@ class FastSketchGroupProperties(bpy.types.PropertyGroup):
                                                     update=property_update_callback)
     bisect_axis: bpy.props.BoolVectorProperty(name="Bisect", update=property_update_callback)
     merge_meshes: bpy.props.BoolProperty(default=True, name="Merge Meshes")
+    bake_method: bpy.props.EnumProperty(
+        name="Bake Method",
+        items=[("Boolean", "Boolean", "Apply the modifiers and join overlapping parts with exact booleans"),
+               ("Voxel", "Voxel", "Mesh the sketch as a smooth union of capsules sampled on a voxel grid, "
+                                  "always closed and in predictable time")],
+        default="Boolean"
+    )
+    voxel_size: bpy.props.FloatProperty(name="Voxel Size",
+                                        description="Size of the voxels, 0 uses half of the smallest radius",
+                                        default=0,
+                                        min=0,
+                                        unit="LENGTH")
+    blend_radius: bpy.props.FloatProperty(name="Blend Radius",
+                                          description="Distance over which capsules blend into each other",
+                                          default=0,
+                                          min=0,
+                                          unit="LENGTH")
 
 
 # global temporary properties
@@ -59,3 +133,77 @@ class FastSketchWmProperties(bpy.types.PropertyGroup):
     insert_node_index: bpy.props.IntProperty(default=-1)
     insert_radius: bpy.props.FloatProperty(default=.5)
     is_branch: bpy.props.BoolProperty()
+    select_mode: bpy.props.EnumProperty(
+        name="Select Mode",
+        items=[("BOX", "Box", "Select nodes inside a box", "SELECT_SET", 0),
+               ("LASSO", "Lasso", "Select nodes inside a lasso", "MOD_CURVE", 1),
+               ("CIRCLE", "Circle", "Select nodes under a circle brush", "MESH_CIRCLE", 2)],
+        default="BOX"
+    )
+    select_circle_radius: bpy.props.IntProperty(name="Radius", default=25, min=1, max=500, subtype="PIXEL")
+
+
+class FastSketchPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    segment_cache_size: bpy.props.IntProperty(name="Segment Cache Size (MB)",
+                                              description="Memory used to keep generated capsules of the Mesh method",
+                                              default=64,
+                                              min=0)
+
+    max_update_rate: bpy.props.IntProperty(name="Max Updates Per Second",
+                                           description="Limit how often the sketch geometry is rebuilt, "
+                                                       "0 means no limit",
+                                           default=60,
+                                           min=0)
+
+    local_undo_memory: bpy.props.IntProperty(name="Sketch Undo Memory (MB)",
+                                             description="Memory used to keep strokes undoable without global undo "
+                                                         "steps",
+                                             default=32,
+                                             min=1)
+
+    use_interaction_lod: bpy.props.BoolProperty(name="Lower Quality While Editing",
+                                                description="Rebuild the sketch at a lower resolution while nodes are "
+                                                            "dragged or resized",
+                                                default=True)
+    interaction_segments: bpy.props.IntProperty(name="Segments", default=2, min=2, max=12)
+    interaction_sub_surf_levels: bpy.props.IntProperty(name="Subdivision Levels", default=0, min=0, max=6)
+    interaction_idle_time: bpy.props.FloatProperty(name="Idle Time",
+                                                   description="Time without input before switching back to full "
+                                                               "quality",
+                                                   default=0.3,
+                                                   min=0,
+                                                   unit="TIME_ABSOLUTE")
+
+    bake_cache_size: bpy.props.IntProperty(name="Bake Cache Size (MB)",
+                                           description="Disk space used to keep bake results, 0 disables the cache",
+                                           default=256,
+                                           min=0)
+    bake_cache_directory: bpy.props.StringProperty(name="Bake Cache Directory",
+                                                   description="Where bake results are kept, empty for the system "
+                                                               "temporary directory",
+                                                   subtype="DIR_PATH")
+
+    use_mesh_storage: bpy.props.BoolProperty(name="Store New Sketches in Meshes",
+                                             description="Store the nodes of new sketches as mesh vertices, "
+                                                         "faster to read, write and save for large sketches")
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "max_update_rate")
+        layout.prop(self, "local_undo_memory")
+        layout.prop(self, "use_interaction_lod")
+        col = layout.column()
+        col.active = self.use_interaction_lod
+        col.prop(self, "interaction_segments")
+        col.prop(self, "interaction_sub_surf_levels")
+        col.prop(self, "interaction_idle_time")
+        layout.prop(self, "use_mesh_storage")
+        row = layout.row()
+        row.prop(self, "segment_cache_size")
+        row.label(text="%d cached, %d hits, %d misses" % (len(segment_cache), segment_cache.hits, segment_cache.misses))
+        row = layout.row()
+        row.prop(self, "bake_cache_size")
+        row.label(text="%d hits, %d misses" % (bake_cache.hits, bake_cache.misses))
+        layout.prop(self, "bake_cache_directory")
@@ -0,0 +1,493 @@
+import bpy
+import numpy as np
+
+from .spatial import PickingGrid
+from .storage import read_node_counts, read_node_data, write_node_data, get_tube_offsets
+
+PICKING_GRID_CELL_SIZE = 64
+
+# runtime-only state, keyed by object session uid
+# versions are drawn from one monotonic counter so a global invalidation (undo, file load) can be expressed as a
+# lower bound shared by every object
+_version_counter = 0
+_global_version = 0
+_versions = {}
+_selection_versions = {}
+_topology_versions = {}
+
+# node arrays, id maps and junction indices, keyed by object session uid
+_sketch_arrays = {}
+_node_id_maps = {}
+_junction_indices = {}
+# topology versions whose ids were checked, keyed by object session uid
+_checked_ids = {}
+# sketch-local undo histories, keyed by object session uid
+_histories = {}
+# sets of selected node ids and their flags in node array order, keyed by object session uid
+_selections = {}
+_selection_flags = {}
+# node projections and picking grids, keyed by region pointer
+_node_projections = {}
+_picking_grids = {}
+
+
+def get_preferences():
+    return bpy.context.preferences.addons[__package__].preferences
+
+
+def get_sketch_version(obj):
+    return max(_versions.get(obj.session_uid, 0), _global_version)
+
+
+def tag_sketch_changed(obj):
+    global _version_counter
+    _version_counter += 1
+    _versions[obj.session_uid] = _version_counter
+
+
+def get_selection_version(obj):
+    return max(_selection_versions.get(obj.session_uid, 0), _global_version)
+
+
+def tag_selection_changed(obj):
+    global _version_counter
+    _version_counter += 1
+    _selection_versions[obj.session_uid] = _version_counter
+
+
+def get_topology_version(obj):
+    return max(_topology_versions.get(obj.session_uid, 0), _global_version)
+
+
+def tag_topology_changed(obj):
+    # nodes or tubes were added, removed or reordered, or branch relationships changed
+    global _version_counter
+    _version_counter += 1
+    _topology_versions[obj.session_uid] = _version_counter
+
+
+def get_reload_version():
+    return _global_version
+
+
+def tag_all_sketches_changed():
+    global _version_counter, _global_version
+    _version_counter += 1
+    _global_version = _version_counter
+
+
+@bpy.app.handlers.persistent
+def sketch_data_reloaded_handler(*args):
+    # undo, redo and file loading replace sketch data without going through the tool
+    tag_all_sketches_changed()
+    clear_sketch_histories()
+
+
+# flat copies of the node data of a sketch, nodes of all tubes are stored one after another
+class SketchArrays:
+    def __init__(self, obj):
+        counts = read_node_counts(obj)
+        self.tube_offsets = get_tube_offsets(counts)
+        total = int(self.tube_offsets[-1])
+        self.ids = np.empty(total, dtype=np.int32)
+        self.locations = np.empty((total, 3), dtype=np.float32)
+        self.radii = np.empty(total, dtype=np.float32)
+        read_node_data(obj, self.tube_offsets, "id", self.ids)
+        read_node_data(obj, self.tube_offsets, "location", self.locations)
+        read_node_data(obj, self.tube_offsets, "radius", self.radii)
+        self.tube_indices = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+        self.node_indices = np.arange(total, dtype=np.int32) - self.tube_offsets[self.tube_indices]
+        # index of the node each tube branches from, -1 for none
+        self.parents = np.full(len(counts), -1, dtype=np.int32)
+        for tube_index, parent in enumerate(get_node_id_map(obj).parents):
+            if parent is not None:
+                self.parents[tube_index] = self.tube_offsets[parent[0]] + parent[1]
+
+    def get_index(self, tube_index, node_index):
+        return int(self.tube_offsets[tube_index]) + node_index
+
+    def __len__(self):
+        return len(self.radii)
+
+
+def get_sketch_arrays(obj):
+    check_sketch_ids(obj)
+    version = get_sketch_version(obj)
+    cached = _sketch_arrays.get(obj.session_uid)
+    if cached and cached[0] == version:
+        return cached[1]
+    arrays = SketchArrays(obj)
+    _sketch_arrays[obj.session_uid] = (version, arrays)
+    return arrays
+
+
+# positions of node and tube ids, and the branch relationships resolved to positions
+class NodeIdMap:
+    def __init__(self, obj):
+        tubes = obj.fast_sketch_properties.tubes
+        self.node_counts = read_node_counts(obj)
+        offsets = get_tube_offsets(self.node_counts)
+        ids = np.empty(int(offsets[-1]), dtype=np.int32)
+        read_node_data(obj, offsets, "id", ids)
+        self.node_positions = {}
+        self.tube_indices = {}
+        for tube_index, tube in enumerate(tubes):
+            self.tube_indices[tube.id] = tube_index
+            self.node_positions.update((node_id, (tube_index, node_index)) for node_index, node_id
+                                       in enumerate(ids[offsets[tube_index]:offsets[tube_index + 1]].tolist()))
+        # links to removed nodes are left in place and resolve to no parent
+        self.parents = [self.node_positions.get(tube.parent_node_id) if tube.parent_node_id else None
+                        for tube in tubes]
+
+    def get_parent(self, tube_index):
+        # (tube index, node index) of the node a tube branches from, or None
+        return self.parents[tube_index]
+
+
+def get_node_id_map(obj):
+    check_sketch_ids(obj)
+    version = get_topology_version(obj)
+    cached = _node_id_maps.get(obj.session_uid)
+    if cached and cached[0] == version:
+        return cached[1]
+    id_map = NodeIdMap(obj)
+    _node_id_maps[obj.session_uid] = (version, id_map)
+    return id_map
+
+
+def migrate_sketch_ids(obj):
+    # give ids to the nodes and tubes of sketches saved before node ids, and new ids to duplicates, such as in
+    # sketches appended from such files, then turn their branch indices into node ids
+    # valid ids are kept, so selections and histories stay valid, returns whether any id changed
+    group = obj.fast_sketch_properties
+    tubes = group.tubes
+    counts = read_node_counts(obj)
+    offsets = get_tube_offsets(counts)
+    tube_ids = np.empty(len(tubes), dtype=np.int32)
+    tubes.foreach_get("id", tube_ids)
+    node_ids = np.empty(int(offsets[-1]), dtype=np.int32)
+    read_node_data(obj, offsets, "id", node_ids)
+    ids = np.concatenate((tube_ids, node_ids))
+    keep = np.zeros(len(ids), dtype=bool)
+    keep[np.unique(ids, return_index=True)[1]] = True
+    keep &= ids > 0
+    if np.all(keep) and (not len(ids) or ids.max() < group.next_id):
+        return False
+
+    # branch relationships are resolved before the ids change
+    node_keep = keep[len(tubes):]
+    positions = dict(zip(node_ids[node_keep].tolist(), np.flatnonzero(node_keep).tolist()))
+    parents = []
+    for tube in tubes:
+        parent = positions.get(tube.parent_node_id) if tube.parent_node_id else None
+        if parent is None and 0 <= tube.parent_tube_index < len(tubes) \
+                and 0 <= tube.parent_node_index < counts[tube.parent_tube_index]:
+            parent = int(offsets[tube.parent_tube_index]) + tube.parent_node_index
+        parents.append(parent)
+
+    next_id = max(group.next_id, int(ids.max()) + 1 if len(ids) else 1, 1)
+    missing = np.flatnonzero(~keep)
+    ids[missing] = np.arange(next_id, next_id + len(missing), dtype=np.int32)
+    tubes.foreach_set("id", ids[:len(tubes)])
+    write_node_data(obj, offsets, "id", ids[len(tubes):])
+    for tube, parent in zip(tubes, parents):
+        tube.parent_node_id = int(ids[len(tubes) + parent]) if parent is not None else 0
+        tube.parent_tube_index = -1
+        tube.parent_node_index = -1
+    group.next_id = next_id + len(missing)
+    tag_sketch_changed(obj)
+    tag_topology_changed(obj)
+    # strokes may refer to the old ids
+    _histories.pop(obj.session_uid, None)
+    forget_selection(obj)
+    return True
+
+
+def check_sketch_ids(obj):
+    # appended and linked sketches are not migrated on file load, so ids are checked once per topology version
+    version = get_topology_version(obj)
+    if _checked_ids.get(obj.session_uid) == version:
+        return
+    if obj.library is None:
+        try:
+            migrate_sketch_ids(obj)
+        except AttributeError:
+            # sketch data can not be written while drawing
+            if not bpy.app.timers.is_registered(_check_ids_timer):
+                bpy.app.timers.register(_check_ids_timer, first_interval=0)
+            return
+    _checked_ids[obj.session_uid] = get_topology_version(obj)
+
+
+def _check_ids_timer():
+    for obj in bpy.data.objects:
+        if obj.fast_sketch_properties.is_fast_sketch:
+            check_sketch_ids(obj)
+    return None
+
+
+# groups of coincident nodes joined by branch relationships, (tube index, node index) -> members of its junction
+class JunctionIndex:
+    def __init__(self, obj):
+        id_map = get_node_id_map(obj)
+        self.junctions = {}
+        for tube_index, count in enumerate(id_map.node_counts.tolist()):
+            parent = id_map.get_parent(tube_index)
+            if parent is None or not count:
+                continue
+            # merge the junctions of the branch root and its parent node
+            members = self.junctions.get(parent, [parent])
+            root = (tube_index, 0)
+            for member in self.junctions.get(root, [root]):
+                if member not in members:
+                    members.append(member)
+            for member in members:
+                self.junctions[member] = members
+
+    def get(self, tube_index, node_index):
+        return self.junctions.get((tube_index, node_index), ())
+
+
+def get_junction_index(obj):
+    version = get_topology_version(obj)
+    cached = _junction_indices.get(obj.session_uid)
+    if cached and cached[0] == version:
+        return cached[1]
+    index = JunctionIndex(obj)
+    _junction_indices[obj.session_uid] = (version, index)
+    return index
+
+
+# locations and radii of the nodes changed by one stroke, before and after
+class SketchStep:
+    def __init__(self, ids, old_locations, old_radii, new_locations, new_radii):
+        self.ids = ids
+        self.old_locations = old_locations
+        self.old_radii = old_radii
+        self.new_locations = new_locations
+        self.new_radii = new_radii
+        self.nbytes = ids.nbytes + old_locations.nbytes + old_radii.nbytes + new_locations.nbytes + new_radii.nbytes
+
+
+# strokes are recorded here instead of as global undo steps, global steps are pushed by topology edits, by strokes
+# going over the memory budget and by leaving the tool, which all clear this history
+class SketchHistory:
+    def __init__(self):
+        self.undo_steps = []
+        self.redo_steps = []
+        self.size = 0
+        self._snapshot = None
+
+    def begin(self, arrays):
+        self.commit(arrays)
+        self._snapshot = (arrays.ids.copy(), arrays.locations.copy(), arrays.radii.copy())
+
+    def commit(self, arrays):
+        # keep only the nodes changed since the stroke began
+        if self._snapshot is None:
+            return
+        ids, locations, radii = self._snapshot
+        self._snapshot = None
+        if not np.array_equal(ids, arrays.ids):
+            return
+        changed = np.any(locations != arrays.locations, axis=1) | (radii != arrays.radii)
+        if not np.any(changed):
+            return
+        step = SketchStep(ids[changed], locations[changed], radii[changed],
+                          arrays.locations[changed], arrays.radii[changed])
+        for redo_step in self.redo_steps:
+            self.size -= redo_step.nbytes
+        self.redo_steps.clear()
+        self.undo_steps.append(step)
+        self.size += step.nbytes
+
+    def pop_undo(self):
+        if not self.undo_steps:
+            return None
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        return step
+
+    def pop_redo(self):
+        if not self.redo_steps:
+            return None
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        return step
+
+
+def get_sketch_history(obj):
+    history = _histories.get(obj.session_uid)
+    if history is None:
+        history = _histories[obj.session_uid] = SketchHistory()
+    return history
+
+
+def begin_sketch_step(obj):
+    get_sketch_history(obj).begin(get_sketch_arrays(obj))
+
+
+def commit_sketch_step(obj):
+    # returns whether the history went over its memory budget, its strokes should then go into a global undo step
+    history = get_sketch_history(obj)
+    history.commit(get_sketch_arrays(obj))
+    return history.size > get_preferences().local_undo_memory * 1024 * 1024
+
+
+def commit_all_sketch_steps():
+    # returns whether any stroke is recorded only in the sketch histories
+    recorded = False
+    for obj in bpy.data.objects:
+        history = _histories.get(obj.session_uid)
+        if history is not None:
+            history.commit(get_sketch_arrays(obj))
+            recorded = recorded or bool(history.undo_steps)
+    return recorded
+
+
+def clear_sketch_histories():
+    _histories.clear()
+
+
+def get_selection(obj):
+    # selected node ids, call tag_selection_changed after changing them
+    # the selection is only written to the nodes when saving, so selecting does not touch the object
+    selection = _selections.get(obj.session_uid)
+    if selection is None:
+        arrays = get_sketch_arrays(obj)
+        flags = np.zeros(len(arrays), dtype=bool)
+        read_node_data(obj, arrays.tube_offsets, "active", flags)
+        selection = _selections[obj.session_uid] = set(arrays.ids[flags].tolist())
+    return selection
+
+
+def forget_selection(obj):
+    # read the saved selection again next time
+    _selections.pop(obj.session_uid, None)
+    _selection_flags.pop(obj.session_uid, None)
+
+
+def read_selection_flags(obj):
+    # do not modify the returned flags
+    key = (get_sketch_version(obj), get_selection_version(obj))
+    cached = _selection_flags.get(obj.session_uid)
+    if cached and cached[0] == key:
+        return cached[1]
+    selection = get_selection(obj)
+    arrays = get_sketch_arrays(obj)
+    flags = np.isin(arrays.ids, np.fromiter(selection, dtype=np.int32, count=len(selection)))
+    _selection_flags[obj.session_uid] = (key, flags)
+    return flags
+
+
+def write_selection_flags(obj, flags):
+    selection = get_selection(obj)
+    ids = set(get_sketch_arrays(obj).ids[flags].tolist())
+    if ids != selection:
+        selection.clear()
+        selection.update(ids)
+        tag_selection_changed(obj)
+
+
+@bpy.app.handlers.persistent
+def sketch_file_loaded_handler(*args):
+    _selections.clear()
+    _selection_flags.clear()
+
+
+@bpy.app.handlers.persistent
+def sketch_selection_save_handler(*args):
+    for obj in bpy.data.objects:
+        selection = _selections.get(obj.session_uid)
+        if selection is None or not obj.fast_sketch_properties.is_fast_sketch:
+            continue
+        arrays = get_sketch_arrays(obj)
+        write_node_data(obj, arrays.tube_offsets, "active", read_selection_flags(obj))
+
+
+# node centers and circle radii in region pixels
+class NodeProjection:
+    def __init__(self, region, r3d, obj, arrays):
+        obj_mat = np.array(obj.matrix_world, dtype=np.float32)
+        perspective_matrix = np.array(r3d.perspective_matrix, dtype=np.float32)
+        obj_scale = obj.matrix_world.to_scale()
+        scale = min(obj_scale.x, obj_scale.y, obj_scale.z)
+        # nodes are hit-tested on the plane parallel to the view, so their outline on screen is a circle
+        view_right = np.array(r3d.view_matrix.inverted().col[0].xyz.normalized(), dtype=np.float32)
+        size = np.array((region.width, region.height), dtype=np.float32)
+
+        world = arrays.locations @ obj_mat[:3, :3].T + obj_mat[:3, 3]
+        edge = world + np.outer(arrays.radii * scale, view_right)
+        center_clip = world @ perspective_matrix[:, :3].T + perspective_matrix[:, 3]
+        edge_clip = edge @ perspective_matrix[:, :3].T + perspective_matrix[:, 3]
+        self.visible = (center_clip[:, 3] > 0) & (edge_clip[:, 3] > 0)
+        center_w = np.where(self.visible, center_clip[:, 3], 1)[:, np.newaxis]
+        edge_w = np.where(self.visible, edge_clip[:, 3], 1)[:, np.newaxis]
+        self.centers = (center_clip[:, :2] / center_w + 1) * 0.5 * size
+        self.radii = np.linalg.norm((edge_clip[:, :2] / edge_w + 1) * 0.5 * size - self.centers, axis=1)
+        # circles overlapping the region
+        self.in_region = self.visible \
+            & (self.centers[:, 0] + self.radii >= 0) & (self.centers[:, 0] - self.radii <= region.width) \
+            & (self.centers[:, 1] + self.radii >= 0) & (self.centers[:, 1] - self.radii <= region.height)
+
+
+def _get_view_key(context, obj):
+    region = context.region
+    r3d = context.space_data.region_3d
+    return (obj.session_uid,
+            get_sketch_version(obj),
+            r3d.perspective_matrix.copy(),
+            obj.matrix_world.copy(),
+            region.width,
+            region.height)
+
+
+def get_node_projection(context, obj):
+    key = _get_view_key(context, obj)
+    region_key = context.region.as_pointer()
+    cached = _node_projections.get(region_key)
+    if cached and cached[0] == key:
+        return cached[1]
+    projection = NodeProjection(context.region, context.space_data.region_3d, obj, get_sketch_arrays(obj))
+    _node_projections[region_key] = (key, projection)
+    return projection
+
+
+def get_view_node_radii(obj, arrays):
+    # largest circle radius in pixels of each node over all 3D views, zero for nodes outside every view
+    # returns None when there is no 3D view, e.g. in background mode
+    radii = None
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type != "VIEW_3D":
+                continue
+            r3d = area.spaces.active.region_3d
+            for region in area.regions:
+                if region.type != "WINDOW" or r3d is None:
+                    continue
+                projection = NodeProjection(region, r3d, obj, arrays)
+                view_radii = np.where(projection.in_region, projection.radii, 0)
+                radii = view_radii if radii is None else np.maximum(radii, view_radii)
+    return radii
+
+
+def _build_picking_grid(context, obj):
+    region = context.region
+    arrays = get_sketch_arrays(obj)
+    projection = get_node_projection(context, obj)
+    visible = np.flatnonzero(projection.visible)
+    # one extra pixel to stay conservative against rounding
+    return PickingGrid(PICKING_GRID_CELL_SIZE, projection.centers[visible].astype(np.float64),
+                       projection.radii[visible].astype(np.float64) + 1, arrays.tube_indices[visible],
+                       arrays.node_indices[visible], region.width, region.height)
+
+
+def get_picking_grid(context, obj):
+    key = _get_view_key(context, obj)
+    region_key = context.region.as_pointer()
+    cached = _picking_grids.get(region_key)
+    if cached and cached[0] == key:
+        return cached[1]
+    grid = _build_picking_grid(context, obj)
+    _picking_grids[region_key] = (key, grid)
+    return grid
@@ -0,0 +1,191 @@
+import bpy
+import mathutils
+import numpy as np
+
+from .runtime import get_sketch_arrays, get_preferences, tag_sketch_changed, tag_topology_changed, \
+    read_selection_flags
+from .storage import get_tube_offsets, write_all_nodes
+
+# sketches as .npz files of flat arrays, readable without Blender
+#     positions     float32 (nodes, 3)  node locations in object space, nodes of all tubes one after another
+#     radii         float32 (nodes,)
+#     tube_offsets  int32 (tubes + 1,)  index of the first node of each tube, and the node count at the end
+#     parents       int32 (tubes,)      index of the node of an earlier tube each tube branches from, -1 for none
+#     tube_names    str (tubes,)
+#     node_ids      int32 (nodes,)      optional, node ids, generated when missing
+#     tube_ids      int32 (tubes,)      optional
+#     selected      bool (nodes,)       optional
+#     matrix        float32 (4, 4)      optional, object matrix
+SKETCH_FILE_VERSION = 1
+
+
+def write_sketch_file(filepath, obj):
+    arrays = get_sketch_arrays(obj)
+    tubes = obj.fast_sketch_properties.tubes
+    tube_ids = np.empty(len(tubes), dtype=np.int32)
+    tubes.foreach_get("id", tube_ids)
+    np.savez(filepath,
+             version=np.int32(SKETCH_FILE_VERSION),
+             positions=arrays.locations,
+             radii=arrays.radii,
+             tube_offsets=arrays.tube_offsets,
+             # branches from later tubes are not part of the geometry either
+             parents=np.where(arrays.parents < arrays.tube_offsets[:-1], arrays.parents, -1),
+             tube_names=np.array([tube.name for tube in tubes], dtype=str),
+             node_ids=arrays.ids,
+             tube_ids=tube_ids,
+             selected=read_selection_flags(obj),
+             matrix=np.array(obj.matrix_world, dtype=np.float32))
+
+
+def _new_sketch_ids(tube_count, node_count):
+    # the ids new_sketch_id would give to the tubes and then the nodes of an empty sketch
+    tube_ids = np.arange(1, tube_count + 1, dtype=np.int32)
+    node_ids = np.arange(tube_count + 1, tube_count + 1 + node_count, dtype=np.int32)
+    return tube_ids, node_ids
+
+
+def read_sketch_file(filepath):
+    # returns the arrays of the file, with the optional ones filled in, raises ValueError for invalid files
+    with np.load(filepath) as file:
+        data = {name: file[name] for name in file.files}
+    for name in ("positions", "radii", "tube_offsets", "parents"):
+        if name not in data:
+            raise ValueError("%s is missing" % name)
+    if int(data.get("version", SKETCH_FILE_VERSION)) > SKETCH_FILE_VERSION:
+        raise ValueError("the file was written by a newer version")
+    positions = data["positions"].astype(np.float32).reshape(-1, 3)
+    node_count = len(positions)
+    tube_offsets = data["tube_offsets"].astype(np.int32)
+    tube_count = len(tube_offsets) - 1
+    if tube_count < 0 or tube_offsets[0] != 0 or tube_offsets[-1] != node_count or np.any(np.diff(tube_offsets) < 0):
+        raise ValueError("tube_offsets do not match the nodes")
+    parents = data["parents"].astype(np.int32)
+    if len(data["radii"]) != node_count or len(parents) != tube_count:
+        raise ValueError("array sizes do not match")
+    # tubes branch from nodes of the tubes before them
+    if np.any(parents < -1) or np.any(parents >= tube_offsets[:-1]):
+        raise ValueError("parents must be -1 or nodes of earlier tubes")
+    node_ids = data.get("node_ids")
+    tube_ids = data.get("tube_ids")
+    if node_ids is None or tube_ids is None or len(node_ids) != node_count or len(tube_ids) != tube_count \
+            or len(np.unique(np.concatenate((node_ids, tube_ids)))) != node_count + tube_count \
+            or np.any(node_ids <= 0) or np.any(tube_ids <= 0):
+        tube_ids, node_ids = _new_sketch_ids(tube_count, node_count)
+    names = data.get("tube_names")
+    return {
+        "positions": positions,
+        "radii": data["radii"].astype(np.float32),
+        "tube_offsets": tube_offsets,
+        "parents": parents,
+        "tube_names": [str(name) for name in names] if names is not None and len(names) == tube_count
+        else ["Tube"] * tube_count,
+        "node_ids": node_ids.astype(np.int32),
+        "tube_ids": tube_ids.astype(np.int32),
+        "selected": data["selected"].astype(bool) if len(data.get("selected", ())) == node_count
+        else np.zeros(node_count, dtype=bool),
+        "matrix": data["matrix"].astype(np.float32) if "matrix" in data else np.identity(4, dtype=np.float32),
+    }
+
+
+def create_sketch_object(context, name, data):
+    # a new sketch object linked to the scene, from the arrays of read_sketch_file or read_armature_sketch
+    mesh = bpy.data.meshes.new(name)
+    obj = bpy.data.objects.new(name, mesh)
+    group = obj.fast_sketch_properties
+    group.is_fast_sketch = True
+    if get_preferences().use_mesh_storage:
+        group.storage = "MESH"
+    obj.matrix_world = mathutils.Matrix(data["matrix"].tolist())
+    context.scene.collection.objects.link(obj)
+
+    node_ids = data["node_ids"]
+    tube_ids = data["tube_ids"]
+    parents = data["parents"]
+    for name in data["tube_names"]:
+        group.tubes.add().name = name
+    group.tubes.foreach_set("id", tube_ids)
+    group.tubes.foreach_set("parent_node_id", np.where(parents >= 0, node_ids[np.maximum(parents, 0)], 0)
+                            if len(node_ids) else np.zeros(len(parents), dtype=np.int32))
+    group.next_id = int(max(node_ids.max(initial=0), tube_ids.max(initial=0))) + 1
+    group.active_index = len(group.tubes) - 1
+    write_all_nodes(obj, np.diff(data["tube_offsets"]), {
+        "id": node_ids,
+        "location": data["positions"],
+        "radius": data["radii"],
+        "active": data["selected"],
+    })
+    tag_sketch_changed(obj)
+    tag_topology_changed(obj)
+    return obj
+
+
+def read_armature_sketch(armature, radius_source, radius_scale):
+    # tubes along the bone chains of an armature, in armature space
+    # a tube follows the first connected child of each bone, the other connected children branch from its tail,
+    # and children away from their parent's tail start tubes of their own
+    bones = armature.bones
+    bone_count = len(bones)
+    heads = np.empty((bone_count, 3), dtype=np.float32)
+    tails = np.empty((bone_count, 3), dtype=np.float32)
+    bones.foreach_get("head_local", heads.ravel())
+    bones.foreach_get("tail_local", tails.ravel())
+    if radius_source == "BBONE":
+        sizes = np.empty((2, bone_count), dtype=np.float32)
+        bones.foreach_get("bbone_x", sizes[0])
+        bones.foreach_get("bbone_z", sizes[1])
+        head_radii = tail_radii = sizes.mean(axis=0)
+    else:
+        head_radii = np.empty(bone_count, dtype=np.float32)
+        tail_radii = np.empty(bone_count, dtype=np.float32)
+        bones.foreach_get("head_radius", head_radii)
+        bones.foreach_get("tail_radius", tail_radii)
+    connected = np.empty(bone_count, dtype=bool)
+    bones.foreach_get("use_connect", connected)
+    bone_indices = {bone.name: bone_index for bone_index, bone in enumerate(bones)}
+    children = [[] for _ in range(bone_count)]
+    roots = []
+    for bone_index, bone in enumerate(bones):
+        if bone.parent and connected[bone_index]:
+            children[bone_indices[bone.parent.name]].append(bone_index)
+        else:
+            roots.append(bone_index)
+
+    # each node is the head or the tail of a bone, tubes are lists of (bone index, is head)
+    tube_nodes = []
+    tube_names = []
+    parents = []
+    # tubes to start: first bone, tube index and node index of the parent node or None
+    pending = [(bone_index, None) for bone_index in reversed(roots)]
+    while pending:
+        bone_index, parent = pending.pop()
+        tube_index = len(tube_nodes)
+        nodes = [(bone_index, True)]
+        tube_nodes.append(nodes)
+        tube_names.append(bones[bone_index].name)
+        parents.append(parent)
+        while True:
+            nodes.append((bone_index, False))
+            if not children[bone_index]:
+                break
+            for child in reversed(children[bone_index][1:]):
+                pending.append((child, (tube_index, len(nodes) - 1)))
+            bone_index = children[bone_index][0]
+
+    counts = np.array([len(nodes) for nodes in tube_nodes], dtype=np.int32)
+    tube_offsets = get_tube_offsets(counts)
+    node_bones = np.array([bone_index for nodes in tube_nodes for bone_index, _ in nodes], dtype=np.int64)
+    node_heads = np.array([is_head for nodes in tube_nodes for _, is_head in nodes], dtype=bool)
+    tube_ids, node_ids = _new_sketch_ids(len(tube_nodes), len(node_bones))
+    return {
+        "positions": np.where(node_heads[:, np.newaxis], heads[node_bones], tails[node_bones]),
+        "radii": np.where(node_heads, head_radii[node_bones], tail_radii[node_bones]) * radius_scale,
+        "tube_offsets": tube_offsets,
+        "parents": np.array([tube_offsets[parent[0]] + parent[1] if parent else -1 for parent in parents],
+                            dtype=np.int32),
+        "tube_names": tube_names,
+        "node_ids": node_ids,
+        "tube_ids": tube_ids,
+        "selected": np.zeros(len(node_bones), dtype=bool),
+        "matrix": np.identity(4, dtype=np.float32),
+    }
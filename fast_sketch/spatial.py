@@ -0,0 +1,116 @@
+import numpy as np
+
+# queries on numpy arrays of points and boxes, free of bpy so they can be tested outside Blender
+
+
+# screen space grid of projected node circles, used to find picking candidates without testing every node
+# the node lists of all cells are kept in one array, sorted by cell and by node in tube order
+class PickingGrid:
+    def __init__(self, cell_size, centers, radii, tube_indices, node_indices, width, height):
+        self.cell_size = cell_size
+        self.columns = int(width // cell_size) + 1
+        self.rows = int(height // cell_size) + 1
+        x = centers[:, 0]
+        y = centers[:, 1]
+        inside = np.flatnonzero((x + radii >= 0) & (y + radii >= 0) & (x - radii <= width) & (y - radii <= height))
+        x = x[inside]
+        y = y[inside]
+        radii = radii[inside]
+        # ranges of cells covered by each circle
+        x0 = np.maximum(np.floor((x - radii) / cell_size), 0).astype(np.int64)
+        x1 = np.minimum(np.floor((x + radii) / cell_size), self.columns - 1).astype(np.int64)
+        y0 = np.maximum(np.floor((y - radii) / cell_size), 0).astype(np.int64)
+        y1 = np.minimum(np.floor((y + radii) / cell_size), self.rows - 1).astype(np.int64)
+        widths = x1 - x0 + 1
+        counts = widths * (y1 - y0 + 1)
+        # one entry per covered cell of each circle
+        entries = np.repeat(np.arange(len(inside)), counts)
+        offsets = np.arange(len(entries)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = (y0[entries] + offsets // widths[entries]) * self.columns + x0[entries] + offsets % widths[entries]
+        order = np.lexsort((entries, keys))
+        self.keys, starts = np.unique(keys[order], return_index=True)
+        self.starts = np.append(starts, len(order))
+        items = inside[entries[order]]
+        self.tube_indices = tube_indices[items]
+        self.node_indices = node_indices[items]
+
+    def query(self, location):
+        cell_size = self.cell_size
+        cx = int(location[0] // cell_size)
+        cy = int(location[1] // cell_size)
+        if not (0 <= cx < self.columns and 0 <= cy < self.rows):
+            return ()
+        j = int(np.searchsorted(self.keys, cy * self.columns + cx))
+        if j == len(self.keys) or self.keys[j] != cy * self.columns + cx:
+            return ()
+        start = self.starts[j]
+        end = self.starts[j + 1]
+        return zip(self.tube_indices[start:end].tolist(), self.node_indices[start:end].tolist())
+
+
+def points_in_box(points, start, end):
+    x0 = min(start[0], end[0])
+    x1 = max(start[0], end[0])
+    y0 = min(start[1], end[1])
+    y1 = max(start[1], end[1])
+    return (x0 <= points[:, 0]) & (points[:, 0] <= x1) & (y0 <= points[:, 1]) & (points[:, 1] <= y1)
+
+
+def points_in_circle(points, center, radius):
+    d = points - np.asarray(center, dtype=points.dtype)
+    return np.einsum("ij,ij->i", d, d) <= radius * radius
+
+
+def points_in_lasso(points, path):
+    inside = np.zeros(len(points), dtype=bool)
+    if len(path) < 3:
+        return inside
+    poly = np.asarray(path, dtype=points.dtype)
+    # only test the points inside the bounding box of the lasso
+    candidates = np.flatnonzero(points_in_box(points, poly.min(axis=0), poly.max(axis=0)))
+    if not len(candidates):
+        return inside
+    px = points[candidates, 0][:, np.newaxis]
+    py = points[candidates, 1][:, np.newaxis]
+    ax = poly[:, 0]
+    ay = poly[:, 1]
+    bx = np.roll(ax, -1)
+    by = np.roll(ay, -1)
+    # even-odd rule, count the lasso edges crossed by a horizontal ray from each point
+    crosses = (ay > py) != (by > py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = ax + (py - ay) * (bx - ax) / (by - ay)
+    inside[candidates] = np.count_nonzero(crosses & (px < x_cross), axis=1) % 2 == 1
+    return inside
+
+
+def find_overlap_clusters(mins, maxs, groups=None):
+    # sweep and prune along x, boxes overlapping on every axis end up in the same cluster
+    # boxes of different groups are never put together
+    count = len(mins)
+    parents = np.arange(count)
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    order = np.argsort(mins[:, 0], kind="stable")
+    # boxes after the k-th one in sweep order and starting before it ends
+    ends = np.searchsorted(mins[order, 0], maxs[order, 0], side="right")
+    for k in range(count):
+        candidates = order[k + 1:ends[k]]
+        if not len(candidates):
+            continue
+        i = order[k]
+        hits = candidates[np.all((mins[candidates] <= maxs[i]) & (maxs[candidates] >= mins[i]), axis=1)]
+        if groups is not None:
+            hits = hits[groups[hits] == groups[i]]
+        root = find(i)
+        for j in hits.tolist():
+            other = find(j)
+            if other != root:
+                parents[other] = root
+    roots = np.array([find(i) for i in range(count)], dtype=np.int64)
+    return np.unique(roots, return_inverse=True)[1]
@@ -0,0 +1,304 @@
+import bpy
+import numpy as np
+
+# sketch nodes are kept either in the node collections of the tubes, or as the vertices of a separate mesh
+# in the mesh, vertices are ordered by tube and carry the point attributes below, tube segments and branches are edges
+# nodes are addressed by their index in tube order, the same as the node arrays
+
+MESH_ATTRIBUTES = {
+    "id": ("node_id", "INT", np.int32),
+    "radius": ("radius", "FLOAT", np.float32),
+    "active": ("active", "BOOLEAN", bool),
+}
+
+
+def get_storage_mesh(obj):
+    group = obj.fast_sketch_properties
+    if group.storage == "MESH":
+        return group.storage_mesh
+    return None
+
+
+def get_tube_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int32)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def _read_tube_ids(tubes):
+    tube_ids = np.empty(len(tubes), dtype=np.int32)
+    tubes.foreach_get("id", tube_ids)
+    return tube_ids
+
+
+def _read_vertex_tube_indices(tubes, mesh):
+    # tube index of every vertex, -1 for vertices of tubes the sketch does not have
+    vertex_tube_ids = np.empty(len(mesh.vertices), dtype=np.int32)
+    tube_id_attr = mesh.attributes.get("tube_id")
+    if tube_id_attr is None or not len(tubes):
+        return np.full(len(vertex_tube_ids), -1, dtype=np.int64)
+    tube_id_attr.data.foreach_get("value", vertex_tube_ids)
+    tube_ids = _read_tube_ids(tubes)
+    sorter = np.argsort(tube_ids)
+    tube_indices = sorter[np.clip(np.searchsorted(tube_ids, vertex_tube_ids, sorter=sorter), 0, len(tubes) - 1)]
+    return np.where(tube_ids[tube_indices] == vertex_tube_ids, tube_indices, -1)
+
+
+def _is_mesh_valid(tube_indices):
+    return not len(tube_indices) or (tube_indices[0] >= 0 and np.all(np.diff(tube_indices) >= 0))
+
+
+def _read_mesh_counts(tubes, mesh):
+    tube_indices = _read_vertex_tube_indices(tubes, mesh)
+    if not _is_mesh_valid(tube_indices):
+        # offsets counted from such a mesh would address the nodes of other tubes, see repair_node_storage
+        raise ValueError("Node mesh %s does not match the tubes of the sketch" % mesh.name)
+    return np.bincount(tube_indices, minlength=len(tubes)).astype(np.int32)
+
+
+def _get_writable_mesh(obj):
+    # duplicated objects share the storage mesh until one of them writes to it
+    mesh = get_storage_mesh(obj)
+    if mesh is not None and mesh.users > 1:
+        mesh = mesh.copy()
+        obj.fast_sketch_properties.storage_mesh = mesh
+    return mesh
+
+
+def read_node_counts(obj):
+    tubes = obj.fast_sketch_properties.tubes
+    mesh = get_storage_mesh(obj)
+    if mesh is None:
+        return np.array([len(tube.nodes) for tube in tubes], dtype=np.int32)
+    return _read_mesh_counts(tubes, mesh)
+
+
+def _read_tube_nodes(tubes, offsets, name, out):
+    flat = out.reshape(len(out), -1)
+    for tube_index, tube in enumerate(tubes):
+        start = offsets[tube_index]
+        end = offsets[tube_index + 1]
+        if start != end:
+            tube.nodes.foreach_get(name, flat[start:end].ravel())
+
+
+def _read_mesh_nodes(mesh, name, out):
+    if name == "location":
+        mesh.vertices.foreach_get("co", out.ravel())
+        return
+    attr = mesh.attributes.get(MESH_ATTRIBUTES[name][0])
+    if attr is None:
+        out[:] = 0
+    else:
+        attr.data.foreach_get("value", out)
+
+
+def read_node_data(obj, offsets, name, out):
+    # name is one of location, radius, id and active
+    mesh = get_storage_mesh(obj)
+    if mesh is None:
+        _read_tube_nodes(obj.fast_sketch_properties.tubes, offsets, name, out)
+    else:
+        _read_mesh_nodes(mesh, name, out)
+
+
+def write_node_data(obj, offsets, name, values, tube_indices=None):
+    # only the given tubes are written when nodes are stored in the tubes, the mesh is always written as a whole
+    mesh = _get_writable_mesh(obj)
+    if mesh is not None:
+        if name == "location":
+            mesh.vertices.foreach_set("co", np.ascontiguousarray(values, dtype=np.float32).ravel())
+        else:
+            attr_name, attr_type, dtype = MESH_ATTRIBUTES[name]
+            attr = mesh.attributes.get(attr_name) or mesh.attributes.new(attr_name, attr_type, "POINT")
+            attr.data.foreach_set("value", np.ascontiguousarray(values, dtype=dtype))
+        return
+    tubes = obj.fast_sketch_properties.tubes
+    flat = values.reshape(len(values), -1)
+    if tube_indices is None:
+        tube_indices = range(len(tubes))
+    for tube_index in tube_indices:
+        start = offsets[tube_index]
+        end = offsets[tube_index + 1]
+        if start != end:
+            tubes[tube_index].nodes.foreach_set(name, np.ascontiguousarray(flat[start:end]).ravel())
+
+
+def _read_all(obj):
+    counts = read_node_counts(obj)
+    offsets = get_tube_offsets(counts)
+    total = int(offsets[-1])
+    data = {
+        "id": np.empty(total, dtype=np.int32),
+        "location": np.empty((total, 3), dtype=np.float32),
+        "radius": np.empty(total, dtype=np.float32),
+        "active": np.empty(total, dtype=bool),
+    }
+    for name, out in data.items():
+        read_node_data(obj, offsets, name, out)
+    return counts, data
+
+
+def _write_mesh(tubes, mesh, counts, data):
+    offsets = get_tube_offsets(counts)
+    total = int(offsets[-1])
+    tube_indices = np.repeat(np.arange(len(tubes), dtype=np.int32), counts)
+    ends = np.flatnonzero(np.arange(total) - offsets[tube_indices] != 0)
+    edges = [np.stack((ends - 1, ends), axis=1)]
+    # branch edges from the parent node to the first node of the branch
+    ids = data["id"]
+    sorter = np.argsort(ids)
+    branches = []
+    for tube_index, tube in enumerate(tubes):
+        if tube.parent_node_id and counts[tube_index] and total:
+            position = sorter[min(np.searchsorted(ids, tube.parent_node_id, sorter=sorter), total - 1)]
+            if ids[position] == tube.parent_node_id:
+                branches.append((position, offsets[tube_index]))
+    edges.append(np.array(branches, dtype=np.int64).reshape(-1, 2))
+    edges = np.concatenate(edges).astype(np.int32)
+
+    mesh.clear_geometry()
+    mesh.vertices.add(total)
+    mesh.edges.add(len(edges))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(data["location"], dtype=np.float32).ravel())
+    mesh.edges.foreach_set("vertices", edges.ravel())
+    tube_id_attr = mesh.attributes.new("tube_id", "INT", "POINT")
+    tube_id_attr.data.foreach_set("value", np.repeat(_read_tube_ids(tubes), counts))
+    for name, (attr_name, attr_type, dtype) in MESH_ATTRIBUTES.items():
+        attr = mesh.attributes.new(attr_name, attr_type, "POINT")
+        attr.data.foreach_set("value", np.ascontiguousarray(data[name], dtype=dtype))
+    mesh.update()
+
+
+def _write_tube_nodes(tubes, counts, data):
+    offsets = get_tube_offsets(counts)
+    for tube_index, tube in enumerate(tubes):
+        tube.nodes.clear()
+        for _ in range(counts[tube_index]):
+            tube.nodes.add()
+    for name, values in data.items():
+        flat = values.reshape(len(values), -1)
+        for tube_index, tube in enumerate(tubes):
+            start = offsets[tube_index]
+            end = offsets[tube_index + 1]
+            if start != end:
+                tube.nodes.foreach_set(name, np.ascontiguousarray(flat[start:end]).ravel())
+
+
+def write_all_nodes(obj, counts, data):
+    # replace the nodes of every tube, data holds id, location, radius and active arrays in tube order
+    tubes = obj.fast_sketch_properties.tubes
+    mesh = _get_writable_mesh(obj)
+    if mesh is None:
+        _write_tube_nodes(tubes, counts, data)
+    else:
+        _write_mesh(tubes, mesh, counts, data)
+
+
+def insert_node(obj, tube_index, node_index, node_id, location, radius):
+    tubes = obj.fast_sketch_properties.tubes
+    mesh = _get_writable_mesh(obj)
+    if mesh is None:
+        nodes = tubes[tube_index].nodes
+        node = nodes.add()
+        node.id = node_id
+        node.location = location
+        node.radius = radius
+        if node_index < len(nodes) - 1:
+            nodes.move(len(nodes) - 1, node_index)
+        return
+    # vertices can not be inserted in place, the mesh is written again in bulk
+    counts, data = _read_all(obj)
+    i = int(get_tube_offsets(counts)[tube_index]) + node_index
+    values = {"id": node_id, "location": tuple(location), "radius": radius, "active": False}
+    for name in data:
+        data[name] = np.insert(data[name], i, values[name], axis=0)
+    counts[tube_index] += 1
+    _write_mesh(tubes, mesh, counts, data)
+
+
+def remove_nodes(obj, indices):
+    # indices in tube order, tubes losing their first node no longer branch
+    tubes = obj.fast_sketch_properties.tubes
+    indices = np.asarray(indices)
+    counts = read_node_counts(obj)
+    offsets = get_tube_offsets(counts)
+    tube_indices = np.searchsorted(offsets, indices, side="right") - 1
+    for tube_index in np.unique(tube_indices[indices == offsets[tube_indices]]).tolist():
+        tubes[tube_index].parent_node_id = 0
+    mesh = _get_writable_mesh(obj)
+    if mesh is None:
+        for i, tube_index in sorted(zip(indices.tolist(), tube_indices.tolist()), reverse=True):
+            tubes[tube_index].nodes.remove(i - int(offsets[tube_index]))
+        return
+    counts, data = _read_all(obj)
+    for name in data:
+        data[name] = np.delete(data[name], indices, axis=0)
+    counts -= np.bincount(tube_indices, minlength=len(counts)).astype(np.int32)
+    _write_mesh(tubes, mesh, counts, data)
+
+
+def remove_tube_nodes(obj, tube_index):
+    # call before removing the tube itself
+    counts = read_node_counts(obj)
+    offsets = get_tube_offsets(counts)
+    if get_storage_mesh(obj) is not None and counts[tube_index]:
+        remove_nodes(obj, np.arange(offsets[tube_index], offsets[tube_index + 1]))
+
+
+def migrate_node_storage(obj):
+    # move the nodes to the storage chosen by the storage property
+    group = obj.fast_sketch_properties
+    tubes = group.tubes
+    if group.storage == "MESH" and group.storage_mesh is None:
+        counts = np.array([len(tube.nodes) for tube in tubes], dtype=np.int32)
+        offsets = get_tube_offsets(counts)
+        data = {}
+        for name, dtype, shape in (("id", np.int32, ()), ("location", np.float32, (3,)),
+                                   ("radius", np.float32, ()), ("active", bool, ())):
+            data[name] = np.empty((int(offsets[-1]),) + shape, dtype=dtype)
+            _read_tube_nodes(tubes, offsets, name, data[name])
+        mesh = bpy.data.meshes.new(obj.name + " Nodes")
+        _write_mesh(tubes, mesh, counts, data)
+        group.storage_mesh = mesh
+        for tube in tubes:
+            tube.nodes.clear()
+    elif group.storage != "MESH" and group.storage_mesh is not None:
+        repair_node_storage(obj)
+        mesh = group.storage_mesh
+        counts = _read_mesh_counts(tubes, mesh)
+        data = {}
+        for name, dtype, shape in (("id", np.int32, ()), ("location", np.float32, (3,)),
+                                   ("radius", np.float32, ()), ("active", bool, ())):
+            data[name] = np.empty((len(mesh.vertices),) + shape, dtype=dtype)
+            _read_mesh_nodes(mesh, name, data[name])
+        _write_tube_nodes(tubes, counts, data)
+        group.storage_mesh = None
+        if not mesh.users:
+            bpy.data.meshes.remove(mesh)
+
+
+def repair_node_storage(obj):
+    # storage meshes shared by duplicated objects in older versions may hold nodes of tubes the sketch does not have
+    # those nodes are dropped and the others put back in tube order, returns whether the mesh was rewritten
+    group = obj.fast_sketch_properties
+    mesh = group.storage_mesh
+    if mesh is None:
+        return False
+    tubes = group.tubes
+    tube_indices = _read_vertex_tube_indices(tubes, mesh)
+    if _is_mesh_valid(tube_indices):
+        return False
+    if mesh.users > 1:
+        mesh = mesh.copy()
+        group.storage_mesh = mesh
+    order = np.flatnonzero(tube_indices >= 0)
+    order = order[np.argsort(tube_indices[order], kind="stable")]
+    data = {}
+    for name, dtype, shape in (("id", np.int32, ()), ("location", np.float32, (3,)),
+                               ("radius", np.float32, ()), ("active", bool, ())):
+        values = np.empty((len(mesh.vertices),) + shape, dtype=dtype)
+        _read_mesh_nodes(mesh, name, values)
+        data[name] = values[order]
+    _write_mesh(tubes, mesh, np.bincount(tube_indices[order], minlength=len(tubes)).astype(np.int32), data)
+    return True
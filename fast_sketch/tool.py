@@ -1,14 +1,22 @@
+import math
 import time
 from pathlib import Path
 
 import bpy
 import gpu
 import mathutils
-from bpy_extras.view3d_utils import region_2d_to_location_3d, location_3d_to_region_2d
+import numpy as np
+from bpy_extras.view3d_utils import region_2d_to_location_3d
 from gpu_extras.batch import batch_for_shader
 
-from .misc import get_mouse_pointing_node, update_branch
-from .update import update_geometry, update_mirror
+from .misc import get_mouse_pointing_node, get_selected_nodes, write_node_arrays, new_sketch_id, write_node_values
+from .runtime import get_sketch_arrays, get_node_projection, get_selection, read_selection_flags, \
+    write_selection_flags, tag_selection_changed, tag_sketch_changed, tag_topology_changed, get_sketch_history, \
+    begin_sketch_step, get_preferences
+from .spatial import points_in_box, points_in_circle, points_in_lasso
+from .storage import insert_node, remove_nodes
+from .update import request_geometry_update, update_mirror, undo_push, begin_interaction, end_interaction, \
+    end_sketch_step, flush_sketch_histories
 
 RADIUS_STEP = 0.02
 RADIUS_MAX = 10
@@ -23,6 +31,10 @@ class FastSketchToolOperator(bpy.types.Operator):
     _draw_handler = None
     _select_box_start = mathutils.Vector((0, 0, 0))
     _select_box_end = mathutils.Vector((0, 0, 0))
+    _select_path = []
+    _select_start_flags = None
+    _select_flags = None
+    _select_swept = None
 
     _clicked_tube_index = -1
     _clicked_node_index = -1
@@ -36,7 +48,7 @@ class FastSketchToolOperator(bpy.types.Operator):
     _drag_start_depth = (0, 0, 0)
     _drag_start_mat = mathutils.Matrix()
     _drag_start_inv_mat = mathutils.Matrix()
-    _drag_start_state = []
+    _drag_start_locations = None
 
     def invoke(self, context, event):
         if event.type == "LEFTMOUSE" and event.value == 'PRESS':
@@ -49,39 +61,37 @@ class FastSketchToolOperator(bpy.types.Operator):
                 active_tube = None
                 active_node = None
                 insert_node_index = -1
+                node_count = 0
 
                 if context.object and context.object.fast_sketch_properties.is_fast_sketch:
                     active_obj = context.object
 
                 if active_obj:
                     group = active_obj.fast_sketch_properties
+                    arrays = get_sketch_arrays(active_obj)
+                    selected = np.flatnonzero(read_selection_flags(active_obj))
 
                     if 0 <= group.active_index < len(group.tubes):
                         active_tube = group.tubes[group.active_index]
-                    else:
-                        for tube_index, tube in enumerate(group.tubes):
-                            for node in tube.nodes:
-                                if node.active:
-                                    group.active_index = tube_index
-                                    active_tube = tube
-                                    break
-                            if active_tube:
-                                break
+                    elif len(selected):
+                        group.active_index = int(arrays.tube_indices[selected[0]])
+                        active_tube = group.tubes[group.active_index]
 
                     if active_tube:
-                        for node_index, node in enumerate(active_tube.nodes):
-                            if node.active:
-                                active_node = node
-                                insert_node_index = node_index
-                                break
+                        node_count = int(arrays.tube_offsets[group.active_index + 1]
+                                         - arrays.tube_offsets[group.active_index])
+                        selected = selected[arrays.tube_indices[selected] == group.active_index]
+                        if len(selected):
+                            active_node = int(selected[0])
+                            insert_node_index = int(arrays.node_indices[active_node])
 
                 if insert_node_index < 0 and active_tube:
-                    insert_node_index = len(active_tube.nodes)
+                    insert_node_index = node_count
 
                 # get mouse clicked location
                 depth_loc = (0, 0, 0)
-                if active_node:
-                    depth_loc = active_obj.matrix_world @ active_node.location
+                if active_node is not None:
+                    depth_loc = active_obj.matrix_world @ mathutils.Vector(arrays.locations[active_node])
                 region = context.region
                 r3d = context.space_data.region_3d
                 x, y = event.mouse_region_x, event.mouse_region_y
@@ -92,58 +102,66 @@ class FastSketchToolOperator(bpy.types.Operator):
                 # new branch
                 if context.window_manager.fast_sketch.is_branch \
                         and active_obj and active_tube \
-                        and 0 <= insert_node_index < len(active_tube.nodes) - 1:
-                    parent_node = active_tube.nodes[insert_node_index]
-                    location = mathutils.Vector(parent_node.location)
-                    radius = parent_node.radius
+                        and 0 <= insert_node_index < node_count - 1:
                     tubes = active_obj.fast_sketch_properties.tubes
+                    sub_tube_id = new_sketch_id(active_obj)
+                    new_node_id = new_sketch_id(active_obj)
                     sub_tube = tubes.add()
                     sub_tube.name = "Tube"
-                    sub_tube.parent_tube_index = active_obj.fast_sketch_properties.active_index
-                    sub_tube.parent_node_index = insert_node_index
+                    sub_tube.id = sub_tube_id
+                    sub_tube.parent_node_id = int(arrays.ids[active_node])
                     active_obj.fast_sketch_properties.active_index = len(tubes) - 1
                     active_tube = sub_tube
                     insert_node_index = 0
-                    new_node = active_tube.nodes.add()
-                    new_node.location = location
-                    new_node.radius = radius
+                    insert_node(active_obj, len(tubes) - 1, 0, new_node_id,
+                                arrays.locations[active_node], arrays.radii[active_node])
+                    node_count = 1
+                    # the arrays read below must include the branch
+                    tag_sketch_changed(active_obj)
+                    tag_topology_changed(active_obj)
 
                 if not active_obj:
                     mesh = bpy.data.meshes.new("Sketch")
                     active_obj = bpy.data.objects.new("Sketch", mesh)
                     active_obj.fast_sketch_properties.is_fast_sketch = True
+                    if get_preferences().use_mesh_storage:
+                        active_obj.fast_sketch_properties.storage = "MESH"
                     active_obj.matrix_world = mathutils.Matrix.Translation(mouse_location)
                     context.scene.collection.objects.link(active_obj)
                     for obj in bpy.context.selected_objects:
                         obj.select_set(False)
                     bpy.context.view_layer.objects.active = active_obj
 
-                bpy.ops.ed.undo_push()
+                undo_push()
 
                 if not active_tube:
+                    tube_id = new_sketch_id(active_obj)
                     tubes = active_obj.fast_sketch_properties.tubes
                     active_tube = tubes.add()
+                    active_tube.id = tube_id
                     active_obj.fast_sketch_properties.active_index = len(tubes) - 1
                     active_tube.name = "Tube"
                     insert_node_index = 0
-
-                if insert_node_index < len(active_tube.nodes) - 1:
-                    tubes = active_obj.fast_sketch_properties.tubes
-                    for tube in tubes:
-                        if tube.parent_tube_index == active_obj.fast_sketch_properties.active_index \
-                                and tube.parent_node_index > insert_node_index:
-                            tube.parent_node_index += 1
-
-                for node in active_tube.nodes:
-                    node.active = False
-                new_node = active_tube.nodes.add()
-                new_node.location = active_obj.matrix_world.inverted() @ mouse_location
-                new_node.radius = context.window_manager.fast_sketch.insert_radius
-                new_node.active = True
-                for i in range(len(active_tube.nodes) - 1, insert_node_index, -1):
-                    active_tube.nodes.move(i, i + 1)
-                update_geometry()
-                update_mirror()
+                    tag_sketch_changed(active_obj)
+                    tag_topology_changed(active_obj)
+
+                selection = get_selection(active_obj)
+                group = active_obj.fast_sketch_properties
+                arrays = get_sketch_arrays(active_obj)
+                if 0 <= group.active_index < len(arrays.tube_offsets) - 1:
+                    start = arrays.tube_offsets[group.active_index]
+                    end = arrays.tube_offsets[group.active_index + 1]
+                    selection.difference_update(arrays.ids[start:end].tolist())
+                new_node_id = new_sketch_id(active_obj)
+                # branches refer to node ids, so inserting in place is enough
+                insert_node(active_obj, group.active_index, min(insert_node_index + 1, node_count), new_node_id,
+                            active_obj.matrix_world.inverted() @ mouse_location,
+                            context.window_manager.fast_sketch.insert_radius)
+                selection.add(new_node_id)
+                tag_topology_changed(active_obj)
+                tag_selection_changed(active_obj)
+                request_geometry_update(active_obj)
+                update_mirror(active_obj)
 
                 # update gizmo
                 bpy.context.region.tag_redraw()
@@ -167,32 +185,31 @@ class FastSketchToolOperator(bpy.types.Operator):
                 if pointing_node_index < 0:
                     self._select_box_start = self._select_box_end = mathutils.Vector(
                         (event.mouse_region_x, event.mouse_region_y))
+                    self._select_path = [(event.mouse_region_x, event.mouse_region_y)]
+                    self._select_start_flags = None
+                    if context.object and context.object.fast_sketch_properties.is_fast_sketch:
+                        self._select_start_flags = read_selection_flags(context.object)
+                        self._select_flags = self._select_start_flags.copy()
+                        self._select_swept = np.zeros(len(self._select_start_flags), dtype=bool)
                     self._draw_handler = bpy.types.SpaceView3D.draw_handler_add(
                         self._draw_callback_px, (context,), "WINDOW", "POST_PIXEL"
                     )
 
                 # save drag start state
                 self._drag_move = pointing_node_index >= 0
-                self._drag_start_state = []
-                if context.object and context.object.fast_sketch_properties.is_fast_sketch:
-                    tubes = context.object.fast_sketch_properties.tubes
-                    for tube_index, tube in enumerate(tubes):
-                        tube_state = []
-                        self._drag_start_state.append(tube_state)
-                        for node_index, node in enumerate(tube.nodes):
-                            tube_state.append({
-                                "location": mathutils.Vector(node.location),
-                                "active": node.active
-                            })
-                            if tube_index == pointing_tube_index and node_index == pointing_node_index:
-                                depth_loc = context.object.matrix_world @ node.location
-                                region = context.region
-                                r3d = context.space_data.region_3d
-                                x, y = event.mouse_region_x, event.mouse_region_y
-                                self._drag_start_depth = depth_loc
-                                self._drag_start_loc = region_2d_to_location_3d(region, r3d, (x, y), depth_loc)
-                                self._drag_start_mat = context.object.matrix_world
-                                self._drag_start_inv_mat = context.object.matrix_world.inverted()
+                self._drag_start_locations = None
+                if self._drag_move and context.object and context.object.fast_sketch_properties.is_fast_sketch:
+                    arrays = get_sketch_arrays(context.object)
+                    self._drag_start_locations = arrays.locations.copy()
+                    node_location = arrays.locations[arrays.get_index(pointing_tube_index, pointing_node_index)]
+                    depth_loc = context.object.matrix_world @ mathutils.Vector(node_location)
+                    region = context.region
+                    r3d = context.space_data.region_3d
+                    x, y = event.mouse_region_x, event.mouse_region_y
+                    self._drag_start_depth = depth_loc
+                    self._drag_start_loc = region_2d_to_location_3d(region, r3d, (x, y), depth_loc)
+                    self._drag_start_mat = context.object.matrix_world.copy()
+                    self._drag_start_inv_mat = context.object.matrix_world.inverted()
 
                 # start dragging in modal
                 context.window_manager.modal_handler_add(self)
@@ -222,36 +239,28 @@ class FastSketchToolOperator(bpy.types.Operator):
                 )
                 if pointing_node_index >= 0:
                     # resize all selected nodes
-                    tubes = context.object.fast_sketch_properties.tubes
-                    hovered_node = tubes[pointing_tube_index].nodes[pointing_node_index]
-                    if hovered_node.active:
-                        # limit undo records num
+                    arrays = get_sketch_arrays(context.object)
+                    selected = read_selection_flags(context.object)
+                    if selected[arrays.get_index(pointing_tube_index, pointing_node_index)]:
+                        # wheel ticks close together are one stroke
                         now = time.time()
                         if now - FastSketchToolOperator._wheel_input_last_timestamp > 0.3:
-                            bpy.ops.ed.undo_push()
+                            end_sketch_step(context.object)
+                            begin_sketch_step(context.object)
                         FastSketchToolOperator._wheel_input_last_timestamp = now
 
                         active_index = context.object.fast_sketch_properties.active_index
-                        radius_0 = []
-                        for tube in tubes:
-                            arr = []
-                            radius_0.append(arr)
-                            for node in tube.nodes:
-                                arr.append(node.radius)
-                        for tube_index, tube in enumerate(tubes):
-                            if 0 <= active_index != tube_index:
-                                continue
-                            for node_index, node in enumerate(tube.nodes):
-                                if node.active:
-                                    r = radius_0[tube_index][node_index]
-                                    if event.type == "WHEELUPMOUSE":
-                                        r = min(r + RADIUS_STEP, RADIUS_MAX)
-                                    else:
-                                        r = max(r - RADIUS_STEP, RADIUS_MIN)
-                                    node.radius = r
-                                    update_branch(tube_index, node_index)
-
-                        update_geometry()
+                        if active_index >= 0:
+                            selected = selected & (arrays.tube_indices == active_index)
+                        radii = arrays.radii.copy()
+                        if event.type == "WHEELUPMOUSE":
+                            radii[selected] = np.minimum(radii[selected] + RADIUS_STEP, RADIUS_MAX)
+                        else:
+                            radii[selected] = np.maximum(radii[selected] - RADIUS_STEP, RADIUS_MIN)
+                        write_node_arrays(context.object, arrays, selected, arrays.locations.copy(), radii)
+
+                        begin_interaction()
+                        request_geometry_update()
                         # update gizmo
                         context.area.tag_redraw()
                         return {"FINISHED"}
@@ -276,19 +285,10 @@ class FastSketchToolOperator(bpy.types.Operator):
                 context.window_manager.fast_sketch.is_inserting = event.alt
                 context.window_manager.fast_sketch.is_branch = event.shift
                 if event.alt and context.object is not None and context.object.fast_sketch_properties.is_fast_sketch:
-                    active_index = context.object.fast_sketch_properties.active_index
-                    tubes = context.object.fast_sketch_properties.tubes
-                    for tube_index, tube in enumerate(tubes):
-                        if 0 <= active_index != tube_index:
-                            continue
-                        active_found = False
-                        for node in tube.nodes:
-                            if node.active:
-                                context.window_manager.fast_sketch.insert_radius = node.radius
-                                active_found = True
-                                break
-                        if active_found:
-                            break
+                    selected = get_selected_nodes(context.object)
+                    if len(selected):
+                        radius = get_sketch_arrays(context.object).radii[selected[0]]
+                        context.window_manager.fast_sketch.insert_radius = float(radius)
 
             if event.value == "RELEASE":
                 context.window_manager.fast_sketch.is_inserting = event.alt
@@ -299,39 +299,17 @@ class FastSketchToolOperator(bpy.types.Operator):
             # ============================ delete ============================
             # delete all selected nodes
             if context.object and context.object.fast_sketch_properties.is_fast_sketch:
-                active_index = context.object.fast_sketch_properties.active_index
-                tubes = context.object.fast_sketch_properties.tubes
-                has_selected = False
-                for tube_index, tube in enumerate(tubes):
-                    if 0 <= active_index != tube_index:
-                        continue
-                    for node in tube.nodes:
-                        if node.active:
-                            has_selected = True
-                            break
-                if has_selected:
-                    bpy.ops.ed.undo_push()
-                    for tube_index, tube in enumerate(tubes):
-                        if 0 <= active_index != tube_index:
-                            continue
-                        for node_index in range(len(tube.nodes) - 1, -1, -1):
-                            node = tube.nodes[node_index]
-                            if node.active:
-                                tube.nodes.remove(node_index)
-
-                                # remove branch relationships
-                                if node_index == 0:
-                                    tube.parent_tube_index = -1
-                                    tube.parent_node_index = -1
-                                for related_tube in tubes:
-                                    if related_tube.parent_tube_index == tube_index:
-                                        if related_tube.parent_node_index == node_index:
-                                            related_tube.parent_tube_index = -1
-                                            related_tube.parent_node_index = -1
-                                        elif related_tube.parent_node_index > node_index:
-                                            related_tube.parent_node_index -= 1
-
-                    update_geometry()
+                arrays = get_sketch_arrays(context.object)
+                selected = get_selected_nodes(context.object)
+                if len(selected):
+                    undo_push()
+                    get_selection(context.object).difference_update(arrays.ids[selected].tolist())
+                    # branches from removed nodes are left pointing to a removed id
+                    remove_nodes(context.object, selected)
+
+                    tag_topology_changed(context.object)
+                    tag_selection_changed(context.object)
+                    request_geometry_update()
 
                     # update gizmo
                     context.area.tag_redraw()
@@ -341,10 +319,8 @@ class FastSketchToolOperator(bpy.types.Operator):
                 if context.object.fast_sketch_properties.active_index >= 0:
                     context.object.fast_sketch_properties.active_index = -1
                 else:
-                    tubes = context.object.fast_sketch_properties.tubes
-                    for tube in tubes:
-                        for node in tube.nodes:
-                            node.active = False
+                    get_selection(context.object).clear()
+                    tag_selection_changed(context.object)
                 context.area.tag_redraw()
 
         return {"PASS_THROUGH"}
@@ -360,8 +336,16 @@ class FastSketchToolOperator(bpy.types.Operator):
         start = self._select_box_start
         end = self._select_box_end
 
-        box_path = (start, (end.x, start.y), end, (start.x, end.y), start)
-        batch = batch_for_shader(shader, "LINE_STRIP", {"pos": box_path})
+        select_mode = context.window_manager.fast_sketch.select_mode
+        if select_mode == "LASSO":
+            path = self._select_path + self._select_path[:1]
+        elif select_mode == "CIRCLE":
+            radius = context.window_manager.fast_sketch.select_circle_radius
+            path = [(end.x + radius * math.cos(math.pi * i / 16), end.y + radius * math.sin(math.pi * i / 16))
+                    for i in range(33)]
+        else:
+            path = (start, (end.x, start.y), end, (start.x, end.y), start)
+        batch = batch_for_shader(shader, "LINE_STRIP", {"pos": path})
         shader.bind()
         shader.uniform_float("color", (1.0, 1.0, 1.0, 0.5))
         batch.draw(shader)
@@ -374,8 +358,8 @@ class FastSketchToolOperator(bpy.types.Operator):
 
         # get selected node
         active_obj = None
-        active_tube = None
-        active_node = None
+        # node array index of the selected node
+        active_node = -1
 
         context.window_manager.fast_sketch.insert_tube_index = -1
         context.window_manager.fast_sketch.insert_node_index = -1
@@ -384,33 +368,23 @@ class FastSketchToolOperator(bpy.types.Operator):
             active_obj = context.object
 
         if active_obj:
-            active_index = context.object.fast_sketch_properties.active_index
-            tubes = context.object.fast_sketch_properties.tubes
-            for tube_index, tube in enumerate(tubes):
-                if 0 <= active_index != tube_index:
-                    continue
-                for node_index, node in enumerate(tube.nodes):
-                    if node.active:
-                        context.window_manager.fast_sketch.insert_tube_index = tube_index
-                        context.window_manager.fast_sketch.insert_node_index = node_index
-                        active_tube = tube
-                        active_node = node
-                        break
-                if active_node:
-                    break
-
-            if not active_node and active_obj.fast_sketch_properties.active_index >= 0:
-                tubes = active_obj.fast_sketch_properties.tubes
-                active_tube = tubes[active_obj.fast_sketch_properties.active_index]
-                context.window_manager.fast_sketch.insert_node_index = len(active_tube.nodes) - 1
-                tube_len = len(active_tube.nodes)
+            arrays = get_sketch_arrays(active_obj)
+            selected = get_selected_nodes(active_obj)
+            active_index = active_obj.fast_sketch_properties.active_index
+            if len(selected):
+                active_node = int(selected[0])
+                context.window_manager.fast_sketch.insert_tube_index = int(arrays.tube_indices[active_node])
+                context.window_manager.fast_sketch.insert_node_index = int(arrays.node_indices[active_node])
+            elif active_index >= 0:
+                tube_len = int(arrays.tube_offsets[active_index + 1] - arrays.tube_offsets[active_index])
+                context.window_manager.fast_sketch.insert_node_index = tube_len - 1
                 if tube_len > 0:
-                    active_node = active_tube.nodes[tube_len - 1]
+                    active_node = arrays.get_index(active_index, tube_len - 1)
 
         # get mouse clicked location
         depth_loc = (0, 0, 0)
-        if active_node:
-            depth_loc = active_obj.matrix_world @ active_node.location
+        if active_node >= 0:
+            depth_loc = active_obj.matrix_world @ mathutils.Vector(arrays.locations[active_node])
         region = context.region
         r3d = context.space_data.region_3d
         x, y = event.mouse_region_x, event.mouse_region_y
@@ -423,6 +397,10 @@ class FastSketchToolOperator(bpy.types.Operator):
         # ============================ dragging ============================
 
         if event.type in ("RIGHTMOUSE", "ESC"):
+            if self._drag_move:
+                end_interaction()
+                # the nodes stay where they were dragged to, the stroke ends here
+                flush_sketch_histories()
             if self._draw_handler is not None:
                 # cancel select box
                 bpy.types.SpaceView3D.draw_handler_remove(self._draw_handler, "WINDOW")
@@ -433,6 +411,10 @@ class FastSketchToolOperator(bpy.types.Operator):
 
         if event.type == "LEFTMOUSE":
             # mouse released
+            if self._drag_move:
+                end_interaction()
+                # one global undo step per stroke
+                flush_sketch_histories()
 
             if self._draw_handler is not None:
                 # end select box
@@ -442,43 +424,35 @@ class FastSketchToolOperator(bpy.types.Operator):
             if not self._mouse_moved:
                 # click select
                 if context.object and context.object.fast_sketch_properties.is_fast_sketch:
+                    selection = get_selection(context.object)
+                    arrays = get_sketch_arrays(context.object)
+                    active_index = context.object.fast_sketch_properties.active_index
                     if self._clicked_node_index >= 0:
-                        tubes = context.object.fast_sketch_properties.tubes
+                        clicked = arrays.get_index(self._clicked_tube_index, self._clicked_node_index)
+                        clicked_id = int(arrays.ids[clicked])
                         if event.ctrl:
-                            clicked_tube = tubes[self._clicked_tube_index]
-                            clicked_node = clicked_tube.nodes[self._clicked_node_index]
-                            clicked_node.active = not clicked_node.active
+                            if clicked_id in selection:
+                                selection.discard(clicked_id)
+                            else:
+                                selection.add(clicked_id)
+                        elif 0 <= active_index != self._clicked_tube_index:
+                            selection.difference_update(arrays.ids[arrays.tube_indices == active_index].tolist())
                         else:
-                            clicked_selected_tube_index = -1
-                            for tube_index, tube in enumerate(tubes):
-                                active_index = context.object.fast_sketch_properties.active_index
-                                if 0 <= active_index != tube_index:
-                                    continue
-                                for node_index, node in enumerate(tube.nodes):
-                                    is_target = tube_index == self._clicked_tube_index and node_index == self._clicked_node_index
-                                    if is_target:
-                                        if node.active:
-                                            clicked_selected_tube_index = tube_index
-                                        else:
-                                            node.active = True
-                                    else:
-                                        node.active = False
-                            if clicked_selected_tube_index >= 0:
-                                context.object.fast_sketch_properties.active_index = clicked_selected_tube_index
+                            clicked_was_selected = clicked_id in selection
+                            if active_index >= 0:
+                                selection.difference_update(arrays.ids[arrays.tube_indices == active_index].tolist())
+                            else:
+                                selection.clear()
+                            selection.add(clicked_id)
+                            if clicked_was_selected:
+                                context.object.fast_sketch_properties.active_index = self._clicked_tube_index
                     else:
                         # clicked on empty
-                        active_index = context.object.fast_sketch_properties.active_index
-                        tubes = context.object.fast_sketch_properties.tubes
-                        has_selected = False
-                        for tube_index, tube in enumerate(tubes):
-                            if 0 <= active_index != tube_index:
-                                continue
-                            for node in tube.nodes:
-                                if node.active:
-                                    has_selected = True
-                                    node.active = False
-                        if not has_selected:
+                        selected = get_selected_nodes(context.object)
+                        selection.difference_update(arrays.ids[selected].tolist())
+                        if not len(selected):
                             context.object.fast_sketch_properties.active_index = -1
+                    tag_selection_changed(context.object)
 
             # update gizmo
             context.area.tag_redraw()
@@ -488,35 +462,36 @@ class FastSketchToolOperator(bpy.types.Operator):
             if self._draw_handler is not None:
                 # ============================ select box ============================
                 self._select_box_end = mathutils.Vector((event.mouse_region_x, event.mouse_region_y))
+                self._select_path.append((event.mouse_region_x, event.mouse_region_y))
 
-                # select all nodes inside selection box
+                # select all nodes inside selection shape
                 if context.object and context.object.fast_sketch_properties.is_fast_sketch:
-                    active_index = context.object.fast_sketch_properties.active_index
-                    tubes = context.object.fast_sketch_properties.tubes
-
-                    if len(self._drag_start_state) == len(tubes):
-                        start = self._select_box_start
-                        end = self._select_box_end
-                        x0 = min(start.x, end.x)
-                        x1 = max(start.x, end.x)
-                        y0 = min(start.y, end.y)
-                        y1 = max(start.y, end.y)
-                        region = context.region
-                        r3d = context.space_data.region_3d
-                        obj_mat = context.object.matrix_world
-
-                        for tube_index, tube in enumerate(tubes):
-                            if 0 <= active_index != tube_index:
-                                continue
-                            tube_drag_start_state = self._drag_start_state[tube_index]
-                            if len(tube_drag_start_state) != len(tube.nodes):
-                                continue
-                            for node_index in range(0, len(tube.nodes), 1):
-                                node = tube.nodes[node_index]
-                                node.active = tube_drag_start_state[node_index]["active"] if event.ctrl else False
-                                p = location_3d_to_region_2d(region, r3d, obj_mat @ node.location)
-                                if x0 <= p.x <= x1 and y0 <= p.y <= y1:
-                                    node.active = True
+                    obj = context.object
+                    active_index = obj.fast_sketch_properties.active_index
+                    arrays = get_sketch_arrays(obj)
+
+                    if self._select_start_flags is not None and len(self._select_start_flags) == len(arrays):
+                        projection = get_node_projection(context, obj)
+                        select_mode = context.window_manager.fast_sketch.select_mode
+                        if select_mode == "LASSO":
+                            inside = points_in_lasso(projection.centers, self._select_path)
+                        elif select_mode == "CIRCLE":
+                            # circle select paints selection along the mouse path
+                            self._select_swept |= points_in_circle(
+                                projection.centers, self._select_box_end,
+                                context.window_manager.fast_sketch.select_circle_radius
+                            )
+                            inside = self._select_swept
+                        else:
+                            inside = points_in_box(projection.centers, self._select_box_start,
+                                                   self._select_box_end)
+                        flags = inside & projection.visible
+                        if event.ctrl:
+                            flags |= self._select_start_flags
+                        if active_index >= 0:
+                            flags = np.where(arrays.tube_indices == active_index, flags, self._select_flags)
+                        write_selection_flags(obj, flags)
+                        self._select_flags = flags
 
                 # update select box and gizmo
                 context.area.tag_redraw()
@@ -524,21 +499,24 @@ class FastSketchToolOperator(bpy.types.Operator):
             elif self._drag_move:
                 # ============================ drag move ============================
                 if context.object and context.object.fast_sketch_properties.is_fast_sketch:
-                    active_index = context.object.fast_sketch_properties.active_index
-                    tubes = context.object.fast_sketch_properties.tubes
+                    obj = context.object
+                    arrays = get_sketch_arrays(obj)
+                    selection = get_selection(obj)
 
                     # auto select the unselected dragging node
-                    if not self._mouse_moved \
-                            and self._clicked_node_index >= 0 \
-                            and not tubes[self._clicked_tube_index].nodes[self._clicked_node_index].active:
-                        for tube_index, tube in enumerate(tubes):
-                            for node_index, node in enumerate(tube.nodes):
-                                node.active = tube_index == self._clicked_tube_index and node_index == self._clicked_node_index
-
-                    # limit undo records num
+                    if not self._mouse_moved and self._clicked_node_index >= 0:
+                        clicked_id = int(arrays.ids[arrays.get_index(self._clicked_tube_index,
+                                                                     self._clicked_node_index)])
+                        if clicked_id not in selection:
+                            selection.clear()
+                            selection.add(clicked_id)
+                            tag_selection_changed(obj)
+
+                    # a pause starts a new stroke
                     now = time.time()
                     if now - FastSketchToolOperator._drag_input_last_timestamp > 0.3:
-                        bpy.ops.ed.undo_push()
+                        end_sketch_step(context.object)
+                        begin_sketch_step(context.object)
                     FastSketchToolOperator._drag_input_last_timestamp = now
 
                     # get mouse drag move vector
@@ -548,31 +526,67 @@ class FastSketchToolOperator(bpy.types.Operator):
                     mouse_loc = region_2d_to_location_3d(region, r3d, (x, y), self._drag_start_depth)
                     det = mouse_loc - self._drag_start_loc
 
-                    for tube_index, tube in enumerate(tubes):
-                        if 0 <= active_index != tube_index:
-                            continue
-
-                        for node_index in range(0, len(tube.nodes), 1):
-                            node = tube.nodes[node_index]
-                            if node.active:
-                                drag_start_state = self._drag_start_state[tube_index][node_index]
-                                location = drag_start_state["location"]
-                                location = self._drag_start_mat @ location
-                                location = location + det
-                                location = self._drag_start_inv_mat @ location
-                                node.location = location
-                                update_branch(tube_index, node_index)
+                    if self._drag_start_locations is not None and len(self._drag_start_locations) == len(arrays):
+                        moved = np.zeros(len(arrays), dtype=bool)
+                        moved[get_selected_nodes(obj)] = True
+                        mat = np.array(self._drag_start_mat)
+                        inv_mat = np.array(self._drag_start_inv_mat)
+                        world = self._drag_start_locations[moved] @ mat[:3, :3].T + mat[:3, 3] + np.array(det)
+                        locations = arrays.locations.copy()
+                        locations[moved] = world @ inv_mat[:3, :3].T + inv_mat[:3, 3]
+                        write_node_arrays(obj, arrays, moved, locations, arrays.radii.copy())
 
-                        update_geometry()
+                    begin_interaction(hold=True)
+                    request_geometry_update()
 
-                        # update gizmo
-                        context.area.tag_redraw()
+                    # update gizmo
+                    context.area.tag_redraw()
 
             self._mouse_moved = True
 
         return {"RUNNING_MODAL"}
 
 
+class FastSketchUndoOperator(bpy.types.Operator):
+    bl_idname = "fast_sketch.undo"
+    bl_label = "Fast Sketch Undo"
+
+    def invoke(self, context, event):
+        obj = context.object
+        if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
+            return {"PASS_THROUGH"}
+        end_sketch_step(obj)
+        step = get_sketch_history(obj).pop_undo()
+        if step is None:
+            # fall back to global undo
+            return {"PASS_THROUGH"}
+        write_node_values(obj, step.ids, step.old_locations, step.old_radii)
+        request_geometry_update(obj)
+        # update gizmo
+        context.area.tag_redraw()
+        return {"FINISHED"}
+
+
+class FastSketchRedoOperator(bpy.types.Operator):
+    bl_idname = "fast_sketch.redo"
+    bl_label = "Fast Sketch Redo"
+
+    def invoke(self, context, event):
+        obj = context.object
+        if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
+            return {"PASS_THROUGH"}
+        end_sketch_step(obj)
+        step = get_sketch_history(obj).pop_redo()
+        if step is None:
+            # fall back to global redo
+            return {"PASS_THROUGH"}
+        write_node_values(obj, step.ids, step.new_locations, step.new_radii)
+        request_geometry_update(obj)
+        # update gizmo
+        context.area.tag_redraw()
+        return {"FINISHED"}
+
+
 class FastSketchTool(bpy.types.WorkSpaceTool):
     bl_space_type = "VIEW_3D"
     bl_context_mode = "OBJECT"
@@ -605,4 +619,13 @@ class FastSketchTool(bpy.types.WorkSpaceTool):
         ("fast_sketch.tool", {"type": "RIGHT_SHIFT", "value": "RELEASE"}, None),
         ("fast_sketch.tool", {"type": "DEL", "value": "PRESS"}, None),
         ("fast_sketch.tool", {"type": "ESC", "value": "PRESS"}, None),
+        ("fast_sketch.undo", {"type": "Z", "value": "PRESS", "ctrl": True}, None),
+        ("fast_sketch.redo", {"type": "Z", "value": "PRESS", "ctrl": True, "shift": True}, None),
     )
+
+    @staticmethod
+    def draw_settings(context, layout, tool):
+        props = context.window_manager.fast_sketch
+        layout.prop(props, "select_mode", expand=True)
+        if props.select_mode == "CIRCLE":
+            layout.prop(props, "select_circle_radius")
@@ -1,7 +1,17 @@
+import os
+import zipfile
+
 import bpy
+import numpy as np
+from bpy_extras.io_utils import ImportHelper, ExportHelper
 
-from .misc import replace_join_nodes_with_boolean_nodes
-from .update import update_geometry
+from .background import get_bake, get_bake_object, start_bake, finish_bake, swap_in_bake
+from .bake import bake_sketch, load_cached_bake, get_bake_key
+from .misc import new_sketch_id
+from .runtime import tag_topology_changed, get_node_id_map, get_sketch_arrays
+from .sketch_file import write_sketch_file, read_sketch_file, read_armature_sketch, create_sketch_object
+from .storage import remove_tube_nodes
+from .update import request_geometry_update, update_mirror, undo_push, finish_interaction, flush_geometry_updates
 
 
 class FastSketchTubeList(bpy.types.UIList):
@@ -30,8 +40,18 @@ class FastSketchPanel(bpy.types.Panel):
         fast_sketch = context.object.fast_sketch_properties
         layout = self.layout
         layout.prop(fast_sketch, "method")
-        if fast_sketch.method == "Geometry Node":
+        if fast_sketch.method in ("Geometry Node", "Attribute Geometry Node", "Mesh"):
             layout.prop(fast_sketch, "segments")
+        if fast_sketch.method in ("Geometry Node", "Mesh"):
+            layout.prop(fast_sketch, "use_adaptive_segments")
+            if fast_sketch.use_adaptive_segments:
+                col = layout.column(align=True)
+                col.prop(fast_sketch, "min_segments")
+                col.prop(fast_sketch, "use_screen_size")
+                if fast_sketch.use_screen_size:
+                    col.prop(fast_sketch, "detail_pixels")
+                else:
+                    col.prop(fast_sketch, "detail_size")
         if fast_sketch.method == "Skin Modifier":
             layout.prop(fast_sketch, "sub_surf_levels")
         row = layout.row(align=True)
@@ -55,8 +75,23 @@ class FastSketchPanel(bpy.types.Panel):
         col.operator("fast_sketch.remove_tube", icon="REMOVE", text="")
         layout.separator()
         layout.operator("fast_sketch.create_armature", text="Create Armature", icon="OUTLINER_OB_ARMATURE")
-        layout.prop(fast_sketch, "merge_meshes")
-        layout.operator("fast_sketch.bake", text="Bake!", icon="CHECKMARK")
+        layout.prop(fast_sketch, "storage")
+        layout.prop(fast_sketch, "bake_method")
+        if fast_sketch.bake_method == "Voxel":
+            col = layout.column(align=True)
+            col.prop(fast_sketch, "voxel_size")
+            col.prop(fast_sketch, "blend_radius")
+        else:
+            layout.prop(fast_sketch, "merge_meshes")
+        bake = get_bake(context.object)
+        if bake is None:
+            row = layout.row(align=True)
+            row.operator("fast_sketch.bake", text="Bake!", icon="CHECKMARK")
+            row.operator("fast_sketch.bake_background", text="In Background", icon="TIME")
+        else:
+            row = layout.row(align=True)
+            row.label(text="Baking: %s, %ds" % (bake.stage, bake.get_elapsed_time()), icon="TIME")
+            row.operator("fast_sketch.cancel_bake", text="", icon="CANCEL")
 
 
 class FastSketchBakeOperator(bpy.types.Operator):
@@ -64,46 +99,88 @@ class FastSketchBakeOperator(bpy.types.Operator):
     bl_label = "Fast Sketch Bake"
 
     def execute(self, context):
-        bpy.ops.ed.undo_push()
+        # the undo step and the bake should not get the reduced geometry of a recent interaction
+        finish_interaction()
+        undo_push()
+        self.report({"INFO"}, bake_sketch(context.object))
+        return {'FINISHED'}
+
 
+class FastSketchBackgroundBakeOperator(bpy.types.Operator):
+    bl_idname = "fast_sketch.bake_background"
+    bl_label = "Fast Sketch Bake in Background"
+    bl_description = "Bake a copy of the sketch in a separate Blender process and replace the sketch when done"
+
+    _bake = None
+    _timer = None
+
+    @classmethod
+    def poll(cls, context):
         obj = context.object
-        obj.fast_sketch_properties.is_fast_sketch = False
-
-        merge_meshes = obj.fast_sketch_properties.merge_meshes
-
-        if obj.modifiers.get("Fast Sketch Mesh"):
-            replace_join_nodes_with_boolean_nodes(merge_meshes)
-            bpy.ops.object.modifier_apply(modifier="Fast Sketch Mesh")
-
-        if obj.modifiers.get("Fast Sketch Skin"):
-            bpy.ops.object.modifier_apply(modifier="Fast Sketch Skin")
-
-        if obj.modifiers.get("Fast Sketch Sub Surf"):
-            bpy.ops.object.modifier_apply(modifier="Fast Sketch Sub Surf")
-
-        if merge_meshes and obj.fast_sketch_properties.method == "Skin Modifier":
-            # remove internal vertices
-            geo_nodes = obj.modifiers.new("Fast Sketch Boolean Union", "NODES")
-            obj.modifiers.move(len(obj.modifiers) - 1, 0)
-            tree = bpy.data.node_groups.new("Geometry Nodes", "GeometryNodeTree")
-            geo_nodes.node_group = tree
-            # tree.inputs.new("NodeSocketGeometry", "Geometry")
-            # tree.outputs.new("NodeSocketGeometry", "Geometry")
-            tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='INPUT')
-            tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='OUTPUT')
-            input_node = tree.nodes.new("NodeGroupInput")
-            output_node = tree.nodes.new("NodeGroupOutput")
-            bool_node = tree.nodes.new(type="GeometryNodeMeshBoolean")
-            bool_node.operation = "UNION"
-            bool_node.solver = "EXACT"
-            bool_node.inputs[2].default_value = True
-            tree.links.new(input_node.outputs[0], bool_node.inputs["Mesh 2"])
-            tree.links.new(bool_node.outputs[0], output_node.inputs[0])
-            bpy.ops.object.modifier_apply(modifier="Fast Sketch Boolean Union")
-
-        if obj.modifiers.get("Fast Sketch Mirror"):
-            bpy.ops.object.modifier_apply(modifier="Fast Sketch Mirror")
+        return obj is not None and obj.fast_sketch_properties.is_fast_sketch and get_bake(obj) is None
+
+    def execute(self, context):
+        # unchanged sketches are swapped in right away
+        finish_interaction()
+        undo_push()
+        if load_cached_bake(context.object):
+            self.report({"INFO"}, "Baked from cache")
+            return {'FINISHED'}
+        try:
+            self._bake = start_bake(context.object)
+        except Exception as e:
+            self.report({"ERROR"}, "Can not start the bake: %s" % e)
+            return {'CANCELLED'}
+        self._timer = context.window_manager.event_timer_add(0.25, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type != "TIMER":
+            return {'PASS_THROUGH'}
+        # update progress
+        for area in context.screen.areas:
+            if area.type == "VIEW_3D":
+                area.tag_redraw()
+        bake = self._bake
+        exit_code = bake.poll()
+        if exit_code is None and not bake.cancelled:
+            return {'PASS_THROUGH'}
+
+        context.window_manager.event_timer_remove(self._timer)
+        try:
+            if bake.cancelled:
+                self.report({"INFO"}, "Bake cancelled")
+                return {'CANCELLED'}
+            if exit_code != 0:
+                self.report({"ERROR"}, "Bake failed: %s" % ("\n".join(bake.log) or exit_code))
+                return {'CANCELLED'}
+            obj = get_bake_object(bake)
+            if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
+                self.report({"WARNING"}, "Sketch %s is gone, the bake is discarded" % bake.object_name)
+                return {'CANCELLED'}
+            if get_bake_key(obj, get_sketch_arrays(obj)) != bake.bake_key:
+                # the edits made while baking are kept, baking again reuses the cached parts of the old bake
+                self.report({"WARNING"}, "Sketch %s changed while baking, the bake is discarded" % obj.name)
+                return {'CANCELLED'}
+            result = bake.read_result()
+            undo_push()
+            swap_in_bake(obj, result)
+            self.report({"INFO"}, "%s in %.1fs" % (bake.report, bake.get_elapsed_time()))
+            return {'FINISHED'}
+        finally:
+            finish_bake(bake)
+
+
+class FastSketchCancelBakeOperator(bpy.types.Operator):
+    bl_idname = "fast_sketch.cancel_bake"
+    bl_label = "Fast Sketch Cancel Bake"
 
+    def execute(self, context):
+        bake = get_bake(context.object) if context.object else None
+        if bake is None:
+            return {'CANCELLED'}
+        bake.cancel()
         return {'FINISHED'}
 
 
@@ -114,11 +191,14 @@ class FastSketchAddTubeOperator(bpy.types.Operator):
     def execute(self, context):
         tubes = context.object.fast_sketch_properties.tubes
 
-        bpy.ops.ed.undo_push()
+        undo_push()
+        tube_id = new_sketch_id(context.object)
         item = tubes.add()
         item.name = "Tube"
+        item.id = tube_id
         context.object.fast_sketch_properties.active_index = len(tubes) - 1
-        update_geometry()
+        tag_topology_changed(context.object)
+        request_geometry_update()
 
         # update gizmo
         bpy.context.region.tag_redraw()
@@ -134,19 +214,14 @@ class FastSketchRemoveTubeOperator(bpy.types.Operator):
         tubes = context.object.fast_sketch_properties.tubes
         tube_index = context.object.fast_sketch_properties.active_index
         if tube_index >= 0:
-            bpy.ops.ed.undo_push()
+            undo_push()
+            remove_tube_nodes(context.object, tube_index)
             tubes.remove(tube_index)
             context.object.fast_sketch_properties.active_index = min(tube_index, len(tubes) - 1)
 
-            # remove branch relationships
-            for sub_tube in tubes:
-                if sub_tube.parent_tube_index == tube_index:
-                    sub_tube.parent_tube_index = -1
-                    sub_tube.parent_node_index = -1
-                elif sub_tube.parent_tube_index > tube_index:
-                    sub_tube.parent_tube_index -= 1
-
-            update_geometry()
+            # branches from the removed tube are left pointing to removed node ids
+            tag_topology_changed(context.object)
+            request_geometry_update()
 
             # update gizmo
             bpy.context.region.tag_redraw()
@@ -159,7 +234,7 @@ class FastSketchCreateArmatureOperator(bpy.types.Operator):
     bl_label = "Fast Sketch Create Armature"
 
     def execute(self, context):
-        bpy.ops.ed.undo_push()
+        undo_push()
 
         armature = bpy.data.armatures.new('Armature')
         obj = bpy.data.objects.new('Armature', armature)
@@ -167,20 +242,25 @@ class FastSketchCreateArmatureOperator(bpy.types.Operator):
         obj.matrix_world = context.object.matrix_world
 
         tubes = context.object.fast_sketch_properties.tubes
+        id_map = get_node_id_map(context.object)
+        arrays = get_sketch_arrays(context.object)
 
         bpy.context.view_layer.objects.active = obj
         bpy.ops.object.mode_set(mode='EDIT')
 
         tube_bones = []
-        for tube in tubes:
+        for tube_index in range(len(tubes)):
             bones = []
             tube_bones.append(bones)
             prev_bone = None
-            if 0 <= tube.parent_tube_index < len(tube_bones):
-                prev_bone = tube_bones[tube.parent_tube_index][tube.parent_node_index]
-            for i in range(1, len(tube.nodes)):
-                start = tube.nodes[i - 1].location
-                end = tube.nodes[i].location
+            parent = id_map.get_parent(tube_index)
+            if parent is not None and parent[0] < tube_index and tube_bones[parent[0]]:
+                # the bone ending at the parent node, a tube of n nodes has n - 1 bones
+                parent_bones = tube_bones[parent[0]]
+                prev_bone = parent_bones[min(max(parent[1] - 1, 0), len(parent_bones) - 1)]
+            for i in range(arrays.tube_offsets[tube_index] + 1, arrays.tube_offsets[tube_index + 1]):
+                start = arrays.locations[i - 1]
+                end = arrays.locations[i]
                 bone = armature.edit_bones.new("Bone")
                 bone.head = start
                 bone.tail = end
@@ -192,3 +272,99 @@ class FastSketchCreateArmatureOperator(bpy.types.Operator):
         bpy.context.view_layer.update()
 
         return {'FINISHED'}
+
+
+class FastSketchCreateSketchFromArmatureOperator(bpy.types.Operator):
+    bl_idname = "fast_sketch.create_sketch_from_armature"
+    bl_label = "Fast Sketch from Armature"
+    bl_description = "Create a sketch with a tube along each bone chain of the selected armatures"
+    bl_options = {"REGISTER", "UNDO"}
+
+    radius_source: bpy.props.EnumProperty(
+        name="Radius",
+        items=[("ENVELOPE", "Envelope", "Use the head and tail radii of the bone envelopes"),
+               ("BBONE", "B-Bone Size", "Use the mean of the B-Bone display sizes")],
+        default="ENVELOPE"
+    )
+    radius_scale: bpy.props.FloatProperty(name="Radius Scale", default=1, min=0.001, soft_max=10)
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == "OBJECT" and any(obj.type == "ARMATURE" for obj in context.selected_objects)
+
+    def execute(self, context):
+        armatures = [obj for obj in context.selected_objects if obj.type == "ARMATURE" and obj.data.bones]
+        if not armatures:
+            self.report({"WARNING"}, "The selected armatures have no bones")
+            return {'CANCELLED'}
+        sketches = []
+        for armature in armatures:
+            data = read_armature_sketch(armature.data, self.radius_source, self.radius_scale)
+            data["matrix"] = np.array(armature.matrix_world, dtype=np.float32)
+            sketches.append(create_sketch_object(context, armature.name + " Sketch", data))
+        for obj in context.selected_objects:
+            obj.select_set(False)
+        for obj in sketches:
+            obj.select_set(True)
+            request_geometry_update(obj)
+            update_mirror(obj)
+        context.view_layer.objects.active = sketches[-1]
+        # the undo step pushed after this operator should hold the geometry
+        flush_geometry_updates()
+        return {'FINISHED'}
+
+
+class FastSketchExportOperator(bpy.types.Operator, ExportHelper):
+    bl_idname = "fast_sketch.export_sketch"
+    bl_label = "Export Fast Sketch"
+    bl_description = "Save the active sketch as arrays of node positions, radii, tube offsets and parent links"
+
+    filename_ext = ".npz"
+    filter_glob: bpy.props.StringProperty(default="*.npz", options={"HIDDEN"})
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None and context.object.fast_sketch_properties.is_fast_sketch
+
+    def execute(self, context):
+        write_sketch_file(self.filepath, context.object)
+        return {'FINISHED'}
+
+
+class FastSketchImportOperator(bpy.types.Operator, ImportHelper):
+    bl_idname = "fast_sketch.import_sketch"
+    bl_label = "Import Fast Sketch"
+    bl_description = "Create a sketch from a file written by Export Fast Sketch"
+    bl_options = {"REGISTER", "UNDO"}
+
+    filename_ext = ".npz"
+    filter_glob: bpy.props.StringProperty(default="*.npz", options={"HIDDEN"})
+
+    def execute(self, context):
+        try:
+            data = read_sketch_file(self.filepath)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            self.report({"ERROR"}, "Can not read %s: %s" % (self.filepath, e))
+            return {'CANCELLED'}
+        obj = create_sketch_object(context, os.path.splitext(os.path.basename(self.filepath))[0], data)
+        for selected in context.selected_objects:
+            selected.select_set(False)
+        obj.select_set(True)
+        context.view_layer.objects.active = obj
+        request_geometry_update(obj)
+        update_mirror(obj)
+        # the undo step pushed after this operator should hold the geometry
+        flush_geometry_updates()
+        return {'FINISHED'}
+
+
+def draw_import_menu(self, context):
+    self.layout.operator(FastSketchImportOperator.bl_idname, text="Fast Sketch (.npz)")
+
+
+def draw_export_menu(self, context):
+    self.layout.operator(FastSketchExportOperator.bl_idname, text="Fast Sketch (.npz)")
+
+
+def draw_convert_menu(self, context):
+    self.layout.operator(FastSketchCreateSketchFromArmatureOperator.bl_idname, text="Fast Sketch from Armature")
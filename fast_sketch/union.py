@@ -0,0 +1,96 @@
+import re
+import time
+
+import numpy as np
+
+from .runtime import get_sketch_arrays
+from .spatial import find_overlap_clusters
+
+
+def build_balanced_union(tree, sockets, x, y):
+    # union pairs level by level, so every boolean works on meshes of similar size
+    level = list(sockets)
+    depth = 0
+    while len(level) > 1:
+        depth += 1
+        next_level = []
+        for k in range(0, len(level) - 1, 2):
+            bool_node = tree.nodes.new(type="GeometryNodeMeshBoolean")
+            bool_node.select = False
+            bool_node.location = (x + depth * 200, y - k * 15)
+            bool_node.operation = "UNION"
+            bool_node.solver = "EXACT"
+            # hulls and the unions of hulls do not intersect themselves
+            bool_node.inputs["Self Intersection"].default_value = False
+            tree.links.new(level[k], bool_node.inputs["Mesh 2"])
+            tree.links.new(level[k + 1], bool_node.inputs["Mesh 2"])
+            next_level.append(bool_node.outputs["Mesh"])
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0], depth
+
+
+def plan_boolean_union(obj, merge_meshes, timings, modifier_name="Fast Sketch Mesh"):
+    # replace the joins of the Geometry Node tree with exact unions of the hulls that may overlap
+    # hulls whose balls' bounding boxes do not touch are only joined
+    # returns the stats and the clusters, as the output socket and the first and second balls of their hulls
+    tree = obj.modifiers.get(modifier_name).node_group
+    arrays = get_sketch_arrays(obj)
+
+    start_time = time.perf_counter()
+    sockets = []
+    first_nodes = []
+    second_nodes = []
+    for tube_index in range(len(arrays.tube_offsets) - 1):
+        tube_node = tree.nodes.get("Tube_%d" % tube_index)
+        if not tube_node:
+            continue
+        for link in tube_node.inputs["Geometry"].links:
+            match_obj = re.match(r'(Hull|Transform)_([0-9]+)_([0-9]+)', link.from_node.name)
+            if not match_obj:
+                continue
+            i = arrays.get_index(tube_index, int(match_obj.group(3)))
+            sockets.append(link.from_socket)
+            # a hull spans the ball before it, a single ball spans itself
+            first_nodes.append(i - 1 if match_obj.group(1) == "Hull" else i)
+            second_nodes.append(i)
+        tree.nodes.remove(tube_node)
+    first_nodes = np.array(first_nodes, dtype=np.int64)
+    second_nodes = np.array(second_nodes, dtype=np.int64)
+    radii = arrays.radii[:, np.newaxis]
+    mins = np.minimum(arrays.locations[first_nodes] - radii[first_nodes],
+                      arrays.locations[second_nodes] - radii[second_nodes])
+    maxs = np.maximum(arrays.locations[first_nodes] + radii[first_nodes],
+                      arrays.locations[second_nodes] + radii[second_nodes])
+    timings.append(("collect", time.perf_counter() - start_time))
+
+    start_time = time.perf_counter()
+    groups = None if merge_meshes else arrays.tube_indices[second_nodes]
+    clusters = find_overlap_clusters(mins, maxs, groups)
+    timings.append(("cluster", time.perf_counter() - start_time))
+
+    start_time = time.perf_counter()
+    join_node = tree.nodes["Join"]
+    for link in list(join_node.inputs["Geometry"].links):
+        tree.links.remove(link)
+    union_count = 0
+    max_depth = 0
+    y = 0
+    pieces = []
+    order = np.argsort(clusters, kind="stable")
+    for members in np.split(order, np.flatnonzero(np.diff(clusters[order])) + 1) if len(order) else ():
+        socket, depth = build_balanced_union(tree, [sockets[i] for i in members.tolist()], 400, y)
+        tree.links.new(socket, join_node.inputs["Geometry"])
+        pieces.append((socket, first_nodes[members], second_nodes[members]))
+        union_count += len(members) - 1
+        max_depth = max(max_depth, depth)
+        y -= len(members) * 15 + 30
+    timings.append(("plan", time.perf_counter() - start_time))
+
+    return {
+        "primitives": len(sockets),
+        "clusters": int(clusters.max()) + 1 if len(clusters) else 0,
+        "unions": union_count,
+        "depth": max_depth,
+    }, pieces
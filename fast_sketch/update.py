@@ -1,44 +1,327 @@
 import re
+import time
+import traceback
 
-import bmesh
 import bpy
+import numpy as np
 
+from .mesher import build_sketch_mesh, adaptive_segments, SegmentCache
+from .runtime import tag_sketch_changed, get_sketch_arrays, get_reload_version, get_preferences, \
+    get_view_node_radii, get_node_id_map, clear_sketch_histories, commit_sketch_step, commit_all_sketch_steps
 
-def update_geometry():
-    obj = bpy.context.object
+# capsule geometry shared by all sketches using the Mesh method
+segment_cache = SegmentCache(64 * 1024 * 1024)
+
+
+def update_geometry(obj=None):
+    if obj is None:
+        obj = bpy.context.object
     if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
         return
+    if is_interacting() and get_preferences().use_interaction_lod:
+        _interaction_objects[obj.name] = obj.session_uid
+    else:
+        _interaction_objects.pop(obj.name, None)
     method = obj.fast_sketch_properties.method
     if method == "Geometry Node":
-        skin = obj.modifiers.get("Fast Sketch Skin")
-        if skin:
-            obj.modifiers.remove(skin)
-        sub_surf = obj.modifiers.get("Fast Sketch Sub Surf")
-        if sub_surf:
-            obj.modifiers.remove(sub_surf)
-        build_geometry_node()
+        remove_skin_modifier(obj)
+        remove_geometry_node_modifier(obj, "Fast Sketch Attribute Mesh")
+        build_geometry_node(obj)
+    elif method == "Attribute Geometry Node":
+        remove_skin_modifier(obj)
+        remove_geometry_node_modifier(obj, "Fast Sketch Mesh")
+        build_attribute_geometry_node(obj)
     elif method == "Skin Modifier":
-        geo_nodes = obj.modifiers.get("Fast Sketch Mesh")
-        if geo_nodes:
-            node_group = geo_nodes.node_group
-            if node_group:
-                bpy.data.node_groups.remove(node_group)
-            obj.modifiers.remove(geo_nodes)
-        build_skin_modifier()
-
-
-def remove_link(tree, from_node_name, from_socket_name, to_node_name, to_socket_name):
-    for link in tree.links:
-        if link.from_node.name == from_node_name \
-                and link.from_socket.name == from_socket_name \
-                and link.to_node.name == to_node_name \
-                and link.to_socket.name == to_socket_name:
-            tree.links.remove(link)
-            return
-
-
-def build_geometry_node():
+        remove_geometry_node_modifier(obj, "Fast Sketch Mesh")
+        remove_geometry_node_modifier(obj, "Fast Sketch Attribute Mesh")
+        build_skin_modifier(obj)
+    elif method == "Mesh":
+        remove_skin_modifier(obj)
+        remove_geometry_node_modifier(obj, "Fast Sketch Mesh")
+        remove_geometry_node_modifier(obj, "Fast Sketch Attribute Mesh")
+        build_mesh(obj)
+
+
+# objects waiting for a geometry update, object name -> session uid
+_pending_updates = {}
+_last_update_time = 0.0
+
+
+def request_geometry_update(obj=None, changed=True):
+    # requests are merged and run once from a timer, the builders only touch what changed since the last build,
+    # so a merged update covers the changes of all requests
+    # changed is False for rebuilds of unchanged sketch data, such as new settings or quality
+    if obj is None:
+        obj = bpy.context.object
+    if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
+        return
+    # picking and drawing read the sketch data directly, so they see the change right away
+    if changed:
+        tag_sketch_changed(obj)
+    _pending_updates[obj.name] = obj.session_uid
+    if not bpy.app.timers.is_registered(_update_timer):
+        rate = get_preferences().max_update_rate
+        interval = 1 / rate if rate > 0 else 0
+        delay = max(0.0, _last_update_time + interval - time.perf_counter())
+        bpy.app.timers.register(_update_timer, first_interval=delay)
+
+
+def _run_pending_updates():
+    global _last_update_time
+    pending = list(_pending_updates.items())
+    _pending_updates.clear()
+    for name, session_uid in pending:
+        obj = bpy.data.objects.get(name)
+        if obj is None or obj.session_uid != session_uid:
+            continue
+        try:
+            update_geometry(obj)
+        except Exception:
+            traceback.print_exc()
+    _last_update_time = time.perf_counter()
+
+
+def _update_timer():
+    _run_pending_updates()
+    return None
+
+
+def flush_geometry_updates():
+    # run the pending updates now, for code that needs the generated geometry
+    if bpy.app.timers.is_registered(_update_timer):
+        bpy.app.timers.unregister(_update_timer)
+    _run_pending_updates()
+
+
+def undo_push():
+    # the undo step should hold geometry matching the sketch data
+    flush_geometry_updates()
+    # strokes recorded locally are part of this step now
+    clear_sketch_histories()
+    bpy.ops.ed.undo_push()
+
+
+def end_sketch_step(obj):
+    # a stroke that does not fit the memory budget of the sketch history goes into a global undo step
+    # with the strokes before it, instead of dropping the oldest strokes
+    if commit_sketch_step(obj):
+        undo_push()
+
+
+def flush_sketch_histories():
+    # strokes recorded only in the sketch histories go into a global undo step, so undo outside the tool sees them
+    if commit_all_sketch_steps():
+        undo_push()
+
+
+# sketches built at interaction quality, object name -> session uid
+_interaction_objects = {}
+_interaction_hold = False
+_interaction_deadline = 0.0
+
+
+def is_interacting():
+    return _interaction_hold or time.perf_counter() < _interaction_deadline
+
+
+def begin_interaction(hold=False):
+    # hold lasts until end_interaction, otherwise the interaction ends after the idle time
+    global _interaction_hold, _interaction_deadline
+    if hold:
+        _interaction_hold = True
+    else:
+        _interaction_deadline = time.perf_counter() + get_preferences().interaction_idle_time
+    if not bpy.app.timers.is_registered(_interaction_timer):
+        bpy.app.timers.register(_interaction_timer, first_interval=get_preferences().interaction_idle_time)
+
+
+def end_interaction():
+    global _interaction_hold
+    _interaction_hold = False
+
+
+def finish_interaction():
+    # end the interaction now instead of after the idle time, call flush_geometry_updates for the full quality geometry
+    global _interaction_hold, _interaction_deadline
+    _interaction_hold = False
+    _interaction_deadline = 0.0
+    _rebuild_interaction_objects()
+
+
+def _rebuild_interaction_objects():
+    # rebuild at full quality
+    pending = list(_interaction_objects.items())
+    _interaction_objects.clear()
+    for name, session_uid in pending:
+        obj = bpy.data.objects.get(name)
+        if obj is not None and obj.session_uid == session_uid:
+            request_geometry_update(obj, changed=False)
+
+
+def _interaction_timer():
+    if is_interacting():
+        return max(_interaction_deadline - time.perf_counter(), 0.05)
+    _rebuild_interaction_objects()
+    # wheel strokes have no release event, they end when the interaction does
+    flush_sketch_histories()
+    return None
+
+
+# sketches being built for a bake, object name -> session uid
+_bake_objects = {}
+
+
+def is_baking(obj):
+    return _bake_objects.get(obj.name) == obj.session_uid
+
+
+def build_bake_geometry(obj):
+    # bakes are built at full quality, with adaptive segments sized in world space, so they do not depend on the views
+    _bake_objects[obj.name] = obj.session_uid
+    try:
+        update_geometry(obj)
+        update_mirror(obj)
+    finally:
+        _bake_objects.pop(obj.name, None)
+
+
+def get_segments(obj, bake=False):
+    segments = obj.fast_sketch_properties.segments
+    if obj.name in _interaction_objects and not bake and not is_baking(obj):
+        return min(segments, get_preferences().interaction_segments)
+    return segments
+
+
+def get_sub_surf_levels(obj, bake=False):
+    levels = obj.fast_sketch_properties.sub_surf_levels
+    if obj.name in _interaction_objects and not bake and not is_baking(obj):
+        return min(levels, get_preferences().interaction_sub_surf_levels)
+    return levels
+
+
+def get_node_segments(obj, arrays, bake=False):
+    # segments of every sketch node, Segments is the upper bound when adaptive
+    # bake gives the segments of build_bake_geometry
+    fast_sketch = obj.fast_sketch_properties
+    bake = bake or is_baking(obj)
+    segments = get_segments(obj, bake)
+    if not fast_sketch.use_adaptive_segments:
+        return np.full(len(arrays), segments, dtype=np.int32)
+    min_segments = min(fast_sketch.min_segments, segments)
+    if fast_sketch.use_screen_size and not bake:
+        radii = get_view_node_radii(obj, arrays)
+        if radii is not None:
+            return adaptive_segments(radii, fast_sketch.detail_pixels, min_segments, segments)
+    scale = obj.matrix_world.to_scale()
+    radii = arrays.radii * max(abs(scale.x), abs(scale.y), abs(scale.z))
+    return adaptive_segments(radii, fast_sketch.detail_size, min_segments, segments)
+
+
+@bpy.app.handlers.persistent
+def sketch_geometry_reloaded_handler(*args):
+    # undo steps may hold geometry built at interaction quality
     obj = bpy.context.object
+    if obj is not None and obj.fast_sketch_properties.is_fast_sketch:
+        request_geometry_update(obj, changed=False)
+
+
+def remove_skin_modifier(obj):
+    skin = obj.modifiers.get("Fast Sketch Skin")
+    if skin:
+        obj.modifiers.remove(skin)
+    sub_surf = obj.modifiers.get("Fast Sketch Sub Surf")
+    if sub_surf:
+        obj.modifiers.remove(sub_surf)
+
+
+def remove_geometry_node_modifier(obj, name):
+    geo_nodes = obj.modifiers.get(name)
+    if geo_nodes:
+        node_group = geo_nodes.node_group
+        if node_group:
+            bpy.data.node_groups.remove(node_group)
+        obj.modifiers.remove(geo_nodes)
+
+
+def build_link_index(tree):
+    return {(link.from_node.name, link.from_socket.name, link.to_node.name, link.to_socket.name): link
+            for link in tree.links}
+
+
+def remove_link(tree, link_index, from_node_name, from_socket_name, to_node_name, to_socket_name):
+    link = link_index.pop((from_node_name, from_socket_name, to_node_name, to_socket_name), None)
+    if link:
+        tree.links.remove(link)
+
+
+def set_socket_value(socket, value):
+    # writing a socket re-evaluates the tree even if the value is the same
+    old_value = socket.default_value
+    if isinstance(value, (tuple, list)):
+        changed = tuple(old_value) != tuple(value)
+    else:
+        changed = old_value != value
+    if changed:
+        socket.default_value = value
+
+
+def set_node_location(node, x, y):
+    if node.location.x != x or node.location.y != y:
+        node.location = (x, y)
+
+
+# node values written by the last build of each tree, keyed by tree session uid
+_geometry_node_states = {}
+
+
+class GeometryNodeState:
+    def __init__(self, arrays, spheres, sphere_names):
+        self.reload_version = get_reload_version()
+        self.tube_offsets = arrays.tube_offsets.copy()
+        self.locations = arrays.locations.copy()
+        self.radii = arrays.radii.copy()
+        self.spheres = spheres.copy()
+        self.sphere_names = sphere_names
+
+    def get_tube(self, tube_index):
+        if tube_index + 1 >= len(self.tube_offsets):
+            return None
+        start = self.tube_offsets[tube_index]
+        end = self.tube_offsets[tube_index + 1]
+        return self.locations[start:end], self.radii[start:end], self.spheres[start:end]
+
+
+def get_geometry_node_state(tree):
+    state = _geometry_node_states.get(tree.session_uid)
+    # undo and file loading may bring back an older tree
+    if state and state.reload_version == get_reload_version():
+        return state
+    return None
+
+
+def remove_sketch_nodes(tree, tube_index, start, end):
+    for node_index in range(start, end):
+        for prefix in ("Transform", "Join", "Hull"):
+            node = tree.nodes.get("%s_%d_%d" % (prefix, tube_index, node_index))
+            if node:
+                tree.nodes.remove(node)
+
+
+def get_sphere_node(tree, segments, max_segments):
+    # balls at full resolution share the Sphere node, adaptive resolutions get one node each
+    name = "Sphere" if segments == max_segments else "Sphere_%d" % segments
+    sphere_node = tree.nodes.get(name)
+    if not sphere_node:
+        sphere_node = tree.nodes.new(type="GeometryNodeMeshUVSphere")
+        sphere_node.name = name
+        sphere_node.select = False
+        sphere_node.location = (-400, (max_segments - segments) * 200)
+    set_socket_value(sphere_node.inputs["Segments"], max(segments * 2, 3))
+    set_socket_value(sphere_node.inputs["Rings"], max(segments, 2))
+    return sphere_node
+
+
+def build_geometry_node(obj):
 
     # create base nodes
     geo_nodes = obj.modifiers.get("Fast Sketch Mesh")
@@ -68,41 +351,96 @@ def build_geometry_node():
         obj.modifiers.move(len(obj.modifiers) - 1, 0)
 
     tree = geo_nodes.node_group
+    state = get_geometry_node_state(tree)
+    arrays = get_sketch_arrays(obj)
 
     # segments
-    segments = obj.fast_sketch_properties.segments
-    sphere_node = tree.nodes["Sphere"]
-    sphere_node.inputs["Segments"].default_value = max(segments * 2, 3)
-    sphere_node.inputs["Rings"].default_value = max(segments, 2)
+    segments = get_segments(obj)
+    node_segments = get_node_segments(obj, arrays)
+    sphere_nodes = {value: get_sphere_node(tree, value, segments) for value in np.unique(node_segments).tolist()}
+    get_sphere_node(tree, segments, segments)
+    # zero for the Sphere node, so changing Segments does not relink every ball
+    node_spheres = np.where(node_segments == segments, 0, node_segments)
 
     # output
     output_node = tree.nodes["Output"]
-    output_node.location.x = 800
-    tree.links.new(tree.nodes["Join"].outputs["Geometry"], output_node.inputs["Geometry"])
+    set_node_location(output_node, 800, output_node.location.y)
+    if not output_node.inputs["Geometry"].is_linked:
+        tree.links.new(tree.nodes["Join"].outputs["Geometry"], output_node.inputs["Geometry"])
 
     # remove useless nodes
     tubes = obj.fast_sketch_properties.tubes
     tubes_len = len(tubes)
-    for node in tree.nodes:
-        match_obj = re.match(r'Tube_([0-9]+)', node.name)
-        if match_obj:
-            tube_index = int(match_obj.group(1))
-            if tube_index >= tubes_len:
-                tree.nodes.remove(node)
-        else:
-            match_obj = re.match(r'(Transform|Join|Hull)_([0-9]+)_([0-9]+)', node.name)
+    if state is None:
+        for node in tree.nodes:
+            match_obj = re.match(r'Tube_([0-9]+)', node.name)
             if match_obj:
-                tube_index = int(match_obj.group(2))
+                tube_index = int(match_obj.group(1))
                 if tube_index >= tubes_len:
                     tree.nodes.remove(node)
-                else:
-                    node_index = int(match_obj.group(3))
-                    if node_index >= len(tubes[tube_index].nodes):
+            else:
+                match_obj = re.match(r'(Transform|Join|Hull)_([0-9]+)_([0-9]+)', node.name)
+                if match_obj:
+                    tube_index = int(match_obj.group(2))
+                    if tube_index >= tubes_len:
                         tree.nodes.remove(node)
+                    else:
+                        node_index = int(match_obj.group(3))
+                        if node_index >= arrays.tube_offsets[tube_index + 1] - arrays.tube_offsets[tube_index]:
+                            tree.nodes.remove(node)
+    else:
+        # only the nodes past the new ends of the tubes need to be removed
+        for tube_index in range(len(state.tube_offsets) - 1):
+            old_len = state.tube_offsets[tube_index + 1] - state.tube_offsets[tube_index]
+            if tube_index >= tubes_len:
+                tube_node = tree.nodes.get("Tube_%d" % tube_index)
+                if tube_node:
+                    tree.nodes.remove(tube_node)
+                remove_sketch_nodes(tree, tube_index, 0, old_len)
+            else:
+                remove_sketch_nodes(tree, tube_index,
+                                    arrays.tube_offsets[tube_index + 1] - arrays.tube_offsets[tube_index], old_len)
 
     # create nodes
+    link_index = None
+    # node editor layout only moves when the node count of a previous tube changes
+    layout_dirty = state is None
     count = 0
-    for tube_index, tube in enumerate(obj.fast_sketch_properties.tubes):
+    for tube_index in range(tubes_len):
+        start = arrays.tube_offsets[tube_index]
+        end = arrays.tube_offsets[tube_index + 1]
+        old_tube = state.get_tube(tube_index) if state else None
+
+        if old_tube is not None and len(old_tube[1]) == end - start:
+            # same topology, only write the values that changed
+            old_locations, old_radii, old_spheres = old_tube
+            changed = np.any(old_locations != arrays.locations[start:end], axis=1) \
+                | (old_radii != arrays.radii[start:end])
+            for node_index in np.flatnonzero(changed):
+                transform_node = tree.nodes["Transform_%d_%d" % (tube_index, node_index)]
+                radius = float(arrays.radii[start + node_index])
+                transform_node.inputs["Translation"].default_value = arrays.locations[start + node_index].tolist()
+                transform_node.inputs["Scale"].default_value = (radius, radius, radius)
+            for node_index in np.flatnonzero(old_spheres != node_spheres[start:end]):
+                # linking replaces the old sphere
+                tree.links.new(sphere_nodes[int(node_segments[start + node_index])].outputs["Mesh"],
+                               tree.nodes["Transform_%d_%d" % (tube_index, node_index)].inputs["Geometry"])
+            if layout_dirty:
+                set_node_location(tree.nodes["Tube_%d" % tube_index], 400, count * -30)
+                for node_index in range(end - start):
+                    set_node_location(tree.nodes["Transform_%d_%d" % (tube_index, node_index)], -200, count * -30)
+                    if node_index > 0:
+                        set_node_location(tree.nodes["Join_%d_%d" % (tube_index, node_index)], 0, count * -30 + 30)
+                        set_node_location(tree.nodes["Hull_%d_%d" % (tube_index, node_index)], 200, count * -30 + 30)
+                    count += 1
+            else:
+                count += end - start
+            continue
+
+        layout_dirty = True
+        if link_index is None:
+            link_index = build_link_index(tree)
+
         tube_node_name = "Tube_%d" % tube_index
         tube_node = tree.nodes.get(tube_node_name)
         if not tube_node:
@@ -114,13 +452,12 @@ def build_geometry_node():
                 tube_node.outputs["Geometry"],
                 tree.nodes["Join"].inputs["Geometry"]
             )
-        tube_node.location.x = 400
-        tube_node.location.y = count * -30
+        set_node_location(tube_node, 400, count * -30)
 
-        if len(tube.nodes) > 1:
-            remove_link(tree, "Transform_%d_0" % tube_index, "Geometry", "Tube_%d" % tube_index, "Geometry")
+        if end - start > 1:
+            remove_link(tree, link_index, "Transform_%d_0" % tube_index, "Geometry", "Tube_%d" % tube_index, "Geometry")
 
-        for node_index, node in enumerate(tube.nodes):
+        for node_index in range(end - start):
             transform_node_name = "Transform_%d_%d" % (tube_index, node_index)
             transform_node = tree.nodes.get(transform_node_name)
             if not transform_node:
@@ -128,15 +465,18 @@ def build_geometry_node():
                 transform_node.name = transform_node_name
                 transform_node.label = "Transform / Node %d" % node_index
                 transform_node.select = False
+            sphere_node = sphere_nodes[int(node_segments[start + node_index])]
+            if (sphere_node.name, "Mesh", transform_node_name, "Geometry") not in link_index:
                 tree.links.new(sphere_node.outputs["Mesh"], transform_node.inputs["Geometry"])
-            if len(tube.nodes) == 1:
-                tree.links.new(transform_node.outputs["Geometry"], tube_node.inputs["Geometry"])
-            else:
-                remove_link(tree, transform_node_name, "Geometry", tube_node_name, "Geometry")
-            transform_node.inputs["Translation"].default_value = node.location
-            transform_node.inputs["Scale"].default_value = (node.radius, node.radius, node.radius)
-            transform_node.location.x = -200
-            transform_node.location.y = count * -30
+            if end - start == 1:
+                if not transform_node.outputs["Geometry"].is_linked:
+                    tree.links.new(transform_node.outputs["Geometry"], tube_node.inputs["Geometry"])
+            elif state is None:
+                remove_link(tree, link_index, transform_node_name, "Geometry", tube_node_name, "Geometry")
+            radius = float(arrays.radii[start + node_index])
+            set_socket_value(transform_node.inputs["Translation"], arrays.locations[start + node_index].tolist())
+            set_socket_value(transform_node.inputs["Scale"], (radius, radius, radius))
+            set_node_location(transform_node, -200, count * -30)
 
             if node_index > 0:
                 join_node_name = "Join_%d_%d" % (tube_index, node_index)
@@ -154,8 +494,7 @@ def build_geometry_node():
                         tree.nodes["Transform_%d_%d" % (tube_index, node_index)].outputs["Geometry"],
                         join_node.inputs["Geometry"]
                     )
-                join_node.location.x = 0
-                join_node.location.y = count * -30 + 30
+                set_node_location(join_node, 0, count * -30 + 30)
                 hull_node_name = "Hull_%d_%d" % (tube_index, node_index)
                 hull_node = tree.nodes.get(hull_node_name)
                 if not hull_node:
@@ -164,14 +503,192 @@ def build_geometry_node():
                     hull_node.select = False
                     tree.links.new(join_node.outputs["Geometry"], hull_node.inputs["Geometry"])
                     tree.links.new(hull_node.outputs["Convex Hull"], tube_node.inputs["Geometry"])
-                hull_node.location.x = 200
-                hull_node.location.y = join_node.location.y
+                set_node_location(hull_node, 200, join_node.location.y)
 
             count += 1
 
+    # remove spheres of resolutions no longer used
+    sphere_names = {sphere_node.name for sphere_node in sphere_nodes.values()}
+    if state is None:
+        old_sphere_names = [node.name for node in tree.nodes if re.match(r'Sphere_[0-9]+$', node.name)]
+    else:
+        old_sphere_names = state.sphere_names
+    for name in old_sphere_names:
+        if name not in sphere_names and name in tree.nodes:
+            tree.nodes.remove(tree.nodes[name])
 
-def build_skin_modifier():
-    obj = bpy.context.object
+    _geometry_node_states[tree.session_uid] = GeometryNodeState(arrays, node_spheres, sphere_names)
+
+
+def get_skeleton(obj, arrays):
+    # branch tubes share their first node with the parent node, so each vertex is owned by one sketch node
+    id_map = get_node_id_map(obj)
+    node_vert_indices = np.empty(len(arrays), dtype=np.int32)
+    owned = np.ones(len(arrays), dtype=bool)
+    vertex_count = 0
+    for tube_index in range(len(arrays.tube_offsets) - 1):
+        start = arrays.tube_offsets[tube_index]
+        end = arrays.tube_offsets[tube_index + 1]
+        if start == end:
+            continue
+        own_start = start
+        parent = id_map.get_parent(tube_index)
+        if parent is not None and parent[0] < tube_index:
+            node_vert_indices[start] = node_vert_indices[arrays.tube_offsets[parent[0]] + parent[1]]
+            owned[start] = False
+            own_start += 1
+        node_vert_indices[own_start:end] = np.arange(vertex_count, vertex_count + end - own_start)
+        vertex_count += end - own_start
+    vert_nodes = np.flatnonzero(owned)
+    ends = np.flatnonzero(arrays.node_indices != 0)
+    edges = np.stack((node_vert_indices[ends - 1], node_vert_indices[ends]), axis=1)
+    return vert_nodes, edges
+
+
+def write_skeleton_mesh(mesh, locations, edges, radii):
+    mesh.clear_geometry()
+    mesh.vertices.add(len(locations))
+    mesh.edges.add(len(edges))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(locations, dtype=np.float32).ravel())
+    mesh.edges.foreach_set("vertices", np.ascontiguousarray(edges, dtype=np.int32).ravel())
+    radius_attr = mesh.attributes.new("radius", "FLOAT", "POINT")
+    radius_attr.data.foreach_set("value", np.ascontiguousarray(radii, dtype=np.float32))
+    mesh.update()
+
+
+# topology of the skeleton meshes written last, keyed by mesh session uid
+_skeleton_topologies = {}
+
+
+def update_skeleton_mesh(mesh, locations, edges, radii):
+    # when only positions and radii changed they are written in place, returns whether the mesh was rebuilt
+    edges = np.ascontiguousarray(edges, dtype=np.int32)
+    topology = (get_reload_version(), len(locations), edges.tobytes())
+    radius_attr = mesh.attributes.get("radius")
+    if _skeleton_topologies.get(mesh.session_uid) == topology \
+            and len(mesh.vertices) == len(locations) \
+            and len(mesh.edges) == len(edges) \
+            and radius_attr is not None:
+        mesh.vertices.foreach_set("co", np.ascontiguousarray(locations, dtype=np.float32).ravel())
+        radius_attr.data.foreach_set("value", np.ascontiguousarray(radii, dtype=np.float32))
+        mesh.update()
+        return False
+    write_skeleton_mesh(mesh, locations, edges, radii)
+    _skeleton_topologies[mesh.session_uid] = topology
+    return True
+
+
+def get_enabled_output(node):
+    # nodes like Named Attribute have one output per data type, only the current one is enabled
+    for socket in node.outputs:
+        if socket.enabled:
+            return socket
+
+
+def create_attribute_node_group():
+    tree = bpy.data.node_groups.new("Geometry Nodes", "GeometryNodeTree")
+    tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='INPUT')
+    tree.interface.new_socket(name="Geometry", socket_type="NodeSocketGeometry", in_out='OUTPUT')
+
+    def new_node(node_type, name, x, y):
+        node = tree.nodes.new(type=node_type)
+        node.name = name
+        node.select = False
+        node.location = (x, y)
+        return node
+
+    input_node = new_node("NodeGroupInput", "Input", -600, 0)
+    output_node = new_node("NodeGroupOutput", "Output", 800, 0)
+    output_node.is_active_output = True
+
+    radius_node = new_node("GeometryNodeInputNamedAttribute", "Radius", -600, -200)
+    radius_node.data_type = "FLOAT"
+    radius_node.inputs["Name"].default_value = "radius"
+    radius_socket = get_enabled_output(radius_node)
+
+    # tubes, one curve per chain of skeleton edges
+    to_curve_node = new_node("GeometryNodeMeshToCurve", "Mesh To Curve", -400, 200)
+    profile_node = new_node("GeometryNodeCurvePrimitiveCircle", "Profile", -400, 50)
+    profile_node.inputs["Radius"].default_value = 1
+    to_mesh_node = new_node("GeometryNodeCurveToMesh", "Curve To Mesh", -200, 200)
+    to_mesh_node.inputs["Fill Caps"].default_value = True
+    tree.links.new(input_node.outputs[0], to_curve_node.inputs["Mesh"])
+    tree.links.new(to_curve_node.outputs["Curve"], to_mesh_node.inputs["Curve"])
+    tree.links.new(profile_node.outputs["Curve"], to_mesh_node.inputs["Profile Curve"])
+    # the radius attribute becomes the curve radius, which already scales the profile
+
+    # balls, one sphere per skeleton vertex
+    sphere_node = new_node("GeometryNodeMeshUVSphere", "Sphere", -400, -300)
+    instance_node = new_node("GeometryNodeInstanceOnPoints", "Instance", -200, -200)
+    realize_node = new_node("GeometryNodeRealizeInstances", "Realize", 0, -200)
+    tree.links.new(input_node.outputs[0], instance_node.inputs["Points"])
+    tree.links.new(sphere_node.outputs["Mesh"], instance_node.inputs["Instance"])
+    tree.links.new(radius_socket, instance_node.inputs["Scale"])
+    tree.links.new(instance_node.outputs["Instances"], realize_node.inputs["Geometry"])
+
+    join_node = new_node("GeometryNodeJoinGeometry", "Join", 600, 0)
+    tree.links.new(to_mesh_node.outputs["Mesh"], join_node.inputs["Geometry"])
+    tree.links.new(realize_node.outputs["Geometry"], join_node.inputs["Geometry"])
+    tree.links.new(join_node.outputs["Geometry"], output_node.inputs["Geometry"])
+    return tree
+
+
+def build_attribute_geometry_node(obj):
+
+    # sketch nodes are stored as mesh vertices with a radius attribute, segments as edges
+    arrays = get_sketch_arrays(obj)
+    vert_nodes, edges = get_skeleton(obj, arrays)
+    update_skeleton_mesh(obj.data, arrays.locations[vert_nodes], edges, arrays.radii[vert_nodes])
+
+    # the node tree does not depend on the sketch size
+    geo_nodes = obj.modifiers.get("Fast Sketch Attribute Mesh")
+    if not geo_nodes:
+        geo_nodes = obj.modifiers.new("Fast Sketch Attribute Mesh", "NODES")
+        geo_nodes.node_group = create_attribute_node_group()
+        obj.modifiers.move(len(obj.modifiers) - 1, 0)
+    tree = geo_nodes.node_group
+
+    segments = get_segments(obj)
+    set_socket_value(tree.nodes["Sphere"].inputs["Segments"], max(segments * 2, 3))
+    set_socket_value(tree.nodes["Sphere"].inputs["Rings"], max(segments, 2))
+    set_socket_value(tree.nodes["Profile"].inputs["Resolution"], max(segments * 2, 3))
+
+
+def write_polygon_mesh(mesh, verts, tris, quads):
+    loops = np.concatenate((tris.ravel(), quads.ravel())).astype(np.int32)
+    loop_starts = np.concatenate((
+        np.arange(0, len(tris) * 3, 3),
+        np.arange(len(tris) * 3, len(loops), 4),
+    )).astype(np.int32)
+    write_polygons(mesh, verts, loops, loop_starts, np.ones(len(loop_starts), dtype=bool))
+
+
+def write_polygons(mesh, verts, loops, loop_starts, smooth):
+    _skeleton_topologies.pop(mesh.session_uid, None)
+    mesh.clear_geometry()
+    mesh.vertices.add(len(verts))
+    mesh.loops.add(len(loops))
+    mesh.polygons.add(len(loop_starts))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(verts, dtype=np.float32).ravel())
+    mesh.loops.foreach_set("vertex_index", np.ascontiguousarray(loops, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_start", np.ascontiguousarray(loop_starts, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", np.ascontiguousarray(smooth, dtype=bool))
+    mesh.update(calc_edges=True)
+
+
+def build_mesh(obj):
+
+    # capsules are generated directly from the sketch into the object mesh, without modifiers
+    arrays = get_sketch_arrays(obj)
+    vert_nodes, edges = get_skeleton(obj, arrays)
+    # capsules whose balls did not change are taken from the cache
+    segment_cache.set_max_bytes(get_preferences().segment_cache_size * 1024 * 1024)
+    verts, tris, quads = build_sketch_mesh(arrays.locations[vert_nodes], arrays.radii[vert_nodes], edges,
+                                           get_node_segments(obj, arrays)[vert_nodes], segment_cache)
+    write_polygon_mesh(obj.data, verts, tris, quads)
+
+
+def build_skin_modifier(obj):
 
     skin = obj.modifiers.get("Fast Sketch Skin")
     if not skin:
@@ -183,48 +700,29 @@ def build_skin_modifier():
         sub_surf = obj.modifiers.new("Fast Sketch Sub Surf", "SUBSURF")
         sub_surf.show_only_control_edges = False
         obj.modifiers.move(len(obj.modifiers) - 1, 1)
-    sub_surf.levels = obj.fast_sketch_properties.sub_surf_levels
-
-    bm = bmesh.new()
+    levels = get_sub_surf_levels(obj)
+    if sub_surf.levels != levels:
+        sub_surf.levels = levels
 
-    tubes = obj.fast_sketch_properties.tubes
-    tube_vert_index_map = []
-    vertex_count = 0
-    for tube in tubes:
-        node_vert_index_map = []
-        tube_vert_index_map.append(node_vert_index_map)
-        for node_index, node in enumerate(tube.nodes):
-            if node_index == 0 and tube.parent_tube_index >= 0:
-                node_vert_index_map.append(tube_vert_index_map[tube.parent_tube_index][tube.parent_node_index])
-            else:
-                node_vert_index_map.append(vertex_count)
-                vertex_count += 1
-                bm.verts.new((node.location.x, node.location.y, node.location.z))
-    bm.verts.ensure_lookup_table()
-    for tube_index, tube in enumerate(tubes):
-        for node_index in range(1, len(tube.nodes)):
-            i = tube_vert_index_map[tube_index][node_index - 1]
-            j = tube_vert_index_map[tube_index][node_index]
-            bm.edges.new((bm.verts[i], bm.verts[j]))
-
-    bm.to_mesh(obj.data)
+    arrays = get_sketch_arrays(obj)
+    vert_nodes, edges = get_skeleton(obj, arrays)
+    radii = arrays.radii[vert_nodes]
+    rebuilt = update_skeleton_mesh(obj.data, arrays.locations[vert_nodes], edges, radii)
 
     if not len(obj.data.skin_vertices):
-        bpy.ops.mesh.customdata_skin_add()
+        with bpy.context.temp_override(object=obj, active_object=obj):
+            bpy.ops.mesh.customdata_skin_add()
+        rebuilt = True
 
     skin_verts = obj.data.skin_vertices[0].data
-    for tube_index, tube in enumerate(tubes):
-        for node_index, node in enumerate(tube.nodes):
-            if node_index == 0 and tube.parent_tube_index >= 0:
-                continue
-            vert_index = tube_vert_index_map[tube_index][node_index]
-            skin_vert = skin_verts[vert_index]
-            skin_vert.radius[0] = skin_vert.radius[1] = node.radius
-            skin_vert.use_root = node_index == 0
+    skin_verts.foreach_set("radius", np.repeat(radii, 2))
+    if rebuilt:
+        skin_verts.foreach_set("use_root", arrays.node_indices[vert_nodes] == 0)
 
 
-def update_mirror():
-    obj = bpy.context.object
+def update_mirror(obj=None):
+    if obj is None:
+        obj = bpy.context.object
     if obj is None or not obj.fast_sketch_properties.is_fast_sketch:
         return
 
@@ -0,0 +1,9 @@
+import os
+import sys
+import types
+
+# the add-on package needs bpy when it is loaded, so the modules that only need numpy are imported from it without
+# running its __init__.py
+package = types.ModuleType("fast_sketch")
+package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fast_sketch")]
+sys.modules.setdefault("fast_sketch", package)
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pytest
+
+from fast_sketch.cache import BakeCache, hash_bake_key
+
+
+def make_arrays(seed):
+    rng = np.random.default_rng(seed)
+    return {
+        "verts": rng.uniform(-1, 1, (20, 3)).astype(np.float32),
+        "loops": rng.integers(0, 20, 40).astype(np.int32),
+        "smooth": rng.integers(0, 2, 10).astype(bool),
+    }
+
+
+def cache_files(directory, suffix):
+    return sorted(name for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def test_hit_gives_identical_arrays(tmp_path):
+    cache = BakeCache(1024 * 1024, str(tmp_path))
+    arrays = make_arrays(0)
+    key = hash_bake_key(arrays["verts"], 0.5, "Voxel")
+    assert cache.get(key) is None
+    cache.put(key, arrays)
+    cached = cache.get(key)
+    assert cached.keys() == arrays.keys()
+    for name, values in arrays.items():
+        assert cached[name].dtype == values.dtype
+        assert np.array_equal(cached[name], values)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_depend_on_values_types_and_shapes():
+    values = np.arange(6, dtype=np.float32)
+    key = hash_bake_key(values, 1)
+    assert key == hash_bake_key(values.copy(), 1)
+    assert key != hash_bake_key(values, 2)
+    assert key != hash_bake_key(values.astype(np.float64), 1)
+    assert key != hash_bake_key(values.reshape(2, 3), 1)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BakeCache(1024 * 1024, str(tmp_path))
+    cache.put("a", make_arrays(1))
+    entry_size = cache.get_size()
+    cache.max_bytes = entry_size * 2 + entry_size // 2
+    cache.put("b", make_arrays(2))
+    os.utime(tmp_path / "a.npz", (1000, 1000))
+    os.utime(tmp_path / "b.npz", (2000, 2000))
+    # reading marks a as used
+    assert cache.get("a") is not None
+    cache.put("c", make_arrays(3))
+    assert cache_files(tmp_path, ".npz") == ["a.npz", "c.npz"]
+    assert cache.get("b") is None
+
+
+def test_disabled_cache_writes_nothing(tmp_path):
+    cache = BakeCache(0, str(tmp_path))
+    cache.put("a", make_arrays(1))
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_write_leaves_no_files(tmp_path):
+    cache = BakeCache(1024 * 1024, str(tmp_path))
+    with pytest.raises(Exception):
+        # lambdas can not be pickled
+        cache.put("a", {"values": np.array([lambda: None], dtype=object)})
+    assert os.listdir(tmp_path) == []
+
+
+def test_clear(tmp_path):
+    cache = BakeCache(1024 * 1024, str(tmp_path))
+    cache.put("a", make_arrays(1))
+    cache.put("b", make_arrays(2))
+    cache.clear()
+    assert cache.get_size() == 0
+    assert cache.get("a") is None
@@ -0,0 +1,127 @@
+import math
+
+import numpy as np
+
+from fast_sketch.mesher import build_sketch_mesh, SegmentCache, build_voxel_mesh, smooth_union
+
+
+def mesh_triangles(tris, quads):
+    quads = np.asarray(quads).reshape(-1, 4)
+    return np.concatenate((np.asarray(tris).reshape(-1, 3), quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]))
+
+
+def assert_closed_manifold(tris, quads):
+    # every edge is used once in each direction by the faces around it
+    faces = [face for face in np.asarray(tris).reshape(-1, 3).tolist() + np.asarray(quads).reshape(-1, 4).tolist()]
+    edges = {}
+    for face in faces:
+        for a, b in zip(face, face[1:] + face[:1]):
+            assert a != b
+            edges[(a, b)] = edges.get((a, b), 0) + 1
+    assert edges
+    for (a, b), count in edges.items():
+        assert count == 1
+        assert edges.get((b, a)) == 1
+
+
+def signed_volume(verts, tris, quads):
+    triangles = np.asarray(verts, dtype=np.float64)[mesh_triangles(tris, quads)]
+    return np.einsum("ij,ij->i", triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])).sum() / 6
+
+
+def capsule_volume(radius, length):
+    return 4 / 3 * math.pi * radius ** 3 + math.pi * radius ** 2 * length
+
+
+def test_sketch_mesh_is_closed():
+    locations = np.array([[0, 0, 0], [2, 0, 0], [3, 2, 0], [10, 0, 0]], dtype=np.float32)
+    radii = np.array([1, 0.5, 0.8, 1], dtype=np.float32)
+    edges = np.array([[0, 1], [1, 2]], dtype=np.int32)
+    verts, tris, quads = build_sketch_mesh(locations, radii, edges, 4)
+    assert_closed_manifold(tris, quads)
+    assert signed_volume(verts, tris, quads) > 0
+
+
+def test_capsule_volume():
+    locations = np.array([[0, 0, 0], [0, 0, 3]], dtype=np.float32)
+    radii = np.array([1, 1], dtype=np.float32)
+    verts, tris, quads = build_sketch_mesh(locations, radii, [[0, 1]], 8)
+    volume = signed_volume(verts, tris, quads)
+    # the faces are inside the rounded surface
+    assert 0.9 * capsule_volume(1, 3) < volume <= capsule_volume(1, 3)
+
+
+def test_sphere_volume():
+    verts, tris, quads = build_sketch_mesh(np.array([[1, 2, 3]]), np.array([2.0]), np.empty((0, 2)), 8)
+    assert_closed_manifold(tris, quads)
+    assert 0.9 * capsule_volume(2, 0) < signed_volume(verts, tris, quads) <= capsule_volume(2, 0)
+
+
+def test_adaptive_segments_mesh_is_closed():
+    locations = np.array([[0, 0, 0], [2, 0, 0], [4, 1, 0]], dtype=np.float32)
+    radii = np.array([1, 0.3, 0.6], dtype=np.float32)
+    verts, tris, quads = build_sketch_mesh(locations, radii, [[0, 1], [1, 2]], np.array([6, 2, 3]))
+    assert_closed_manifold(tris, quads)
+    assert signed_volume(verts, tris, quads) > 0
+
+
+def test_segment_cache_hit_gives_the_same_mesh():
+    locations = np.array([[0, 0, 0], [2, 0, 0], [3, 2, 0]], dtype=np.float32)
+    radii = np.array([1, 0.5, 0.8], dtype=np.float32)
+    edges = np.array([[0, 1], [1, 2]], dtype=np.int32)
+    cache = SegmentCache(1024 * 1024)
+    first = build_sketch_mesh(locations, radii, edges, 4, cache)
+    assert cache.misses == 2 and cache.hits == 0
+    second = build_sketch_mesh(locations, radii, edges, 4, cache)
+    assert cache.hits == 2
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
+    for a, b in zip(first, build_sketch_mesh(locations, radii, edges, 4)):
+        assert np.array_equal(a, b)
+
+
+def test_segment_cache_evicts_least_recently_used():
+    verts = np.zeros((10, 3), dtype=np.float64)
+    entry_size = verts.nbytes + 1
+    cache = SegmentCache(entry_size * 2)
+    cache.put(b"a", verts)
+    cache.put(b"b", verts.copy())
+    assert cache.get(b"a") is not None
+    cache.put(b"c", verts.copy())
+    assert len(cache) == 2
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") is not None and cache.get(b"c") is not None
+    assert cache.size == entry_size * 2
+
+
+def test_segment_cache_shrinks():
+    cache = SegmentCache(1024 * 1024)
+    for key in (b"a", b"b", b"c"):
+        cache.put(key, np.zeros((10, 3)))
+    cache.set_max_bytes(0)
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_voxel_mesh_is_closed():
+    locations = np.array([[0, 0, 0], [2, 0, 0], [3, 2, 0], [3, 2, 3]], dtype=np.float32)
+    radii = np.array([1, 0.5, 0.8, 0.6], dtype=np.float32)
+    verts, quads, voxel_size = build_voxel_mesh(locations, radii, [[0, 1], [1, 2]], 0.1, blend=0.3)
+    assert_closed_manifold(np.empty((0, 3), dtype=np.int32), quads)
+    assert signed_volume(verts, np.empty((0, 3), dtype=np.int32), quads) > 0
+
+
+def test_voxel_ball_volume():
+    verts, quads, voxel_size = build_voxel_mesh(np.array([[1, 2, 3]]), np.array([1.0]), np.empty((0, 2)), 0.05)
+    assert_closed_manifold(np.empty((0, 3), dtype=np.int32), quads)
+    volume = signed_volume(verts, np.empty((0, 3), dtype=np.int32), quads)
+    assert abs(volume - capsule_volume(1, 0)) < 0.05 * capsule_volume(1, 0)
+
+
+def test_smooth_union():
+    distances = np.array([[1.0, 3.0], [0.5, 0.6], [-1.0, 2.0]])
+    # without blending it is the union
+    assert np.allclose(smooth_union(distances, 0), distances.min(axis=1))
+    blended = smooth_union(distances, 0.5)
+    # surfaces further apart than the blend radius are not changed, closer ones bulge out
+    assert np.isclose(blended[0], 1.0) and np.isclose(blended[2], -1.0)
+    assert blended[1] < 0.5
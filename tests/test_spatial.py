@@ -0,0 +1,132 @@
+import numpy as np
+
+from fast_sketch.spatial import PickingGrid, points_in_box, points_in_circle, points_in_lasso, find_overlap_clusters
+
+
+def make_grid(rng, count, cell_size=64, width=800, height=600):
+    centers = rng.uniform((-100, -100), (width + 100, height + 100), (count, 2))
+    radii = rng.uniform(0, 150, count)
+    tube_indices = np.repeat(np.arange(count // 10 + 1), 10)[:count]
+    node_indices = np.arange(count) % 10
+    grid = PickingGrid(cell_size, centers, radii, tube_indices, node_indices, width, height)
+    return grid, centers, radii, tube_indices, node_indices
+
+
+def brute_force_query(centers, radii, tube_indices, node_indices, location, cell_size, width, height):
+    # every circle on screen whose bounding box covers the cell of the location, in tube order
+    cx = location[0] // cell_size
+    cy = location[1] // cell_size
+    x = centers[:, 0]
+    y = centers[:, 1]
+    on_screen = (x + radii >= 0) & (y + radii >= 0) & (x - radii <= width) & (y - radii <= height)
+    covers = (np.floor((x - radii) / cell_size) <= cx) & (cx <= np.floor((x + radii) / cell_size)) \
+        & (np.floor((y - radii) / cell_size) <= cy) & (cy <= np.floor((y + radii) / cell_size))
+    hits = np.flatnonzero(on_screen & covers)
+    return list(zip(tube_indices[hits].tolist(), node_indices[hits].tolist()))
+
+
+def test_picking_grid_matches_brute_force():
+    rng = np.random.default_rng(1)
+    grid, centers, radii, tube_indices, node_indices = make_grid(rng, 300)
+    for location in rng.uniform((0, 0), (800, 600), (500, 2)):
+        expected = brute_force_query(centers, radii, tube_indices, node_indices, location, 64, 800, 600)
+        assert list(grid.query(location)) == expected
+
+
+def test_picking_grid_finds_every_circle_under_the_location():
+    rng = np.random.default_rng(2)
+    grid, centers, radii, tube_indices, node_indices = make_grid(rng, 300)
+    for location in rng.uniform((0, 0), (800, 600), (500, 2)):
+        candidates = set(grid.query(location))
+        under = np.flatnonzero(np.linalg.norm(centers - location, axis=1) <= radii)
+        assert set(zip(tube_indices[under].tolist(), node_indices[under].tolist())) <= candidates
+
+
+def test_picking_grid_outside_region():
+    rng = np.random.default_rng(3)
+    grid = make_grid(rng, 50)[0]
+    assert list(grid.query((-10, 10))) == []
+    assert list(grid.query((10, 10000))) == []
+
+
+def test_points_in_box():
+    points = np.array([[5, 5], [0, 0], [10, 10], [11, 5], [5, -1]], dtype=np.float32)
+    # corners in any order
+    assert points_in_box(points, (10, 10), (0, 0)).tolist() == [True, True, True, False, False]
+
+
+def test_points_in_circle():
+    points = np.array([[0, 0], [3, 4], [3.1, 4], [-5, 0], [0, -6]], dtype=np.float32)
+    assert points_in_circle(points, (0, 0), 5).tolist() == [True, True, False, True, False]
+
+
+def test_points_in_lasso():
+    # an L shape, its notch is outside
+    path = [(0, 0), (10, 0), (10, 4), (4, 4), (4, 10), (0, 10)]
+    points = np.array([[2, 2], [8, 2], [2, 8], [8, 8], [12, 2], [-1, 5], [2, 11]], dtype=np.float32)
+    assert points_in_lasso(points, path).tolist() == [True, True, True, False, False, False, False]
+
+
+def test_points_in_lasso_either_direction():
+    rng = np.random.default_rng(4)
+    points = rng.uniform(-2, 2, (200, 2))
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    path = np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    inside = np.linalg.norm(points, axis=1) < 0.99
+    outside = np.linalg.norm(points, axis=1) > 1.0
+    for lasso in (path, path[::-1]):
+        result = points_in_lasso(points, lasso)
+        assert np.all(result[inside])
+        assert not np.any(result[outside])
+
+
+def test_points_in_lasso_too_short():
+    points = np.zeros((3, 2), dtype=np.float32)
+    assert not np.any(points_in_lasso(points, [(-1, -1), (1, 1)]))
+
+
+def sphere_boxes(centers, radii):
+    centers = np.asarray(centers, dtype=np.float64)
+    radii = np.asarray(radii, dtype=np.float64)[:, np.newaxis]
+    return centers - radii, centers + radii
+
+
+def test_overlap_clusters_overlapping_and_disjoint():
+    mins, maxs = sphere_boxes([(0, 0, 0), (1.5, 0, 0), (10, 0, 0), (0, 10, 0)], [1, 1, 1, 1])
+    clusters = find_overlap_clusters(mins, maxs)
+    assert clusters[0] == clusters[1]
+    assert len({clusters[0], clusters[2], clusters[3]}) == 3
+
+
+def test_overlap_clusters_are_transitive():
+    # the first and the last sphere only meet through the middle one
+    mins, maxs = sphere_boxes([(0, 0, 0), (1.8, 0, 0), (3.6, 0, 0)], [1, 1, 1])
+    assert len(set(find_overlap_clusters(mins, maxs).tolist())) == 1
+
+
+def test_overlap_clusters_need_overlap_on_every_axis():
+    # overlapping along x only
+    mins, maxs = sphere_boxes([(0, 0, 0), (0.5, 5, 0), (0.5, 0, 5)], [1, 1, 1])
+    assert len(set(find_overlap_clusters(mins, maxs).tolist())) == 3
+
+
+def test_overlap_clusters_keep_groups_apart():
+    mins, maxs = sphere_boxes([(0, 0, 0), (1, 0, 0), (2, 0, 0)], [1, 1, 1])
+    clusters = find_overlap_clusters(mins, maxs, np.array([0, 1, 0]))
+    assert clusters[0] == clusters[2]
+    assert clusters[0] != clusters[1]
+
+
+def test_overlap_clusters_match_brute_force():
+    rng = np.random.default_rng(5)
+    centers = rng.uniform(0, 20, (200, 3))
+    mins, maxs = sphere_boxes(centers, rng.uniform(0.1, 1, 200))
+    clusters = find_overlap_clusters(mins, maxs)
+    touching = np.all((mins[:, np.newaxis] <= maxs[np.newaxis]) & (maxs[:, np.newaxis] >= mins[np.newaxis]), axis=2)
+    # boxes that touch share a cluster, and every cluster is connected by touching boxes
+    pairs = np.argwhere(touching)
+    assert np.all(clusters[pairs[:, 0]] == clusters[pairs[:, 1]])
+    labels = np.arange(200)
+    for _ in range(200):
+        labels = np.min(np.where(touching, labels[np.newaxis], 200), axis=1)
+    assert len(np.unique(labels)) == len(np.unique(clusters))